@@ -1,25 +1,116 @@
 """Console script for op_env."""
 import argparse
+from contextlib import contextmanager
+import fcntl
+import fnmatch
 import json
 import os
 import pipes
+import signal
 import subprocess
 import sys
-from typing import Any, cast, Dict, List, Optional, Sequence, Union
+from types import FrameType
+from typing import Any, cast, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
 
 from typing_extensions import TypedDict
 import yaml
 
-from .op import do_lookups, EnvVarName, Title
+from .breaker import CircuitBreaker, DEFAULT_RESET_AFTER, is_outage
+from .completion import note_lookup
+from .delivery import delivered_env
+from .item_cache import ItemVersionCache
+from .k8s import (load_secret_specs, parse_secret_spec, required_env_var_names, SecretSpec,
+                  stream_manifests, write_manifests)
+from .matrix import (diff_environments, EnvironmentSelector, parse_selector, render_matrix,
+                     resolve_matrix)
+from .op import (_account_lookups, _is_item_uuid, AccountLookup, BACKEND_NAMES,
+                 ConflictingValuesOPLookupError, do_lookups, do_partial_lookups, EnvVarName,
+                 FieldMapping, FieldName, FieldReference, FieldValue, iter_partial_lookups, Title)
+from .plan import plan_account_lookups, render_plan
+from .recording import recording, replaying
+from .store import describe_age, Snapshot, snapshot_name, SnapshotStore
+from .supervisor import load_procfile, supervise
 
+# Seconds after which --stale-while-revalidate won't print a snapshot
+# without refreshing it first
+DEFAULT_MAX_STALE = 86400.0
 
-class Arguments(TypedDict):
+# Names of the files 'check' looks for under directories it is given
+DEFAULT_CHECK_NAMES = ['vars.yml', 'vars.yaml']
+
+# Where 'check' reports problems with names and titles given as options
+COMMAND_LINE = '(command line)'
+
+
+class _RequiredArguments(TypedDict):
     operation: str
     environment: List[EnvVarName]
     title: List[Title]
     command: List[str]
 
 
+class Arguments(_RequiredArguments, total=False):
+    # Options below default to argparse.SUPPRESS, so they are only
+    # present when given on the command line.
+    stale_while_revalidate: bool
+    max_stale: float
+    changed_marker: str
+    refresh_snapshot: bool
+    secret: List[SecretSpec]
+    secrets_file: List[str]
+    output_dir: str
+    field_mapping: List[str]
+    timeout: float
+    op_timeout: float
+    file_variable: List[EnvVarName]
+    fd_variable: List[EnvVarName]
+    procfile: str
+    partial: bool
+    backend: str
+    circuit_breaker: int
+    circuit_reset: float
+    fallback_snapshot: bool
+    record: str
+    replay: str
+    tag_prefix: List[str]
+    all_tags: bool
+    path: List[str]
+    name: List[str]
+    env: List[EnvironmentSelector]
+    diff_only: bool
+    item_cache: bool
+    stream: bool
+    # from NAME=op://vault/item/field or NAME=ITEMUUID entries in
+    # the environment lists
+    references: Dict[EnvVarName, FieldReference]
+    # from ACCOUNT:NAME entries and --account-title; these names and
+    # titles are not in environment and title
+    accounts: Dict[str, AccountLookup]
+
+
+def load_text_environment(filename: str) -> List[str]:
+    "Environment list entries from a text file, one on each line"
+    variables = open(filename, 'r').read().split("\n")
+    # remove empty lines
+    return [variable for variable in variables if variable]
+
+
+def load_yaml_environment(filename: str) -> List[str]:
+    "Environment list entries from a YAML file holding a list of strings"
+    with open(filename, 'r') as stream:
+        variables_from_yaml = yaml.safe_load(stream)
+        if variables_from_yaml is None:
+            # treat an empty file as an empty list
+            variables_from_yaml = []
+        if not isinstance(variables_from_yaml, list):
+            raise argparse.ArgumentTypeError('YAML file must be a list; '
+                                             f'found {variables_from_yaml}')
+        if not all([isinstance(item, str) for item in variables_from_yaml]):
+            raise argparse.ArgumentTypeError('YAML file must contain a list of strings; '
+                                             f'found {variables_from_yaml}')
+    return variables_from_yaml
+
+
 class AppendListFromTextAction(argparse.Action):
     def __call__(self,
                  parser: argparse.ArgumentParser,
@@ -27,13 +118,9 @@ class AppendListFromTextAction(argparse.Action):
                  values: Union[str, Sequence[Any], None],
                  option_string: Optional[str] = None):
         assert isinstance(values, str)  # should be validated already by argparse
-        filename = values
-        variables = open(filename, 'r').read().split("\n")
-        # remove empty lines
-        variables = [variable for variable in variables if variable]
         envvars = getattr(namespace, self.dest)
         assert isinstance(envvars, list)  # should be validated already by argparse
-        envvars.extend(variables)
+        envvars.extend(load_text_environment(values))
 
 
 class AppendListFromYAMLAction(argparse.Action):
@@ -43,30 +130,184 @@ class AppendListFromYAMLAction(argparse.Action):
                  values: Union[str, Sequence[Any], None],
                  option_string: Optional[str] = None):
         assert isinstance(values, str)  # should be validated already by argparse
-        filename = values
-        with open(filename, 'r') as stream:
-            variables_from_yaml = yaml.safe_load(stream)
-            if variables_from_yaml is None:
-                # treat an empty file as an empty list
-                variables_from_yaml = []
-            if not isinstance(variables_from_yaml, list):
-                raise argparse.ArgumentTypeError('YAML file must be a list; '
-                                                 f'found {variables_from_yaml}')
-            if not all([isinstance(item, str) for item in variables_from_yaml]):
-                raise argparse.ArgumentTypeError('YAML file must contain a list of strings; '
-                                                 f'found {variables_from_yaml}')
         envvars = getattr(namespace, self.dest)
         assert isinstance(envvars, list)  # should be validated already by argparse
-        envvars.extend(variables_from_yaml)
+        envvars.extend(load_yaml_environment(values))
 
 
-def add_environment_arguments(arg_parser: argparse.ArgumentParser) -> None:
-    arg_parser.add_argument('--title', '-t',
-                            metavar='TITLE',
-                            action='append',
-                            default=[],
-                            help='title of 1Password item from which all tagged environment '
-                            'variable names will be set')
+def load_field_mapping(filenames: List[str]) -> Dict[EnvVarName, FieldReference]:
+    """Load YAML files mapping env var names to fields, like this:
+
+    WEB_DB_PASSWORD: password
+    STRIPE_KEY:
+      field: secret key
+      item: Stripe
+      vault: Private
+    """
+    field_mapping: Dict[EnvVarName, FieldReference] = {}
+    for filename in filenames:
+        with open(filename, 'r') as stream:
+            mapping_from_yaml = yaml.safe_load(stream)
+        if mapping_from_yaml is None:
+            # treat an empty file as an empty mapping
+            mapping_from_yaml = {}
+        if not isinstance(mapping_from_yaml, dict):
+            raise argparse.ArgumentTypeError('Field mapping file must be a mapping; '
+                                             f'found {mapping_from_yaml}')
+        for env_var_name, target in mapping_from_yaml.items():
+            if isinstance(target, str):
+                target = {'field': target}
+            if (not isinstance(target, dict) or
+                    not set(target).issubset({'field', 'item', 'vault'}) or
+                    ('field' not in target and 'item' not in target)):
+                raise argparse.ArgumentTypeError('Field mapping must map each env variable '
+                                                 'to a field name or to a mapping with '
+                                                 'field, item and/or vault keys; '
+                                                 f'found {env_var_name}: {target}')
+            field_mapping[EnvVarName(env_var_name)] = FieldReference(**target)
+    return field_mapping
+
+
+def parse_env_reference(entry: str) -> Tuple[EnvVarName, Optional[FieldReference]]:
+    """Split an environment list entry into its name and any direct reference.
+
+    Entries may be a plain name (looked up by tag),
+    NAME=op://vault/item/field or NAME=ITEMUUID.
+    """
+    env_var_name, sep, target = entry.partition('=')
+    if sep == '':
+        return EnvVarName(entry), None
+    if target.startswith('op://'):
+        parts = target[len('op://'):].split('/')
+        if len(parts) == 3 and all(parts):
+            vault, item, field = parts
+            return EnvVarName(env_var_name), FieldReference(field=FieldName(field),
+                                                            item=item,
+                                                            vault=vault)
+    elif _is_item_uuid(target):
+        return EnvVarName(env_var_name), FieldReference(field=None, item=target)
+    raise argparse.ArgumentTypeError('Environment entries must be NAME, '
+                                     'NAME=op://vault/item/field or NAME=ITEMUUID; '
+                                     f'found {entry}')
+
+
+def split_account(entry: str) -> Tuple[Optional[str], str]:
+    "Split off the ACCOUNT: prefix of an ACCOUNT:NAME or ACCOUNT:NAME=REFERENCE entry"
+    name_part, _, _ = entry.partition('=')
+    if ':' not in name_part:
+        return None, entry
+    shorthand, _, rest = entry.partition(':')
+    if shorthand == '' or rest == '':
+        raise argparse.ArgumentTypeError(f'Account must be given as ACCOUNT:NAME; found {entry}')
+    return shorthand, rest
+
+
+def format_env_reference(env_var_name: EnvVarName, field_reference: FieldReference) -> str:
+    if field_reference.vault is None:
+        return f'{env_var_name}={field_reference.item}'
+    return (f'{env_var_name}=op://{field_reference.vault}/{field_reference.item}/'
+            f'{field_reference.field}')
+
+
+def tag_prefixes(args: Arguments) -> List[str]:
+    "Prefixes of the tags to find and look up, with '' standing for every tag"
+    return list(args.get('tag_prefix', [])) + ([''] if args.get('all_tags') else [])
+
+
+def lookup_field_mapping(args: Arguments) -> Optional[FieldMapping]:
+    "The field mapping files and references in args, combined, if any were given"
+    if 'field_mapping' not in args and 'references' not in args:
+        return None
+    return {
+        **load_field_mapping(args.get('field_mapping', [])),
+        **args.get('references', {}),
+    }
+
+
+def lookup_options(args: Arguments) -> Dict[str, Any]:
+    "Keyword arguments for do_lookups() from any lookup options given"
+    options: Dict[str, Any] = {}
+    field_mapping = lookup_field_mapping(args)
+    if field_mapping is not None:
+        options['field_mapping'] = field_mapping
+    if 'timeout' in args:
+        options['timeout'] = args['timeout']
+    if 'op_timeout' in args:
+        options['per_call_timeout'] = args['op_timeout']
+    if 'backend' in args:
+        options['backend'] = args['backend']
+    if 'accounts' in args:
+        options['accounts'] = args['accounts']
+    if 'circuit_breaker' in args:
+        options['breaker'] = CircuitBreaker(args['circuit_breaker'],
+                                            args.get('circuit_reset', DEFAULT_RESET_AFTER))
+    if tag_prefixes(args):
+        options['tag_prefixes'] = tag_prefixes(args)
+    if args.get('item_cache'):
+        options['item_cache'] = ItemVersionCache(SnapshotStore())
+    return options
+
+
+def lookup_argv(args: Arguments) -> List[str]:
+    "Command line arguments which reproduce the lookup given in args"
+    argv: List[str] = []
+    references = args.get('references', {})
+
+    def env_entry(envvar: EnvVarName) -> str:
+        if envvar in references:
+            return format_env_reference(envvar, references[envvar])
+        return envvar
+    for envvar in args['environment']:
+        argv += ['-e', env_entry(envvar)]
+    for title in args['title']:
+        argv += ['-t', title]
+    for shorthand, account_lookup in args.get('accounts', {}).items():
+        for envvar in account_lookup.env_var_names:
+            argv += ['-e', f'{shorthand}:{env_entry(envvar)}']
+        for title in account_lookup.titles:
+            argv += ['--account-title', f'{shorthand}:{title}']
+    for tag_prefix in args.get('tag_prefix', []):
+        argv += ['--tag-prefix', tag_prefix]
+    if args.get('all_tags'):
+        argv += ['--all-tags']
+    for field_mapping_file in args.get('field_mapping', []):
+        argv += ['--field-mapping', os.path.abspath(field_mapping_file)]
+    if 'timeout' in args:
+        argv += ['--timeout', str(args['timeout'])]
+    if 'op_timeout' in args:
+        argv += ['--op-timeout', str(args['op_timeout'])]
+    if 'backend' in args:
+        argv += ['--backend', args['backend']]
+    if 'circuit_breaker' in args:
+        argv += ['--circuit-breaker', str(args['circuit_breaker'])]
+    if 'circuit_reset' in args:
+        argv += ['--circuit-reset', str(args['circuit_reset'])]
+    if args.get('item_cache'):
+        argv += ['--item-cache']
+    if args.get('fallback_snapshot'):
+        argv += ['--fallback-snapshot']
+    if 'record' in args:
+        argv += ['--record', os.path.abspath(args['record'])]
+    if 'replay' in args:
+        argv += ['--replay', os.path.abspath(args['replay'])]
+    return argv
+
+
+def add_environment_arguments(arg_parser: argparse.ArgumentParser,
+                              single_environment: bool = True) -> None:
+    """Add the options which say what to look up, and how.
+
+    Without single_environment, options which pick out where values
+    come from (titles, tag prefixes and accounts) are left out, for
+    subcommands which are given environments to look in instead.
+    """
+    if single_environment:
+        arg_parser.add_argument('--title', '-t',
+                                metavar='TITLE',
+                                action='append',
+                                default=[],
+                                help='title of 1Password item from which all tagged '
+                                'environment variable names will be set')
     arg_parser.add_argument('--environment', '-e',
                             metavar='ENVVAR',
                             action='append',
@@ -87,6 +328,83 @@ def add_environment_arguments(arg_parser: argparse.ArgumentParser) -> None:
                             default=[],
                             help='Text config specifying environment variable '
                             'names to set, one on each line')
+    if single_environment:
+        arg_parser.add_argument('--tag-prefix',
+                                metavar='PREFIX',
+                                action='append',
+                                default=argparse.SUPPRESS,
+                                help='also set every environment variable named by a 1Password '
+                                'tag starting with this, found with a single listing of items')
+        arg_parser.add_argument('--all-tags',
+                                action='store_true',
+                                default=argparse.SUPPRESS,
+                                help='also set every environment variable named by any '
+                                '1Password tag')
+    arg_parser.add_argument('--field-mapping', '-m',
+                            metavar='MAPPINGYAML',
+                            action='append',
+                            default=argparse.SUPPRESS,
+                            help='YAML config mapping environment variable names to the '
+                            '1Password field (and optionally item and vault) to read')
+    arg_parser.add_argument('--timeout',
+                            metavar='SECONDS',
+                            type=float,
+                            default=argparse.SUPPRESS,
+                            help='give up if looking up values takes longer than this in total')
+    arg_parser.add_argument('--op-timeout',
+                            metavar='SECONDS',
+                            type=float,
+                            default=argparse.SUPPRESS,
+                            help='give up if any single op command takes longer than this')
+    if single_environment:
+        arg_parser.add_argument('--account-title',
+                                metavar='ACCOUNT:TITLE',
+                                action='append',
+                                default=argparse.SUPPRESS,
+                                help='title of 1Password item in the given op account from '
+                                'which all tagged environment variable names will be set; env '
+                                'variables can be scoped to an account the same way, as '
+                                'ACCOUNT:NAME')
+    arg_parser.add_argument('--backend',
+                            choices=BACKEND_NAMES,
+                            default=argparse.SUPPRESS,
+                            help="generation of the 1Password 'op' CLI to use; 'auto' asks op "
+                            'for its version (default: $OP_ENV_BACKEND, or v1)')
+    arg_parser.add_argument('--circuit-breaker',
+                            metavar='FAILURES',
+                            type=int,
+                            default=argparse.SUPPRESS,
+                            help='after this many lookups in a row fail to reach 1Password, '
+                            'fail fast instead of waiting on op (shared by every op-env on '
+                            'this machine)')
+    arg_parser.add_argument('--circuit-reset',
+                            metavar='SECONDS',
+                            type=float,
+                            default=argparse.SUPPRESS,
+                            help='with --circuit-breaker, try 1Password again after this long '
+                            f'(default {DEFAULT_RESET_AFTER:g})')
+    arg_parser.add_argument('--item-cache',
+                            action='store_true',
+                            default=argparse.SUPPRESS,
+                            help='keep the fields of tagged items, encrypted, and fetch them '
+                            'again only once 1Password lists a new version of the item')
+    if single_environment:
+        arg_parser.add_argument('--fallback-snapshot',
+                                action='store_true',
+                                default=argparse.SUPPRESS,
+                                help='save values after each lookup, and use the saved values, '
+                                'with a warning, when 1Password cannot be reached')
+    recording_group = arg_parser.add_mutually_exclusive_group()
+    recording_group.add_argument('--record',
+                                 metavar='DIR',
+                                 default=argparse.SUPPRESS,
+                                 help='save each op call made, with secret values redacted, to '
+                                 'this directory')
+    recording_group.add_argument('--replay',
+                                 metavar='DIR',
+                                 default=argparse.SUPPRESS,
+                                 help='answer op calls from a directory written by --record '
+                                 'instead of running op, taking as long as they originally did')
 
 
 def parse_argv(argv: List[str]) -> Arguments:
@@ -99,47 +417,606 @@ def parse_argv(argv: List[str]) -> Arguments:
                                        description=run_desc,
                                        help=run_desc)
     add_environment_arguments(run_parser)
+    run_parser.add_argument('--file-variable',
+                            metavar='ENVVAR',
+                            action='append',
+                            default=argparse.SUPPRESS,
+                            help='set this environment variable to the path of a private '
+                            'file holding its value, removed when the command exits')
+    run_parser.add_argument('--fd-variable',
+                            metavar='ENVVAR',
+                            action='append',
+                            default=argparse.SUPPRESS,
+                            help='set this environment variable to the number of an inherited '
+                            'file descriptor from which its value can be read')
+    run_parser.add_argument('--procfile',
+                            metavar='PROCFILE',
+                            default=argparse.SUPPRESS,
+                            help="run each 'name: command' line of this file at once, instead "
+                            'of a single command')
     run_parser.add_argument('command',
-                            nargs='+',
+                            nargs='*',
                             help='Command to run with the environment set from 1Password')
     json_desc = 'Produce simple JSON on stdout mapping requested env variables to values'
     json_parser = subparsers.add_parser('json',
                                         description=json_desc,
                                         help=json_desc)
     add_environment_arguments(json_parser)
+    json_parser.add_argument('--partial',
+                             action='store_true',
+                             default=argparse.SUPPRESS,
+                             help='print whatever values can be found, reporting every lookup '
+                             'failure on stderr rather than stopping at the first')
+    json_parser.add_argument('--stream',
+                             action='store_true',
+                             default=argparse.SUPPRESS,
+                             help='print a JSON line for each value or lookup failure as soon as '
+                             'it is known, rather than one object at the end')
+    plan_desc = ("Explain the op calls 'json' would make with the same arguments, "
+                 'without running any of them')
+    plan_parser = subparsers.add_parser('plan',
+                                        description=plan_desc,
+                                        help=plan_desc)
+    add_environment_arguments(plan_parser)
+    plan_parser.add_argument('--partial',
+                             action='store_true',
+                             default=argparse.SUPPRESS,
+                             help="plan for 'json --partial', which carries on past names "
+                             'that cannot be looked up')
     sh_desc = ("Produce commands on stdout that can be 'eval'ed to set "
                "variables in current shell")
     sh_parser = subparsers.add_parser('sh',
                                       help=sh_desc,
                                       description=sh_desc)
     add_environment_arguments(sh_parser)
-    return vars(parser.parse_args(argv[1:]))  # type: ignore
+    sh_parser.add_argument('--stale-while-revalidate',
+                           action='store_true',
+                           default=argparse.SUPPRESS,
+                           help='print the last known good values from the local encrypted '
+                           'snapshot right away and refresh them in the background')
+    sh_parser.add_argument('--max-stale',
+                           metavar='SECONDS',
+                           type=float,
+                           default=argparse.SUPPRESS,
+                           help='with --stale-while-revalidate, look up values before printing '
+                           f'if the snapshot is older than this (default {DEFAULT_MAX_STALE:g})')
+    sh_parser.add_argument('--changed-marker',
+                           metavar='FILE',
+                           default=argparse.SUPPRESS,
+                           help='with --stale-while-revalidate, file to touch when a background '
+                           "refresh finds changed values (e.g., for direnv's watch_file)")
+    sh_parser.add_argument('--refresh-snapshot',
+                           action='store_true',
+                           default=argparse.SUPPRESS,
+                           help=argparse.SUPPRESS)
+    k8s_desc = 'Produce Kubernetes Secret manifests containing the requested env variables'
+    k8s_parser = subparsers.add_parser('k8s',
+                                       help=k8s_desc,
+                                       description=k8s_desc)
+    add_environment_arguments(k8s_parser)
+    k8s_parser.add_argument('--secret', '-s',
+                            metavar='NAMESPACE/NAME',
+                            action='append',
+                            type=parse_secret_spec,
+                            default=argparse.SUPPRESS,
+                            help='Secret to create with every requested env variable')
+    k8s_parser.add_argument('--secrets-file', '-S',
+                            metavar='SECRETSYAML',
+                            action='append',
+                            default=argparse.SUPPRESS,
+                            help='YAML config listing secrets to create, each with a name, '
+                            'namespaces and environment variable names')
+    k8s_parser.add_argument('--output-dir', '-o',
+                            metavar='DIR',
+                            default=argparse.SUPPRESS,
+                            help='write one NAMESPACE.NAME.yaml file per secret, skipping '
+                            'secrets whose values are unchanged, instead of writing to stdout')
+    check_desc = ('Check that every environment list under the given paths can be looked up, '
+                  'reporting each problem without printing any values')
+    check_parser = subparsers.add_parser('check',
+                                         help=check_desc,
+                                         description=check_desc)
+    add_environment_arguments(check_parser)
+    check_parser.add_argument('--name', '-n',
+                              metavar='GLOB',
+                              action='append',
+                              default=argparse.SUPPRESS,
+                              help='name of environment list files to check under directories; '
+                              'files ending .yml or .yaml are read as YAML, others as text '
+                              f"(default {' and '.join(DEFAULT_CHECK_NAMES)})")
+    check_parser.add_argument('path',
+                              nargs='+',
+                              help='environment list file, or directory to search for them')
+    matrix_desc = ('Look up the same env variables in several environments at once, printing '
+                   "each environment's values and how they differ as JSON")
+    matrix_parser = subparsers.add_parser('matrix',
+                                          help=matrix_desc,
+                                          description=matrix_desc)
+    add_environment_arguments(matrix_parser, single_environment=False)
+    matrix_parser.add_argument('--env',
+                               metavar='LABEL=SELECTOR',
+                               action='append',
+                               type=parse_selector,
+                               required=True,
+                               help='environment to look in, as LABEL=title:TITLE (the item '
+                               'with this title), LABEL=prefix:PREFIX (tags starting with this '
+                               'followed by each name) or LABEL=account:ACCOUNT (the tags in '
+                               'this op account)')
+    matrix_parser.add_argument('--diff-only',
+                               action='store_true',
+                               default=argparse.SUPPRESS,
+                               help='leave values out, printing only lookup errors and a diff of '
+                               'hashes of the values')
+    args = vars(parser.parse_args(argv[1:]))
+    references: Dict[EnvVarName, FieldReference] = {}
+    environment: List[EnvVarName] = []
+    account_env_var_names: Dict[str, List[EnvVarName]] = {}
+    account_titles: Dict[str, List[Title]] = {}
+    try:
+        for entry in args['environment']:
+            shorthand, entry = split_account(entry)
+            env_var_name, field_reference = parse_env_reference(entry)
+            if shorthand is None:
+                environment.append(env_var_name)
+            else:
+                account_env_var_names.setdefault(shorthand, []).append(env_var_name)
+            if field_reference is not None:
+                references[env_var_name] = field_reference
+        for entry in args.get('account_title', []):
+            shorthand, title = split_account(entry)
+            if shorthand is None:
+                raise argparse.ArgumentTypeError('--account-title must be given as '
+                                                 f'ACCOUNT:TITLE; found {entry}')
+            account_titles.setdefault(shorthand, []).append(Title(title))
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    args.pop('account_title', None)
+    if references or account_env_var_names:
+        args['environment'] = environment
+    if references:
+        args['references'] = references
+    if account_env_var_names or account_titles:
+        args['accounts'] = {
+            shorthand: AccountLookup(env_var_names=account_env_var_names.get(shorthand, []),
+                                     titles=account_titles.get(shorthand, []))
+            for shorthand in {**account_env_var_names, **account_titles}
+        }
+    if args['operation'] == 'matrix':
+        args['title'] = []
+        labels = [selector.label for selector in args['env']]
+        if len(set(labels)) < len(labels):
+            matrix_parser.error('each --env needs a different LABEL')
+        if args.get('accounts'):
+            matrix_parser.error('env variables cannot be scoped to an account with ACCOUNT:NAME '
+                                'here; use --env LABEL=account:ACCOUNT')
+    if args.get('stream') and args.get('fallback_snapshot'):
+        json_parser.error('--stream cannot be used with --fallback-snapshot, as values '
+                          'would be printed before knowing whether 1Password can be reached')
+    if args['operation'] == 'run':
+        if 'procfile' in args and args['command']:
+            run_parser.error('give either a command or --procfile, not both')
+        if 'procfile' not in args and not args['command']:
+            run_parser.error('the following arguments are required: command')
+        if 'procfile' in args and 'fd_variable' in args:
+            run_parser.error('--fd-variable cannot be used with --procfile, as only one '
+                             'command could read each value')
+    return args  # type: ignore
 
 
-def process_args(args: Arguments) -> int:
-    if args['operation'] == 'run':
-        copied_env = dict(os.environ)
-        new_env = do_lookups(args['environment'], args['title'])
+def lookup_snapshot_name(args: Arguments) -> str:
+    env_var_names = list(args['environment'])
+    titles = list(args['title'])
+    for shorthand, account_lookup in args.get('accounts', {}).items():
+        env_var_names += [EnvVarName(f'{shorthand}:{envvar}')
+                          for envvar in account_lookup.env_var_names]
+        titles += [Title(f'{shorthand}:{title}') for title in account_lookup.titles]
+    env_var_names += [EnvVarName(f'{tag_prefix}*') for tag_prefix in tag_prefixes(args)]
+    return snapshot_name(env_var_names, titles, lookup_field_mapping(args),
+                         args.get('backend') or os.environ.get('OP_ENV_BACKEND') or 'v1')
+
+
+def lookup_env(args: Arguments) -> Tuple[Dict[EnvVarName, FieldValue], Optional[Snapshot]]:
+    """Look up the values in args, and the stale snapshot they came from, if any.
+
+    With --fallback-snapshot, values are saved after each lookup and
+    used in place of a lookup which couldn't reach 1Password.
+    """
+    if not args.get('fallback_snapshot'):
+        new_env = do_lookups(args['environment'], args['title'], **lookup_options(args))
+        note_lookup(new_env, args['title'])
+        return new_env, None
+    store = SnapshotStore()
+    name = lookup_snapshot_name(args)
+    try:
+        new_env = do_lookups(args['environment'], args['title'], **lookup_options(args))
+        note_lookup(new_env, args['title'])
+    except Exception as e:
+        if not is_outage(e):
+            raise
+        snapshot = store.load(name)
+        if snapshot is None:
+            raise
+        print(f'op-env: WARNING: could not look up values ({e}); using the last known good '
+              f'values, saved {describe_age(snapshot.age)} ago', file=sys.stderr)
+        return snapshot.values, snapshot
+    store.save(name, new_env)
+    return new_env, None
+
+
+def print_sh(new_env: Mapping[EnvVarName, FieldValue]) -> None:
+    for envvar, envvalue in new_env.items():
+        print(f'{envvar}={pipes.quote(envvalue)}; export {envvar}')
+
+
+def spawn_snapshot_refresh(args: Arguments) -> None:
+    "Refresh the snapshot for these arguments in a detached process"
+    refresh_argv = [sys.executable, '-m', 'op_env._cli', 'sh', '--refresh-snapshot']
+    refresh_argv += lookup_argv(args)
+    if 'changed_marker' in args:
+        refresh_argv += ['--changed-marker', args['changed_marker']]
+    subprocess.Popen(refresh_argv,
+                     stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def refresh_snapshot(args: Arguments) -> None:
+    store = SnapshotStore()
+    name = lookup_snapshot_name(args)
+    os.makedirs(store.directory, mode=0o700, exist_ok=True)
+    with open(store.path(name, 'lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another refresh of the same snapshot is already running
+            return
+        new_env = do_lookups(args['environment'], args['title'], **lookup_options(args))
+        changed = store.save(name, new_env)
+    if changed and 'changed_marker' in args:
+        with open(args['changed_marker'], 'a'):
+            os.utime(args['changed_marker'])
+
+
+def process_sh_stale_while_revalidate(args: Arguments) -> None:
+    store = SnapshotStore()
+    name = lookup_snapshot_name(args)
+    snapshot = store.load(name)
+    if snapshot is not None and snapshot.age <= args.get('max_stale', DEFAULT_MAX_STALE):
+        print_sh(snapshot.values)
+        spawn_snapshot_refresh(args)
+    else:
+        new_env = do_lookups(args['environment'], args['title'], **lookup_options(args))
+        store.save(name, new_env)
+        print_sh(new_env)
+
+
+def process_k8s(args: Arguments) -> None:
+    specs = list(args.get('secret', []))
+    for secrets_file in args.get('secrets_file', []):
+        specs.extend(load_secret_specs(secrets_file))
+    account_env_var_names = [
+        env_var_name
+        for account_lookup in args.get('accounts', {}).values()
+        for env_var_name in account_lookup.env_var_names
+    ]
+    env_var_names = list(args['environment']) + [
+        env_var_name for env_var_name in required_env_var_names(specs)
+        if env_var_name not in args['environment'] and
+        env_var_name not in account_env_var_names
+    ]
+    # Look up the union of everything once, however many secrets
+    # and namespaces it fans out to.
+    new_env, _ = lookup_env({**args, 'environment': env_var_names})
+    if 'output_dir' in args:
+        for path in write_manifests(specs, new_env, args['output_dir']):
+            print(path)
+    else:
+        stream_manifests(specs, new_env, sys.stdout)
+
+
+def process_run(args: Arguments) -> int:
+    copied_env = dict(os.environ)
+    new_env, stale_snapshot = lookup_env(args)
+    if stale_snapshot is not None:
+        # let the command know it's running on old values
+        copied_env['OP_ENV_SNAPSHOT_AGE'] = str(int(stale_snapshot.age))
+    file_variables = args.get('file_variable', [])
+    fd_variables = args.get('fd_variable', [])
+    for envvar in list(file_variables) + list(fd_variables):
+        if envvar not in new_env:
+            raise ValueError(f'{envvar} was not looked up, so it cannot be delivered '
+                             'via a file or file descriptor')
+    if 'procfile' in args:
+        if fd_variables:
+            raise ValueError('--fd-variable cannot be used with --procfile, as only one '
+                             'command could read each value')
+        entries = load_procfile(args['procfile'])
+        # Looked up once and shared by every command
+        with delivered_env(new_env, file_variables) as delivered:
+            copied_env.update(delivered.env)
+            return supervise(entries, copied_env)
+    if not file_variables and not fd_variables:
         copied_env.update(cast(Dict[str, str], new_env))
         subprocess.check_call(args['command'], env=copied_env)
         return 0
+    with delivered_env(new_env, file_variables, fd_variables) as delivered:
+        copied_env.update(delivered.env)
+        process = subprocess.Popen(args['command'], env=copied_env,
+                                   pass_fds=delivered.pass_fds)
+        terminated = False
+
+        def forward(signum: int, frame: Optional[FrameType]) -> None:
+            nonlocal terminated
+            terminated = True
+            process.send_signal(signum)
+        # If we're asked to terminate, the command is too, and files
+        # are only removed once it has exited
+        previous_handler = signal.signal(signal.SIGTERM, forward)
+        try:
+            returncode = process.wait()
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+    if terminated:
+        return 128 - returncode if returncode < 0 else returncode
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args['command'])
+    return 0
+
+
+def process_json_partial(args: Arguments) -> int:
+    result = do_partial_lookups(args['environment'], args['title'], **lookup_options(args))
+    note_lookup(result.values, [title for title in args['title']
+                                if title not in result.title_errors])
+    print(json.dumps(result.values))
+    for env_var_name, error in result.env_var_errors.items():
+        print(f'{env_var_name}: {error}', file=sys.stderr)
+    for title, error in result.title_errors.items():
+        print(f'{title}: {error}', file=sys.stderr)
+    return 0 if result.ok else 1
+
+
+def process_json_stream(args: Arguments) -> int:
+    """Print a JSON line for each value or failure as the lookups for them finish.
+
+    Lines are {"name": ..., "value": ...} for values, {"name": ...,
+    "error": ...} for names which couldn't be looked up, and {"title":
+    ..., "error": ...} for items which couldn't be.
+    """
+    values: Dict[EnvVarName, FieldValue] = {}
+    failed_titles: List[Title] = []
+    ok = True
+
+    def emit(record: Dict[str, str]) -> None:
+        sys.stdout.write(json.dumps(record) + '\n')
+        sys.stdout.flush()
+    for result in iter_partial_lookups(args['environment'], args['title'],
+                                       **lookup_options(args)):
+        ok = ok and result.ok
+        values.update(result.values)
+        failed_titles.extend(result.title_errors)
+        for env_var_name, value in result.values.items():
+            emit({'name': env_var_name, 'value': value})
+        for env_var_name, error in result.env_var_errors.items():
+            emit({'name': env_var_name, 'error': str(error)})
+        for title, error in result.title_errors.items():
+            emit({'title': title, 'error': str(error)})
+    note_lookup(values, [title for title in args['title'] if title not in failed_titles])
+    return 0 if ok else 1
+
+
+def find_env_files(paths: List[str], names: List[str]) -> List[str]:
+    "Files in paths, and files named like any of names under directories in paths"
+    found: List[str] = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith('.'))
+            found.extend(os.path.join(dirpath, filename) for filename in sorted(filenames)
+                         if any(fnmatch.fnmatch(filename, name) for name in names))
+    return found
+
+
+def load_env_file(filename: str) -> List[str]:
+    if filename.endswith(('.yml', '.yaml')):
+        return load_yaml_environment(filename)
+    return load_text_environment(filename)
+
+
+# An env var name to check, with its account (if not the default) and
+# any reference to the field it comes from
+CheckRequest = Tuple[Optional[str], EnvVarName, Optional[FieldReference]]
+
+
+def account_label(shorthand: Optional[str], env_var_name: EnvVarName) -> EnvVarName:
+    "How partial lookups key a name looked up in the given account"
+    return env_var_name if shorthand is None else EnvVarName(f'{shorthand}:{env_var_name}')
+
+
+def check_requests(args: Arguments,
+                   field_mapping: Mapping[EnvVarName, FieldReference]) -> \
+        Tuple[Dict[str, List[CheckRequest]], Dict[str, List[str]]]:
+    "What to check for each file (and the command line), and problems found loading them"
+    requests: Dict[str, List[CheckRequest]] = {COMMAND_LINE: []}
+    problems: Dict[str, List[str]] = {COMMAND_LINE: []}
+
+    def add(source: str,
+            shorthand: Optional[str],
+            env_var_name: EnvVarName,
+            reference: Optional[FieldReference] = None) -> None:
+        requests[source].append((shorthand, env_var_name,
+                                 reference or field_mapping.get(env_var_name)))
+    for env_var_name in args['environment']:
+        add(COMMAND_LINE, None, env_var_name)
+    for shorthand, account_lookup in args.get('accounts', {}).items():
+        for env_var_name in account_lookup.env_var_names:
+            add(COMMAND_LINE, shorthand, env_var_name)
+    for filename in find_env_files(args['path'], args.get('name', DEFAULT_CHECK_NAMES)):
+        requests[filename] = []
+        problems[filename] = []
+        try:
+            entries = load_env_file(filename)
+        except (OSError, ValueError, yaml.YAMLError, argparse.ArgumentTypeError) as e:
+            problems[filename].append(str(e))
+            continue
+        for entry in entries:
+            try:
+                account, entry = split_account(entry)
+                env_var_name, reference = parse_env_reference(entry)
+            except argparse.ArgumentTypeError as e:
+                problems[filename].append(str(e))
+                continue
+            add(filename, account, env_var_name, reference)
+    return requests, problems
+
+
+def process_check(args: Arguments) -> int:
+    """Look up every name in every file in as few batches as possible, reporting failures.
+
+    Names are looked up once however many files list them.  A name
+    which different files refer to different fields for is looked up
+    once per field, in later batches.
+    """
+    options = lookup_options(args)
+    requests, problems = check_requests(args, options.pop('field_mapping', {}))
+    options.pop('accounts', None)
+    discover = options.pop('tag_prefixes', None)
+    variants: Dict[EnvVarName, List[Optional[FieldReference]]] = {}
+    for source_requests in requests.values():
+        for _, env_var_name, reference in source_requests:
+            if reference not in variants.setdefault(env_var_name, []):
+                variants[env_var_name].append(reference)
+    # names as keyed in lookup results, with the account they're in
+    labels: Dict[EnvVarName, Tuple[Optional[str], EnvVarName]] = {}
+    for source_requests in requests.values():
+        for shorthand, env_var_name, _ in source_requests:
+            labels[account_label(shorthand, env_var_name)] = (shorthand, env_var_name)
+    errors: Dict[CheckRequest, Exception] = {}
+    batches = max([len(references) for references in variants.values()], default=1)
+    for batch in range(batches):
+        lookups: Dict[Optional[str], AccountLookup] = {}
+        if batch == 0:
+            lookups[None] = AccountLookup([], list(args['title']))
+            for account, account_lookup in args.get('accounts', {}).items():
+                lookups[account] = AccountLookup([], list(account_lookup.titles))
+        for source_requests in requests.values():
+            for shorthand, env_var_name, reference in source_requests:
+                env_var_names = lookups.setdefault(shorthand, AccountLookup([], [])).env_var_names
+                if variants[env_var_name].index(reference) == batch and \
+                        env_var_name not in env_var_names:
+                    env_var_names.append(env_var_name)
+        default_lookup = lookups.pop(None, AccountLookup([], []))
+        field_mapping: Dict[EnvVarName, FieldReference] = {}
+        for env_var_name, references in variants.items():
+            reference = references[batch] if len(references) > batch else None
+            if reference is not None:
+                field_mapping[env_var_name] = reference
+        result = do_partial_lookups(default_lookup.env_var_names, default_lookup.titles,
+                                    field_mapping=field_mapping,
+                                    accounts=cast(Dict[str, AccountLookup], lookups),
+                                    tag_prefixes=discover if batch == 0 else None,
+                                    **options)
+        for label, error in result.env_var_errors.items():
+            # different values in different accounts aren't a problem here
+            if isinstance(error, ConflictingValuesOPLookupError):
+                continue
+            if label in labels:
+                shorthand, env_var_name = labels[label]
+                errors[(shorthand, env_var_name, variants[env_var_name][batch])] = error
+            else:
+                # found by --tag-prefix or --all-tags
+                problems[COMMAND_LINE].append(f'{label}: {error}')
+        problems[COMMAND_LINE] += [f'{title}: {error}'
+                                   for title, error in result.title_errors.items()]
+    for source, source_requests in requests.items():
+        for shorthand, env_var_name, reference in source_requests:
+            failure = errors.get((shorthand, env_var_name, reference))
+            label = account_label(shorthand, env_var_name)
+            if failure is not None and f'{label}: {failure}' not in problems[source]:
+                problems[source].append(f'{label}: {failure}')
+    for source, source_problems in problems.items():
+        for problem in source_problems:
+            print(f'{source}: {problem}')
+    count = sum(len(source_problems) for source_problems in problems.values())
+    print(f'{len(problems) - 1} files and {len(variants)} names checked: '
+          f'{count} problem{"" if count == 1 else "s"}', file=sys.stderr)
+    return 1 if count else 0
+
+
+def process_matrix(args: Arguments) -> int:
+    options = lookup_options(args)
+    results = resolve_matrix(args['environment'], args['env'], **options)
+    diff = diff_environments(results, args['environment'])
+    print(json.dumps(render_matrix(results, diff, with_values=not args.get('diff_only'))))
+    return 0 if all(result.ok for result in results.values()) else 1
+
+
+def process_plan(args: Arguments) -> int:
+    plans = plan_account_lookups(_account_lookups(args['environment'], args['title'],
+                                                  args.get('accounts', {})),
+                                 lookup_field_mapping(args),
+                                 args.get('backend'),
+                                 partial=args.get('partial', False),
+                                 tag_prefixes=tag_prefixes(args),
+                                 item_cache=args.get('item_cache', False))
+    print(render_plan(plans,
+                      SnapshotStore().path(lookup_snapshot_name(args)),
+                      DEFAULT_MAX_STALE))
+    return 0
+
+
+def process_args(args: Arguments) -> int:
+    if args['operation'] == 'run':
+        return process_run(args)
     elif args['operation'] == 'json':
-        new_env = do_lookups(args['environment'], args['title'])
+        if args.get('stream'):
+            return process_json_stream(args)
+        if args.get('partial'):
+            return process_json_partial(args)
+        new_env, _ = lookup_env(args)
         print(json.dumps(new_env))
         return 0
+    elif args['operation'] == 'plan':
+        return process_plan(args)
+    elif args['operation'] == 'check':
+        return process_check(args)
+    elif args['operation'] == 'matrix':
+        return process_matrix(args)
     elif args['operation'] == 'sh':
-        new_env = do_lookups(args['environment'], args['title'])
-        for envvar, envvalue in new_env.items():
-            print(f'{envvar}={pipes.quote(envvalue)}; export {envvar}')
+        if args.get('refresh_snapshot'):
+            refresh_snapshot(args)
+        elif args.get('stale_while_revalidate'):
+            process_sh_stale_while_revalidate(args)
+        else:
+            print_sh(lookup_env(args)[0])
+        return 0
+    elif args['operation'] == 'k8s':
+        process_k8s(args)
         return 0
     else:
         raise ValueError(f"Unknown operation: {args['operation']}")
 
 
+@contextmanager
+def recorded_op_calls(args: Arguments) -> Iterator[None]:
+    "Record or replay op calls made in this context, as args ask"
+    if 'record' in args:
+        with recording(args['record']):
+            yield
+    elif 'replay' in args:
+        with replaying(args['replay']):
+            yield
+    else:
+        yield
+
+
 def main(argv: List[str] = sys.argv) -> int:
     """Console script for op_env."""
     args = parse_argv(argv)
-    return process_args(args)
+    with recorded_op_calls(args):
+        return process_args(args)
 
 
 if __name__ == "__main__":
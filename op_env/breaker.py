@@ -0,0 +1,183 @@
+"""Failing fast while 1Password is unreachable.
+
+The breaker's state lives in a small file in the cache directory, so
+every op-env process on a machine shares it: once one of them has seen
+enough consecutive failures, the rest stop waiting on op too.
+"""
+from contextlib import contextmanager
+import os
+from subprocess import CalledProcessError
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .op import (ConflictingValuesOPLookupError, EnvVarName, FieldMapping, FieldValue,
+                 InvalidTagOPLookupError, NoEntriesOPLookupError, NoFieldValueOPLookupError,
+                 OpBackend, OPLookupError, Title, TooManyEntriesOPLookupError,
+                 UnreadableItemOPLookupError)
+from .store import default_cache_dir, locked_json_state
+
+DEFAULT_RESET_AFTER = 60.0
+
+# Lookups failing with these got an answer from 1Password; it was just
+# not the one wanted.
+ANSWERED_ERRORS = (
+    ConflictingValuesOPLookupError,
+    InvalidTagOPLookupError,
+    NoEntriesOPLookupError,
+    NoFieldValueOPLookupError,
+    TooManyEntriesOPLookupError,
+    UnreadableItemOPLookupError,
+)
+
+
+class CircuitOpenOPLookupError(OPLookupError):
+    def __init__(self, message: str, retry_in: float) -> None:
+        super().__init__(message)
+        # seconds until a lookup will be let through to try again
+        self.retry_in = retry_in
+
+
+def is_outage(e: BaseException) -> bool:
+    """Whether e suggests 1Password or op couldn't be reached, rather than bad entries.
+
+    op exits with the same status whether or not 1Password could be
+    reached, so of the op commands which fail, only listing items
+    counts: every lookup needs that to work, whichever items it's for.
+    Failing to fetch a given item may just mean its title is wrong.
+    """
+    if isinstance(e, CalledProcessError):
+        return isinstance(e.cmd, list) and 'list' in e.cmd[1:3]
+    return isinstance(e, Exception) and not isinstance(e, ANSWERED_ERRORS)
+
+
+class CircuitBreaker:
+    """Trips after threshold consecutive failed lookups, then fails fast.
+
+    Once reset_after seconds have passed since it tripped, one lookup
+    is let through as a probe (the breaker is half-open); if it works
+    the breaker closes again, and if not it stays open for another
+    reset_after seconds.
+    """
+
+    def __init__(self,
+                 threshold: int,
+                 reset_after: float = DEFAULT_RESET_AFTER,
+                 path: Optional[str] = None) -> None:
+        if threshold < 1:
+            raise ValueError('Circuit breaker threshold must be at least 1')
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.path = path or os.path.join(default_cache_dir(), 'circuit-breaker.json')
+
+    def state(self) -> str:
+        "'closed', 'open' or 'half-open'"
+        with locked_json_state(self.path) as state:
+            return self._describe(state)[0]
+
+    def _describe(self, state: Dict[str, Any]) -> Tuple[str, float]:
+        "The breaker's state, and seconds until it will let a probe through"
+        opened_at = state.get('opened_at')
+        if opened_at is None:
+            return 'closed', 0.0
+        now = time.time()
+        probing_since = state.get('probing_since')
+        if probing_since is not None and now - probing_since < self.reset_after:
+            # someone else's probe is still under way
+            return 'open', probing_since + self.reset_after - now
+        if now - opened_at < self.reset_after:
+            return 'open', opened_at + self.reset_after - now
+        return 'half-open', 0.0
+
+    def before_call(self) -> None:
+        "Raise CircuitOpenOPLookupError unless a lookup may go ahead"
+        with locked_json_state(self.path) as state:
+            current, retry_in = self._describe(state)
+            if current == 'open':
+                raise CircuitOpenOPLookupError('1Password lookups are failing fast after '
+                                               f"{state.get('failures', 0)} consecutive "
+                                               f'failures; trying again in {retry_in:.0f}s',
+                                               retry_in=retry_in)
+            if current == 'half-open':
+                state['probing_since'] = time.time()
+
+    def record_success(self) -> None:
+        with locked_json_state(self.path) as state:
+            state.clear()
+
+    def record_failure(self) -> None:
+        with locked_json_state(self.path) as state:
+            state['failures'] = state.get('failures', 0) + 1
+            state.pop('probing_since', None)
+            if state['failures'] >= self.threshold:
+                state['opened_at'] = time.time()
+
+    @contextmanager
+    def guard(self) -> Iterator[List[Exception]]:
+        """Run a lookup if the breaker allows, recording how it went.
+
+        Partial lookups, which return their failures instead of
+        raising them, add them to the list yielded so outages among
+        them are counted too.
+        """
+        self.before_call()
+        returned: List[Exception] = []
+        try:
+            yield returned
+        except BaseException as e:
+            if is_outage(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        if any(is_outage(error) for error in returned):
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+class CircuitBreakerBackend:
+    "Sends lookups to another backend through a circuit breaker"
+
+    def __init__(self, backend: OpBackend, breaker: CircuitBreaker) -> None:
+        self.backend = backend
+        self.breaker = breaker
+
+    def env_lookups(self,
+                    env_var_names: List[EnvVarName],
+                    field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        with self.breaker.guard():
+            return self.backend.env_lookups(env_var_names, field_mapping)
+
+    def env_lookups_partial(self,
+                            env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        with self.breaker.guard() as returned:
+            values, errors = self.backend.env_lookups_partial(env_var_names, field_mapping)
+            returned.extend(errors.values())
+            return values, errors
+
+    def title_lookups(self,
+                      title: Title,
+                      field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        with self.breaker.guard():
+            return self.backend.title_lookups(title, field_mapping)
+
+    def title_lookups_partial(self,
+                              title: Title,
+                              field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+        with self.breaker.guard() as returned:
+            values, error = self.backend.title_lookups_partial(title, field_mapping)
+            if error is not None:
+                returned.append(error)
+            return values, error
+
+    def tag_prefix_lookups_partial(self,
+                                   tag_prefixes: List[str],
+                                   field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        with self.breaker.guard() as returned:
+            values, errors = self.backend.tag_prefix_lookups_partial(tag_prefixes, field_mapping)
+            returned.extend(errors.values())
+            return values, errors
@@ -0,0 +1,111 @@
+"""Merging env lookups made by many threads at once into batched op calls."""
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .op import (_current_account, _uniqify, EnvVarName, FieldMapping, FieldValue, OpBackend,
+                 select_backend)
+
+
+class _Batch:
+    def __init__(self) -> None:
+        self.env_var_names: List[EnvVarName] = []
+        self.requests = 0
+        # set when the batch has as many names as it may take
+        self.full = threading.Event()
+        # set once the batch's lookup has finished
+        self.done = threading.Event()
+        self.values: Dict[EnvVarName, FieldValue] = {}
+        self.errors: Dict[EnvVarName, Exception] = {}
+        # raised by the lookup as a whole, e.g. if op couldn't list items
+        self.failure: Optional[BaseException] = None
+
+    def add(self, env_var_names: Sequence[EnvVarName]) -> None:
+        self.env_var_names = _uniqify(self.env_var_names + list(env_var_names))
+        self.requests += 1
+
+
+class Coalescer:
+    """Gathers env lookups arriving close together into one backend call.
+
+    The first request opens a batch and waits up to window seconds for
+    others to join it, or until max_batch_size distinct names are
+    pending.  The union of names is then looked up once, through the
+    backend's partial lookup, and each caller gets the values for its
+    own names or the error for the first of them which failed.  Every
+    caller waits at most about one window longer than it would have
+    alone.
+
+    Lookups run in the context (account, deadline) of the request
+    which opened the batch; requests in different accounts are never
+    batched together.
+    """
+
+    def __init__(self,
+                 window: float = 0.005,
+                 max_batch_size: int = 100,
+                 field_mapping: Optional[FieldMapping] = None,
+                 backend: Optional[OpBackend] = None) -> None:
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.field_mapping: FieldMapping = field_mapping or {}
+        self._backend = backend or select_backend()
+        self._lock = threading.Lock()
+        # batches still open to new requests, by account
+        self._open: Dict[Optional[str], _Batch] = {}
+        # number of backend calls made, and requests served by them
+        self.batches = 0
+        self.requests = 0
+
+    def _join(self, env_var_names: List[EnvVarName]) -> Tuple[_Batch, bool]:
+        "The batch to wait on, and whether this request should run it"
+        current_account = _current_account.get()
+        with self._lock:
+            batch = self._open.get(current_account)
+            leader = batch is None
+            if batch is None:
+                batch = self._open[current_account] = _Batch()
+            batch.add(env_var_names)
+            if len(batch.env_var_names) >= self.max_batch_size:
+                del self._open[current_account]
+                batch.full.set()
+            return batch, leader
+
+    def _run(self, batch: _Batch) -> None:
+        batch.full.wait(self.window)
+        with self._lock:
+            current_account = _current_account.get()
+            if self._open.get(current_account) is batch:
+                del self._open[current_account]
+            self.batches += 1
+            self.requests += batch.requests
+        try:
+            batch.values, batch.errors = \
+                self._backend.env_lookups_partial(batch.env_var_names, self.field_mapping)
+        except BaseException as e:
+            batch.failure = e
+        finally:
+            batch.done.set()
+
+    def lookup_partial(self, env_var_names: Sequence[EnvVarName]) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        "Values for env_var_names which could be found, and errors for the rest"
+        names = _uniqify(list(env_var_names))
+        if not names:
+            return {}, {}
+        batch, leader = self._join(names)
+        if leader:
+            self._run(batch)
+        else:
+            batch.done.wait()
+        if batch.failure is not None:
+            raise batch.failure
+        return ({name: batch.values[name] for name in names if name in batch.values},
+                {name: batch.errors[name] for name in names if name in batch.errors})
+
+    def lookup(self, env_var_names: Sequence[EnvVarName]) -> Dict[EnvVarName, FieldValue]:
+        "Values for every one of env_var_names, or the error for the first that failed"
+        values, errors = self.lookup_partial(env_var_names)
+        for env_var_name in env_var_names:
+            if env_var_name in errors:
+                raise errors[env_var_name]
+        return values
@@ -0,0 +1,259 @@
+"""Shell completion for op-env, answered from a local index of tags and titles.
+
+Completion runs on every keypress, so it never runs op and imports
+nothing heavier than the standard library: candidates come from an
+index file in the cache directory.  When the index is older than
+REFRESH_AFTER seconds, a detached process lists every item once to
+rebuild it, while completion carries on answering from the old one.
+Lookups also add the names and titles they use to an existing index.
+
+Install by adding one of these to your shell's startup file:
+
+    eval "$(op-env-complete --script bash)"
+    eval "$(op-env-complete --script zsh)"
+    op-env-complete --script fish | source
+"""
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .paths import _write_private_file, default_cache_dir
+
+# Seconds after which completing starts a background refresh of the
+# index, and after which a refresh which failed is tried again
+REFRESH_AFTER = 3600.0
+RETRY_AFTER = 60.0
+
+ENVIRONMENT_OPTIONS = [
+    '--help', '--title', '--environment', '--yaml-environment', '--file-environment',
+    '--tag-prefix', '--all-tags', '--field-mapping', '--timeout', '--op-timeout',
+    '--account-title', '--backend', '--circuit-breaker', '--circuit-reset', '--item-cache',
+    '--fallback-snapshot', '--record', '--replay',
+]
+
+# Long options of each subcommand; the tests keep this in step with
+# op_env._cli.parse_argv()
+SUBCOMMAND_OPTIONS: Dict[str, List[str]] = {
+    'run': ENVIRONMENT_OPTIONS + ['--file-variable', '--fd-variable', '--procfile'],
+    'json': ENVIRONMENT_OPTIONS + ['--partial', '--stream'],
+    'plan': ENVIRONMENT_OPTIONS + ['--partial'],
+    'sh': ENVIRONMENT_OPTIONS + ['--stale-while-revalidate', '--max-stale',
+                                 '--changed-marker'],
+    'k8s': ENVIRONMENT_OPTIONS + ['--secret', '--secrets-file', '--output-dir'],
+    'check': ENVIRONMENT_OPTIONS + ['--name'],
+    'matrix': [option for option in ENVIRONMENT_OPTIONS
+               if option not in ('--title', '--tag-prefix', '--all-tags', '--account-title',
+                                 '--fallback-snapshot')] + ['--env', '--diff-only'],
+}
+
+TAG_OPTIONS = ('-e', '--environment', '--file-variable', '--fd-variable')
+TITLE_OPTIONS = ('-t', '--title')
+PREFIX_OPTIONS = ('--tag-prefix',)
+CHOICES = {'--backend': ['v1', 'v2', 'connect', 'auto']}
+
+SCRIPTS = {
+    'bash': r'''_op_env_complete() {
+    local IFS=$'\n' candidate
+    local -a candidates
+    candidates=($(op-env-complete -- "${COMP_WORDS[@]:1:COMP_CWORD}"))
+    COMPREPLY=()
+    if [ ${#candidates[@]} -eq 0 ]; then
+        compopt -o default
+        return 0
+    fi
+    for candidate in "${candidates[@]}"; do
+        COMPREPLY+=("$(printf '%q' "$candidate")")
+    done
+}
+complete -F _op_env_complete op-env
+''',
+    'zsh': r'''_op_env_complete() {
+    local -a candidates
+    candidates=("${(@f)$(op-env-complete -- "${(@)words[2,CURRENT]}")}")
+    if [[ -z ${candidates[1]} ]]; then
+        _files
+    else
+        compadd -a candidates
+    fi
+}
+compdef _op_env_complete op-env
+''',
+    'fish': r'''function __op_env_complete
+    set -l tokens (commandline -opc) (commandline -ct)
+    set -l candidates (op-env-complete -- $tokens[2..-1])
+    if test (count $candidates) -eq 0
+        __fish_complete_path (commandline -ct)
+    else
+        printf '%s\n' $candidates
+    end
+end
+complete -c op-env -f -a '(__op_env_complete)'
+''',
+}
+
+
+def index_path() -> str:
+    return os.path.join(default_cache_dir(), 'completion-index.json')
+
+
+def load_index(path: Optional[str] = None) -> Tuple[Dict[str, Any], Optional[float]]:
+    "The index, and how many seconds ago it was last rebuilt (None if never)"
+    try:
+        with open(path or index_path(), 'rb') as f:
+            index = json.loads(f.read())
+    except (OSError, ValueError):
+        return {'tags': [], 'titles': []}, None
+    refreshed_at = index.get('refreshed_at')
+    return index, None if refreshed_at is None else time.time() - refreshed_at
+
+
+def save_index(tags: Iterable[str],
+               titles: Iterable[str],
+               refreshed_at: Optional[float],
+               path: Optional[str] = None) -> None:
+    index = {'refreshed_at': refreshed_at, 'tags': sorted(set(tags)), 'titles': sorted(set(titles))}
+    _write_private_file(path or index_path(),
+                        json.dumps(index, separators=(',', ':')).encode('utf-8'))
+
+
+def note_lookup(env_var_names: Iterable[str],
+                titles: Iterable[str],
+                path: Optional[str] = None) -> None:
+    """Add names and titles which were just looked up to the index.
+
+    Nothing is written unless the index already exists, i.e. unless
+    completion is in use.
+    """
+    path = path or index_path()
+    if not os.path.exists(path):
+        return
+    index, _ = load_index(path)
+    tags = set(index['tags'])
+    known_titles = set(index['titles'])
+    if tags.issuperset(env_var_names) and known_titles.issuperset(titles):
+        return
+    save_index(tags.union(env_var_names), known_titles.union(titles),
+               index.get('refreshed_at'), path)
+
+
+def _list_tags_and_titles(backend_name: str) -> Tuple[List[str], List[str]]:
+    "Every tag and title in 1Password, from a single listing of items"
+    from .op import _detect_backend_name, _op_check_output
+
+    if backend_name == 'auto':
+        backend_name = _detect_backend_name()
+    if backend_name == 'connect':
+        from .connect import ConnectBackend
+
+        summaries = ConnectBackend()._summaries()
+        return ([tag for summary in summaries for tag in summary.tags],
+                [summary.title for summary in summaries if summary.title])
+    if backend_name == 'v2':
+        items = json.loads(_op_check_output(['op', 'item', 'list', '--format', 'json'],
+                                            phase='list'))
+        return ([tag for item in items for tag in item.get('tags', [])],
+                [item['title'] for item in items if item.get('title')])
+    entries = json.loads(_op_check_output(['op', 'list', 'items'], phase='list'))
+    overviews = [entry.get('overview', {}) for entry in entries]
+    return ([tag for overview in overviews for tag in overview.get('tags', [])],
+            [overview['title'] for overview in overviews if overview.get('title')])
+
+
+def refresh_index(backend_name: Optional[str] = None, path: Optional[str] = None) -> None:
+    "Rebuild the index from 1Password, unless another process is already doing so"
+    path = path or index_path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    with open(f'{path}.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        tags, titles = _list_tags_and_titles(backend_name or
+                                             os.environ.get('OP_ENV_BACKEND') or 'v1')
+        save_index(tags, titles, time.time(), path)
+
+
+def _refresh_attempted_recently(path: str) -> bool:
+    # refresh_index() rewrites the lock file as it starts
+    try:
+        return time.time() - os.path.getmtime(f'{path}.lock') < RETRY_AFTER
+    except OSError:
+        return False
+
+
+def spawn_index_refresh() -> None:
+    subprocess.Popen([sys.executable, '-m', 'op_env.completion', '--refresh'],
+                     stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def _prefixes(tags: Iterable[str]) -> List[str]:
+    "Prefixes of tags ending in '_', for --tag-prefix"
+    prefixes = set()
+    for tag in tags:
+        end = tag.find('_')
+        while end != -1:
+            prefixes.add(tag[:end + 1])
+            end = tag.find('_', end + 1)
+    return sorted(prefixes)
+
+
+def candidates(words: List[str], index: Dict[str, Any]) -> List[str]:
+    """Completions for the last of words, the arguments typed after 'op-env'.
+
+    An empty list leaves the shell to complete file names.
+    """
+    current = words[-1] if words else ''
+    previous = words[-2] if len(words) > 1 else None
+    subcommand = next((word for word in words[:-1] if word in SUBCOMMAND_OPTIONS), None)
+    options: List[str]
+    if subcommand is None:
+        options = sorted(SUBCOMMAND_OPTIONS) + ['--help']
+    elif previous in TAG_OPTIONS:
+        options = index['tags']
+    elif previous in TITLE_OPTIONS:
+        options = index['titles']
+    elif previous in PREFIX_OPTIONS:
+        options = _prefixes(index['tags'])
+    elif previous in CHOICES:
+        options = CHOICES[previous]
+    elif current.startswith('-'):
+        options = SUBCOMMAND_OPTIONS[subcommand]
+    else:
+        return []
+    return [option for option in options if option.startswith(current)]
+
+
+def main(argv: List[str] = sys.argv) -> int:
+    """Console script for completion.
+
+    op-env-complete -- WORD...  prints candidates for the last word
+    op-env-complete --script SHELL  prints the completion script for SHELL
+    op-env-complete --refresh  rebuilds the index in the foreground
+    """
+    if argv[1:2] == ['--']:
+        index, age = load_index()
+        if (age is None or age > REFRESH_AFTER) and not _refresh_attempted_recently(index_path()):
+            spawn_index_refresh()
+        for candidate in candidates(argv[2:], index):
+            print(candidate)
+        return 0
+    if argv[1:2] == ['--script'] and len(argv) == 3 and argv[2] in SCRIPTS:
+        sys.stdout.write(SCRIPTS[argv[2]])
+        return 0
+    if argv[1:] == ['--refresh']:
+        refresh_index()
+        return 0
+    print(f'usage: op-env-complete -- WORD... | --script {{{",".join(SCRIPTS)}}} | --refresh',
+          file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
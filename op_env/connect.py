@@ -0,0 +1,323 @@
+"""Lookups through the REST API of a 1Password Connect server.
+
+No 'op' subprocess is spawned: requests go over a small pool of
+keep-alive HTTP connections, item fetches run concurrently, and
+responses are revalidated with their ETags so that unchanged vaults
+and items cost a 304 rather than a full download.
+
+Connections and ETags belong to a ConnectBackend instance, and are
+kept only in memory.  do_lookups(), and so each op-env command, makes
+a new backend, so only requests repeated within that one lookup are
+revalidated; library users keep both across lookups by reusing a
+backend, e.g. through a long-lived Resolver.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import urllib.parse
+
+from . import metrics
+from .op import (_current_deadline, _index_list_items, _op_pluck_fields_partial, _submit,
+                 _tags_with_prefixes, _title_values_partial, _validate_env_var_names,
+                 CollectingOpBackend, EnvVarName, FieldMapping, FieldReference, FieldValue,
+                 InvalidTagOPLookupError, NoEntriesOPLookupError, OPLookupError, T,
+                 TimeoutOPLookupError, Title, TooManyEntriesOPLookupError)
+from .op_v2 import _item_tags, OpV2Item, OpV2Vault
+
+
+class ConnectOPLookupError(OPLookupError):
+    def __init__(self, message: str, status: Optional[int] = None) -> None:
+        super().__init__(message)
+        # HTTP status returned by the server, if it got that far
+        self.status = status
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections to one server, reused between requests.
+
+    Up to max_idle connections are kept open between requests; more
+    are opened as needed when requests run concurrently.
+    """
+
+    def __init__(self, base_url: str, max_idle: int = 4) -> None:
+        parsed = urllib.parse.urlsplit(base_url)
+        if parsed.scheme not in ('http', 'https'):
+            raise ValueError(f'1Password Connect host must be an http(s) URL; found {base_url}')
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.base_path = parsed.path.rstrip('/')
+        self.max_idle = max_idle
+        self.connections_opened = 0
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def _checkout(self) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+            self.connections_opened += 1
+        connection_class = (http.client.HTTPSConnection if self.scheme == 'https'
+                            else http.client.HTTPConnection)
+        return connection_class(self.netloc), False
+
+    def _checkin(self, connection: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def request(self,
+                path: str,
+                headers: Dict[str, str],
+                timeout: Optional[float]) -> Tuple[int, Optional[str], bytes]:
+        "GET path, returning the status, ETag and body"
+        for attempt in (0, 1):
+            connection, reused = self._checkout()
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request('GET', self.base_path + path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except ConnectionError:
+                connection.close()
+                if reused and attempt == 0:
+                    # the server dropped the idle connection; try a fresh one
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(connection)
+            return response.status, response.getheader('ETag'), body
+        raise AssertionError('unreachable')
+
+
+class ConnectClient:
+    "JSON GETs against the Connect API, revalidating anything fetched before"
+
+    def __init__(self, host: str, token: str, max_connections: int = 4) -> None:
+        self.host = host
+        self.pool = ConnectionPool(host, max_idle=max_connections)
+        self._token = token
+        self._etags: Dict[str, Tuple[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get_json(self, path: str, phase: str) -> Any:
+        headers = {
+            'Authorization': f'Bearer {self._token}',
+            'Accept': 'application/json',
+        }
+        with self._lock:
+            cached = self._etags.get(path)
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        current_deadline = _current_deadline.get()
+        timeout = None if current_deadline is None else current_deadline.call_timeout(phase)
+        start = time.perf_counter()
+        try:
+            status, etag, body = self.pool.request(path, headers, timeout)
+        except socket.timeout:
+            if current_deadline is None:
+                raise ConnectOPLookupError(f'1Password Connect at {self.host} timed out')
+            current_deadline.record(phase, time.perf_counter() - start)
+            raise current_deadline.timeout_error(phase) from None
+        except OSError as e:
+            raise ConnectOPLookupError(f'Could not reach 1Password Connect at {self.host}: '
+                                       f'{e}') from e
+        if current_deadline is not None:
+            current_deadline.record(phase, time.perf_counter() - start)
+        if cached is not None:
+            metrics.emit_cache('connect', status == 304)
+            if status == 304:
+                return cached[1]
+        if status == 404:
+            raise NoEntriesOPLookupError(f'1Password Connect found nothing at {path}')
+        if status != 200:
+            raise ConnectOPLookupError(f'1Password Connect returned HTTP {status} for {path}',
+                                       status=status)
+        with metrics.parsing(phase, len(body)):
+            data = json.loads(body)
+        if etag is not None:
+            with self._lock:
+                self._etags[path] = (etag, data)
+        return data
+
+
+def _quote(identifier: str) -> str:
+    return urllib.parse.quote(identifier, safe='')
+
+
+class ConnectBackend(CollectingOpBackend):
+    """Looks up tags and titles across every vault the Connect token can read.
+
+    The host and token default to $OP_CONNECT_HOST and
+    $OP_CONNECT_TOKEN, as used by 1Password's own Connect SDKs.  Open
+    connections and ETags last as long as the instance does, so pass
+    the same one to every lookup which should share them.
+    """
+
+    def __init__(self,
+                 host: Optional[str] = None,
+                 token: Optional[str] = None,
+                 max_connections: int = 4) -> None:
+        host = host or os.environ.get('OP_CONNECT_HOST')
+        token = token or os.environ.get('OP_CONNECT_TOKEN')
+        if not host or not token:
+            raise ValueError('The connect backend needs OP_CONNECT_HOST and OP_CONNECT_TOKEN '
+                             'to be set')
+        self.max_connections = max_connections
+        self.client = ConnectClient(host, token, max_connections)
+
+    def _map(self, fn: Callable[[Any], T], args: List[Any]) -> List[Union[T, Exception]]:
+        "Call fn on each of args concurrently, returning results or the exceptions raised"
+        def call(arg: Any) -> Union[T, Exception]:
+            try:
+                return fn(arg)
+            except TimeoutOPLookupError:
+                raise
+            except OPLookupError as e:
+                return e
+        if len(args) <= 1:
+            return [call(arg) for arg in args]
+        with ThreadPoolExecutor(max_workers=self.max_connections,
+                                thread_name_prefix='op-env-connect') as executor:
+            futures = [_submit(executor, call, arg) for arg in args]
+            return [future.result() for future in futures]
+
+    def _vault_items(self, vault: OpV2Vault) -> List[OpV2Item]:
+        items = [OpV2Item(**item)
+                 for item in self.client.get_json(f'/v1/vaults/{_quote(vault.id)}/items',
+                                                  phase='list')]
+        for item in items:
+            # summaries only carry the vault id
+            item.vault = vault
+        return items
+
+    def _summaries(self) -> List[OpV2Item]:
+        "Summaries (without fields) of every item in every vault"
+        vaults = [OpV2Vault(**vault)
+                  for vault in self.client.get_json('/v1/vaults', phase='vaults')]
+        summaries: List[OpV2Item] = []
+        for items in self._map(self._vault_items, vaults):
+            if isinstance(items, Exception):
+                raise items
+            summaries += items
+        return summaries
+
+    def _get_item(self, summary: OpV2Item) -> OpV2Item:
+        assert summary.vault is not None
+        return OpV2Item(**self.client.get_json(f'/v1/vaults/{_quote(summary.vault.id)}'
+                                               f'/items/{_quote(summary.id)}',
+                                               phase='get'))
+
+    def _get_items(self, summaries: List[OpV2Item]) -> Dict[str, Union[OpV2Item, Exception]]:
+        unique = list({summary.id: summary for summary in summaries}.values())
+        return {
+            summary.id: item
+            for summary, item in zip(unique, self._map(self._get_item, unique))
+        }
+
+    @staticmethod
+    def _find(summaries: List[OpV2Item], item: str, vault: Optional[str]) -> OpV2Item:
+        matches = [
+            summary for summary in summaries
+            if item in (summary.id, summary.title) and
+            (vault is None or
+             (summary.vault is not None and vault in (summary.vault.id, summary.vault.name)))
+        ]
+        if not matches:
+            raise NoEntriesOPLookupError(f'No 1Password entries named {item} found')
+        if len(matches) > 1:
+            raise TooManyEntriesOPLookupError(f'Too many 1Password entries named {item} found')
+        return matches[0]
+
+    def env_lookups_partial(self,
+                            env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        return self._env_lookups_partial(env_var_names, field_mapping, None)
+
+    def tag_prefix_lookups_partial(self,
+                                   tag_prefixes: List[str],
+                                   field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        summaries = self._summaries()
+        return self._env_lookups_partial(_tags_with_prefixes(summaries, tag_prefixes, _item_tags),
+                                         field_mapping, summaries)
+
+    def _env_lookups_partial(self,
+                             env_var_names: List[EnvVarName],
+                             field_mapping: FieldMapping,
+                             summaries: Optional[List[OpV2Item]]) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        "Look up env_var_names, among summaries if given rather than listing them again"
+        values: Dict[EnvVarName, FieldValue] = {}
+        errors: Dict[EnvVarName, Exception] = {}
+        valid_env_var_names: List[EnvVarName] = []
+        for env_var_name in env_var_names:
+            try:
+                _validate_env_var_names([env_var_name])
+                valid_env_var_names.append(env_var_name)
+            except InvalidTagOPLookupError as e:
+                errors[env_var_name] = e
+        if not valid_env_var_names:
+            return values, errors
+        if summaries is None:
+            summaries = self._summaries()
+        tagged = [
+            env_var_name for env_var_name in valid_env_var_names
+            if field_mapping.get(env_var_name, FieldReference(None)).item is None
+        ]
+        tagged_set = set(tagged)
+        by_env_var_name, list_errors = _index_list_items(summaries, tagged, _item_tags)
+        wanted: Dict[EnvVarName, OpV2Item] = {}
+        for env_var_name in valid_env_var_names:
+            if env_var_name in tagged_set:
+                if env_var_name in list_errors:
+                    errors[env_var_name] = list_errors[env_var_name]
+                else:
+                    wanted[env_var_name] = by_env_var_name[env_var_name]
+                continue
+            field_reference = field_mapping[env_var_name]
+            assert field_reference.item is not None
+            try:
+                wanted[env_var_name] = self._find(summaries,
+                                                  field_reference.item, field_reference.vault)
+            except OPLookupError as e:
+                errors[env_var_name] = e
+        items = self._get_items(list(wanted.values()))
+        for env_var_name, summary in wanted.items():
+            item = items[summary.id]
+            if isinstance(item, Exception):
+                errors[env_var_name] = item
+            else:
+                _op_pluck_fields_partial([env_var_name], {env_var_name: item.field_values()},
+                                         field_mapping, values, errors)
+        return values, errors
+
+    def title_lookups_partial(self,
+                              title: Title,
+                              field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+        try:
+            item = self._get_item(self._find(self._summaries(), title, None))
+        except OPLookupError as e:
+            return {}, e
+        return _title_values_partial(item.tags, item.field_values(), field_mapping)
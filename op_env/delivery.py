@@ -0,0 +1,94 @@
+"""Delivery of values to child processes other than through the environment.
+
+Large values (TLS bundles, kubeconfigs, service account JSON) are
+expensive to copy into every exec and can exceed E2BIG limits.  These
+helpers instead hand the child an env variable pointing at a file on a
+memory-backed filesystem, or at an inherited pipe to read from.
+"""
+from contextlib import contextmanager
+import os
+import shutil
+import tempfile
+import threading
+from typing import Collection, Dict, Iterator, List, Mapping, NamedTuple, Optional, Tuple
+
+from .op import EnvVarName, FieldValue
+
+
+class SecretFileDirError(Exception):
+    pass
+
+
+class DeliveredEnv(NamedTuple):
+    env: Dict[str, str]
+    pass_fds: Tuple[int, ...]
+
+
+def secret_file_dir() -> str:
+    """A memory-backed directory to put secret files in.
+
+    Raises SecretFileDirError rather than fall back to a directory
+    whose files could end up on disk.
+    """
+    for candidate in (os.environ.get('XDG_RUNTIME_DIR'), '/dev/shm'):
+        if candidate and os.path.isdir(candidate) and os.access(candidate, os.W_OK):
+            return candidate
+    raise SecretFileDirError('Neither $XDG_RUNTIME_DIR nor /dev/shm is a writable directory, '
+                             'so values cannot be delivered via files without writing them '
+                             'to disk; try --fd-variable instead')
+
+
+def _write_to_pipe(write_fd: int, value: bytes) -> None:
+    try:
+        with os.fdopen(write_fd, 'wb') as pipe:
+            pipe.write(value)
+    except BrokenPipeError:
+        # child exited without reading it all
+        pass
+
+
+@contextmanager
+def delivered_env(new_env: Mapping[EnvVarName, FieldValue],
+                  file_env_var_names: Collection[EnvVarName] = (),
+                  fd_env_var_names: Collection[EnvVarName] = ()) -> Iterator[DeliveredEnv]:
+    """Yield the env and fds to pass to the child.
+
+    Names in file_env_var_names are set to the path of a 0600 file
+    holding their value; names in fd_env_var_names are set to the
+    number of an inherited fd which yields their value.  Files are
+    removed and pipes closed on exit.
+    """
+    env: Dict[str, str] = {
+        env_var_name: value for env_var_name, value in new_env.items()
+    }
+    pass_fds: List[int] = []
+    writers: List[threading.Thread] = []
+    temp_dir: Optional[str] = None
+    try:
+        if file_env_var_names:
+            temp_dir = tempfile.mkdtemp(prefix='op-env-', dir=secret_file_dir())
+        for env_var_name in file_env_var_names:
+            assert temp_dir is not None
+            path = os.path.join(temp_dir, env_var_name.replace(os.sep, '_'))
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(new_env[env_var_name].encode('utf-8'))
+            env[env_var_name] = path
+        for env_var_name in fd_env_var_names:
+            read_fd, write_fd = os.pipe()
+            pass_fds.append(read_fd)
+            # A thread, so values bigger than the pipe buffer don't block us
+            writer = threading.Thread(target=_write_to_pipe,
+                                      args=(write_fd, new_env[env_var_name].encode('utf-8')),
+                                      daemon=True)
+            writer.start()
+            writers.append(writer)
+            env[env_var_name] = str(read_fd)
+        yield DeliveredEnv(env=env, pass_fds=tuple(pass_fds))
+    finally:
+        for read_fd in pass_fds:
+            os.close(read_fd)
+        for writer in writers:
+            writer.join()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
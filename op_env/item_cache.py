@@ -0,0 +1,187 @@
+"""Field values of 1Password items, reused for as long as the items are unchanged.
+
+Tagged lookups list items before fetching their fields, and the
+listing already says which version of each item is current.  While
+an ItemVersionCache is in use, fields are only fetched for items which
+are new or have changed since they were cached, so rotated secrets are
+never served stale and unchanged ones are never fetched twice.  Hits
+and misses are reported to metrics observers as the 'items' cache.
+"""
+from contextlib import contextmanager
+import json
+import threading
+import time
+from typing import Any, Collection, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from . import metrics
+from .op import _current_account, _current_item_cache, FieldName
+from .store import SnapshotStore
+
+# Keys of listed items which change whenever the item does: 1Password
+# CLI 1.x lists itemVersion and updatedAt, 2.x version and updated_at.
+VERSION_KEYS = ('itemVersion', 'updatedAt', 'version', 'updated_at')
+
+# Seconds after which entries which haven't been used are dropped, and
+# how often an entry's last use is saved
+EXPIRE_AFTER = 30 * 86400.0
+USE_RECORDED_EVERY = 86400.0
+
+# Name of the snapshot holding a saved cache
+SNAPSHOT_NAME = 'item-cache'
+
+
+def item_version(listed: Mapping[str, Any]) -> Optional[str]:
+    "What changes whenever a listed item does, or None if the listing doesn't say"
+    parts = [f'{key}={listed[key]}' for key in VERSION_KEYS if listed.get(key) is not None]
+    return ';'.join(parts) or None
+
+
+def _item_key(listed: Mapping[str, Any]) -> Optional[str]:
+    item_id = listed.get('uuid') or listed.get('id')
+    if item_id is None:
+        return None
+    return f'{_current_account.get() or ""}/{item_id}'
+
+
+class _Entry:
+    def __init__(self,
+                 version: str,
+                 fields: Optional[List[FieldName]],
+                 values: Dict[str, Any],
+                 used_at: float) -> None:
+        self.version = version
+        # fields asked for when the values were fetched, or None for
+        # the whole item
+        self.fields = fields
+        self.values = values
+        self.used_at = used_at
+
+
+class ItemVersionCache:
+    """Fetched fields of items, keyed by account and item, checked against its version.
+
+    Entries are kept in memory, and saved encrypted under the given
+    SnapshotStore, if any, after each lookup using the cache.
+    Instances are safe to share between threads.
+    """
+
+    def __init__(self, store: Optional[SnapshotStore] = None) -> None:
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+        self._loaded = store is None
+        self._changed = False
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        "The share of items found unchanged in the cache, or None before any lookups"
+        total = self.hits + self.misses
+        return None if total == 0 else self.hits / total
+
+    def _load(self) -> None:
+        # called with self._lock held
+        if self._loaded:
+            return
+        self._loaded = True
+        assert self.store is not None
+        snapshot = self.store.load(SNAPSHOT_NAME)
+        if snapshot is None:
+            return
+        for key, encoded in snapshot.values.items():
+            version, fields, values, used_at = json.loads(encoded)
+            self._entries.setdefault(key, _Entry(version, fields, values, used_at))
+
+    def save(self) -> None:
+        "Save to the store, if there is one and anything changed, dropping long-unused entries"
+        if self.store is None:
+            return
+        with self._lock:
+            if not self._changed:
+                return
+            self._changed = False
+            expired_before = time.time() - EXPIRE_AFTER
+            self._entries = {key: entry for key, entry in self._entries.items()
+                             if entry.used_at >= expired_before}
+            encoded = {
+                key: json.dumps([entry.version, entry.fields, entry.values, entry.used_at])
+                for key, entry in self._entries.items()
+            }
+        self.store.save(SNAPSHOT_NAME, encoded)  # type: ignore
+
+    def get(self,
+            listed: Mapping[str, Any],
+            fields: Optional[Collection[FieldName]] = None) -> Optional[Dict[Any, Any]]:
+        """Cached values of fields (or the whole item, if None) for an item as listed.
+
+        Returns None unless the item is unchanged since they were
+        cached.
+        """
+        key = _item_key(listed)
+        version = item_version(listed)
+        with self._lock:
+            self._load()
+            entry = None if key is None else self._entries.get(key)
+            hit = (entry is not None and version is not None and entry.version == version and
+                   (entry.fields is None if fields is None else
+                    entry.fields is not None and set(fields).issubset(entry.fields)))
+            if hit:
+                assert entry is not None
+                self.hits += 1
+                if time.time() - entry.used_at > USE_RECORDED_EVERY:
+                    entry.used_at = time.time()
+                    self._changed = True
+            else:
+                self.misses += 1
+        metrics.emit_cache('items', hit)
+        if not hit:
+            return None
+        assert entry is not None
+        if fields is None:
+            return entry.values
+        return {field: value for field, value in entry.values.items() if field in fields}
+
+    def put(self,
+            listed: Mapping[str, Any],
+            fields: Optional[Collection[FieldName]],
+            values: Mapping[Any, Any]) -> None:
+        "Cache values fetched for fields (or the whole item, if None) of an item as listed"
+        key = _item_key(listed)
+        version = item_version(listed)
+        if key is None or version is None:
+            return
+        with self._lock:
+            self._load()
+            self._entries[key] = _Entry(version, None if fields is None else sorted(fields),
+                                        dict(values), time.time())
+            self._changed = True
+
+    def split(self,
+              listed: Sequence[Mapping[str, Any]],
+              fields: Optional[Collection[FieldName]] = None) -> \
+            Tuple[Dict[int, Dict[Any, Any]], List[int]]:
+        "Cached values for listed items by position, and the positions of those to fetch"
+        cached: Dict[int, Dict[Any, Any]] = {}
+        to_fetch: List[int] = []
+        for position, entry in enumerate(listed):
+            values = self.get(entry, fields)
+            if values is None:
+                to_fetch.append(position)
+            else:
+                cached[position] = values
+        return cached, to_fetch
+
+
+@contextmanager
+def caching_items(cache: Optional[ItemVersionCache]) -> Iterator[None]:
+    "Use cache for the item fields fetched in this context, saving it afterwards"
+    if cache is None:
+        yield
+        return
+    token = _current_item_cache.set(cache)
+    try:
+        yield
+    finally:
+        _current_item_cache.reset(token)
+        cache.save()
@@ -0,0 +1,141 @@
+"""Rendering of looked-up values as Kubernetes Secret manifests."""
+import base64
+import os
+from typing import Dict, IO, Iterable, Iterator, List, Mapping, NamedTuple, Optional
+
+import yaml
+
+from .op import EnvVarName, FieldValue
+from .paths import _write_private_file
+
+
+class SecretSpec(NamedTuple):
+    namespace: str
+    name: str
+    # None means every looked-up env var name
+    environment: Optional[List[EnvVarName]] = None
+
+
+def parse_secret_spec(value: str) -> SecretSpec:
+    "Parse NAMESPACE/NAME as given on the command line"
+    namespace, sep, name = value.partition('/')
+    if sep == '' or namespace == '' or name == '':
+        raise ValueError(f'Secret must be given as NAMESPACE/NAME; found {value}')
+    return SecretSpec(namespace=namespace, name=name)
+
+
+def load_secret_specs(filename: str) -> List[SecretSpec]:
+    """Load secrets from a YAML list of entries like this:
+
+    - name: web
+      namespaces: [staging, prod]
+      environment: [WEB_DB_PASSWORD]
+    """
+    with open(filename, 'r') as stream:
+        entries = yaml.safe_load(stream) or []
+    if not isinstance(entries, list):
+        raise ValueError(f'Secrets file must be a list; found {entries}')
+    specs = []
+    for entry in entries:
+        if not isinstance(entry, dict) or 'name' not in entry:
+            raise ValueError(f'Each secret must be a mapping with a name; found {entry}')
+        namespaces = entry.get('namespaces', [entry.get('namespace', 'default')])
+        if not isinstance(namespaces, list):
+            raise ValueError(f'namespaces must be a list; found {namespaces}')
+        if not isinstance(entry.get('environment', []), list):
+            raise ValueError(f"environment must be a list; found {entry['environment']}")
+        for namespace in namespaces:
+            specs.append(SecretSpec(namespace=namespace,
+                                    name=entry['name'],
+                                    environment=entry.get('environment')))
+    return specs
+
+
+def required_env_var_names(specs: Iterable[SecretSpec]) -> List[EnvVarName]:
+    "Union of the env var names explicitly requested by specs"
+    names: Dict[EnvVarName, None] = {}
+    for spec in specs:
+        for env_var_name in spec.environment or []:
+            names[env_var_name] = None
+    return list(names)
+
+
+def secret_data(spec: SecretSpec,
+                values: Mapping[EnvVarName, FieldValue]) -> Dict[EnvVarName, FieldValue]:
+    if spec.environment is None:
+        return dict(values)
+    missing = [env_var_name for env_var_name in spec.environment if env_var_name not in values]
+    if missing:
+        raise LookupError(f'No value found for {", ".join(missing)} '
+                          f'in secret {spec.namespace}/{spec.name}')
+    return {env_var_name: values[env_var_name] for env_var_name in spec.environment}
+
+
+def render_manifest(spec: SecretSpec, data: Mapping[EnvVarName, FieldValue]) -> str:
+    manifest = {
+        'apiVersion': 'v1',
+        'kind': 'Secret',
+        'metadata': {
+            'name': spec.name,
+            'namespace': spec.namespace,
+        },
+        'type': 'Opaque',
+        'data': {
+            key: base64.b64encode(value.encode('utf-8')).decode('ascii')
+            for key, value in data.items()
+        },
+    }
+    return yaml.safe_dump(manifest, sort_keys=False)
+
+
+def manifest_filename(spec: SecretSpec) -> str:
+    return f'{spec.namespace}.{spec.name}.yaml'
+
+
+def _previous_data(path: str) -> Optional[Dict[str, str]]:
+    "The data in a manifest written earlier, or None if there isn't one that can be read"
+    try:
+        with open(path, 'r') as stream:
+            manifest = yaml.safe_load(stream)
+    except (FileNotFoundError, yaml.YAMLError):
+        return None
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('data'), dict):
+        return None
+    try:
+        return {
+            key: base64.b64decode(value, validate=True).decode('utf-8')
+            for key, value in manifest['data'].items()
+        }
+    except (TypeError, ValueError):
+        # hand-edited or corrupt; written again as if changed
+        return None
+
+
+def stream_manifests(specs: Iterable[SecretSpec],
+                     values: Mapping[EnvVarName, FieldValue],
+                     out: IO[str]) -> None:
+    "Write one YAML document per secret, flushing as each is rendered"
+    for spec in specs:
+        out.write('---\n')
+        out.write(render_manifest(spec, secret_data(spec, values)))
+        out.flush()
+
+
+def write_manifests(specs: Iterable[SecretSpec],
+                    values: Mapping[EnvVarName, FieldValue],
+                    output_dir: str) -> Iterator[str]:
+    """Write one file per secret into output_dir.
+
+    Secrets whose values match the file already there are neither
+    re-rendered nor rewritten.  Yields the paths written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for spec in specs:
+        data = secret_data(spec, values)
+        path = os.path.join(output_dir, manifest_filename(spec))
+        if _previous_data(path) == data:
+            continue
+        # replaced rather than rewritten in place, so that a file left
+        # readable by others doesn't stay that way
+        _write_private_file(path, render_manifest(spec, data).encode('utf-8'))
+        yield path
@@ -0,0 +1,63 @@
+"""Lazily-resolved mapping of env var names to 1Password values."""
+import threading
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional
+
+from .op import _uniqify, EnvVarName, FieldValue, OpBackend, select_backend
+
+
+class LazyOpEnviron(Mapping[EnvVarName, FieldValue]):
+    """Mapping of declared env var names which resolves nothing until accessed.
+
+    The first access to a value which hasn't been fetched yet looks up
+    that name along with every other pending name in one batch, so
+    declaring many names costs nothing up front and at most one 'op'
+    round trip later.  A name which couldn't be looked up raises its
+    own error when accessed, without affecting the others.
+    """
+
+    def __init__(self,
+                 env_var_names: Iterable[EnvVarName],
+                 backend: Optional[OpBackend] = None) -> None:
+        self._backend = backend or select_backend()
+        self._declared: List[EnvVarName] = _uniqify(list(env_var_names))
+        self._values: Dict[EnvVarName, FieldValue] = {}
+        self._errors: Dict[EnvVarName, Exception] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> List[EnvVarName]:
+        "Declared names which haven't been fetched yet"
+        with self._lock:
+            return self._pending()
+
+    def _pending(self) -> List[EnvVarName]:
+        # called with self._lock held
+        return [name for name in self._declared
+                if name not in self._values and name not in self._errors]
+
+    def _fetch_pending(self) -> None:
+        with self._lock:
+            pending = self._pending()
+            if pending:
+                values, errors = self._backend.env_lookups_partial(pending, {})
+                self._values.update(values)
+                self._errors.update(errors)
+
+    def __getitem__(self, env_var_name: EnvVarName) -> FieldValue:
+        if env_var_name not in self._declared:
+            raise KeyError(env_var_name)
+        if env_var_name not in self._values and env_var_name not in self._errors:
+            self._fetch_pending()
+        if env_var_name in self._errors:
+            raise self._errors[env_var_name]
+        return self._values[env_var_name]
+
+    def __contains__(self, env_var_name: object) -> bool:
+        # Answerable without resolving anything
+        return env_var_name in self._declared
+
+    def __iter__(self) -> Iterator[EnvVarName]:
+        return iter(self._declared)
+
+    def __len__(self) -> int:
+        return len(self._declared)
@@ -0,0 +1,207 @@
+"""Looking up the same env var names in several environments at once, and comparing them.
+
+Each environment is picked out by a selector: the item with a given
+title, tags with a given prefix (PROD_DB_PASSWORD for DB_PASSWORD), or
+a given op account.  Prefixed tags in the same account are looked up
+together, so they share one listing of items however many
+environments use them.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+import os
+from typing import Dict, List, NamedTuple, Optional, TYPE_CHECKING
+
+from .item_cache import caching_items, ItemVersionCache
+from .op import (_guarded_backend, _submit, _uniqify, account, deadline, EnvVarName,
+                 FieldMapping, FieldReference, NoEntriesOPLookupError, PartialLookupResult,
+                 Resolver, Title)
+
+if TYPE_CHECKING:
+    from .breaker import CircuitBreaker
+
+SELECTOR_KINDS = ('title', 'prefix', 'account')
+
+# Hex digits of each value's hash shown in a diff
+HASH_LENGTH = 12
+
+
+class EnvironmentSelector(NamedTuple):
+    "Where one environment's values come from"
+    label: str
+    # one of SELECTOR_KINDS
+    kind: str
+    value: str
+
+
+def parse_selector(value: str) -> EnvironmentSelector:
+    "Parse LABEL=title:TITLE, LABEL=prefix:PREFIX or LABEL=account:ACCOUNT"
+    label, sep, selector = value.partition('=')
+    kind, kind_sep, selected = selector.partition(':')
+    if sep == '' or label == '' or kind_sep == '' or kind not in SELECTOR_KINDS or \
+            (selected == '' and kind != 'prefix'):
+        raise ValueError('Environment must be given as LABEL=title:TITLE, LABEL=prefix:PREFIX '
+                         f'or LABEL=account:ACCOUNT; found {value}')
+    return EnvironmentSelector(label=label, kind=kind, value=selected)
+
+
+def _in_account(shorthand: Optional[str],
+                resolver: Resolver,
+                env_var_names: List[EnvVarName],
+                titles: List[Title]) -> PartialLookupResult:
+    with account(shorthand):
+        return resolver.resolve_partial(env_var_names, titles)
+
+
+def _prefixed_field_mapping(field_mapping: FieldMapping,
+                            env_var_names: List[EnvVarName],
+                            prefixes: List[str]) -> Dict[EnvVarName, FieldReference]:
+    "Mapped fields (but not items) apply to every prefixed tag for a name"
+    prefixed = dict(field_mapping)
+    for env_var_name in env_var_names:
+        reference = field_mapping.get(env_var_name)
+        if reference is None or reference.item is not None:
+            continue
+        for prefix in prefixes:
+            prefixed.setdefault(EnvVarName(prefix + env_var_name), reference)
+    return prefixed
+
+
+def _title_result(title: Title,
+                  env_var_names: List[EnvVarName],
+                  result: PartialLookupResult) -> PartialLookupResult:
+    title_error = result.title_errors.get(title)
+    errors: Dict[EnvVarName, Exception] = {}
+    for env_var_name in env_var_names:
+        if env_var_name not in result.values:
+            errors[env_var_name] = title_error or NoEntriesOPLookupError(
+                f'1Password item {title} has no field tagged {env_var_name}')
+    return PartialLookupResult(values={env_var_name: result.values[env_var_name]
+                                       for env_var_name in env_var_names
+                                       if env_var_name in result.values},
+                               env_var_errors=errors,
+                               title_errors={})
+
+
+def _prefix_result(prefix: str,
+                   env_var_names: List[EnvVarName],
+                   result: PartialLookupResult) -> PartialLookupResult:
+    values = {}
+    errors = {}
+    for env_var_name in env_var_names:
+        tag = EnvVarName(prefix + env_var_name)
+        if tag in result.values:
+            values[env_var_name] = result.values[tag]
+        elif tag in result.env_var_errors:
+            errors[env_var_name] = result.env_var_errors[tag]
+    return PartialLookupResult(values=values, env_var_errors=errors, title_errors={})
+
+
+def resolve_matrix(env_var_names: List[EnvVarName],
+                   selectors: List[EnvironmentSelector],
+                   field_mapping: Optional[FieldMapping] = None,
+                   timeout: Optional[float] = None,
+                   per_call_timeout: Optional[float] = None,
+                   backend: Optional[str] = None,
+                   breaker: Optional['CircuitBreaker'] = None,
+                   item_cache: Optional[ItemVersionCache] = None) -> \
+        Dict[str, PartialLookupResult]:
+    """Look up env_var_names in each environment, all in parallel.
+
+    Results are keyed by environment label, with values and errors
+    keyed by the names as given (not the prefixed tags).
+    """
+    env_var_names = _uniqify(env_var_names)
+    prefixes = [selector.value for selector in selectors if selector.kind == 'prefix']
+    # one lookup per account for tagged names, and one per title
+    tagged: Dict[Optional[str], List[EnvVarName]] = {}
+    if prefixes:
+        tagged[None] = [EnvVarName(prefix + env_var_name)
+                        for prefix in _uniqify(prefixes) for env_var_name in env_var_names]
+    for selector in selectors:
+        if selector.kind == 'account':
+            tagged[selector.value] = env_var_names
+    titles = _uniqify([Title(selector.value) for selector in selectors
+                       if selector.kind == 'title'])
+    with Resolver(field_mapping=_prefixed_field_mapping(field_mapping or {}, env_var_names,
+                                                        prefixes),
+                  backend=_guarded_backend(backend, breaker)) as resolver, \
+            deadline(timeout, per_call_timeout), caching_items(item_cache), \
+            ThreadPoolExecutor(max_workers=max(len(tagged) + len(titles), 1),
+                               thread_name_prefix='op-env-matrix') as executor:
+        tagged_futures = {
+            shorthand: _submit(executor, _in_account, shorthand, resolver, names, [])
+            for shorthand, names in tagged.items()
+        }
+        title_futures = {
+            title: _submit(executor, _in_account, None, resolver, [], [title])
+            for title in titles
+        }
+        tagged_results = {shorthand: future.result()
+                          for shorthand, future in tagged_futures.items()}
+        title_results = {title: future.result() for title, future in title_futures.items()}
+    results: Dict[str, PartialLookupResult] = {}
+    for selector in selectors:
+        if selector.kind == 'title':
+            results[selector.label] = _title_result(Title(selector.value), env_var_names,
+                                                    title_results[Title(selector.value)])
+        elif selector.kind == 'prefix':
+            results[selector.label] = _prefix_result(selector.value, env_var_names,
+                                                     tagged_results[None])
+        else:
+            results[selector.label] = _prefix_result('', env_var_names,
+                                                     tagged_results[selector.value])
+    return results
+
+
+class NameDiff(NamedTuple):
+    "How one name compares across environments, without its values"
+    # 'same', 'changed' or 'missing' (from at least one environment)
+    status: str
+    # a short keyed hash of each environment's value, or None where it's missing
+    hashes: Dict[str, Optional[str]]
+
+
+def diff_environments(results: Dict[str, PartialLookupResult],
+                      env_var_names: List[EnvVarName],
+                      key: Optional[bytes] = None) -> Dict[EnvVarName, NameDiff]:
+    """Compare each name's values across environments.
+
+    Values are hashed with a key which is random unless given, so
+    hashes can be compared within a diff but can't be used to guess
+    values, however short.
+    """
+    key = key or os.urandom(32)
+    diff: Dict[EnvVarName, NameDiff] = {}
+    for env_var_name in _uniqify(env_var_names):
+        hashes: Dict[str, Optional[str]] = {}
+        for label, result in results.items():
+            value = result.values.get(env_var_name)
+            hashes[label] = None if value is None else \
+                hmac.new(key, value.encode('utf-8'), hashlib.sha256).hexdigest()[:HASH_LENGTH]
+        present = [digest for digest in hashes.values() if digest is not None]
+        if len(present) < len(hashes):
+            status = 'missing'
+        elif len(set(present)) > 1:
+            status = 'changed'
+        else:
+            status = 'same'
+        diff[env_var_name] = NameDiff(status=status, hashes=hashes)
+    return diff
+
+
+def render_matrix(results: Dict[str, PartialLookupResult],
+                  diff: Dict[EnvVarName, NameDiff],
+                  with_values: bool = True) -> Dict[str, object]:
+    "The JSON document 'op-env matrix' prints"
+    return {
+        'environments': {
+            label: {
+                **({'values': result.values} if with_values else {}),
+                'errors': {env_var_name: str(error)
+                           for env_var_name, error in result.env_var_errors.items()},
+            }
+            for label, result in results.items()
+        },
+        'diff': {env_var_name: name_diff._asdict() for env_var_name, name_diff in diff.items()},
+    }
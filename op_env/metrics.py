@@ -0,0 +1,242 @@
+"""Instrumentation hooks for the 'op' lookup pipeline.
+
+Observers are plain callables which receive one event per 'op'
+subprocess, parse phase and cache interaction.  When no observer is
+registered, the pipeline skips all timing and bookkeeping.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+from typing import (Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence,
+                    Tuple, Union)
+
+
+class OpSubprocessEvent(NamedTuple):
+    # argv with everything but subcommands and flags replaced by '?'
+    argv_shape: Tuple[str, ...]
+    duration: float
+    bytes_in: int
+    bytes_out: int
+    exit_status: int
+
+
+class OpParseEvent(NamedTuple):
+    phase: str
+    duration: float
+    size: int
+
+
+class OpCacheEvent(NamedTuple):
+    cache: str
+    hit: bool
+
+
+class OpSlotWaitEvent(NamedTuple):
+    # time spent waiting for a host-wide op slot
+    wait: float
+    limit: int
+    # processes and threads queued ahead when the wait began
+    queued: int
+
+
+OpEvent = Union[OpSubprocessEvent, OpParseEvent, OpCacheEvent, OpSlotWaitEvent]
+OpObserver = Callable[[OpEvent], None]
+
+_observers: List[OpObserver] = []
+_scoped_observers: ContextVar[Tuple[OpObserver, ...]] = ContextVar('_scoped_observers',
+                                                                   default=())
+
+# Words which can appear in an 'op' argv without revealing anything
+# about the items being looked up.
+_SAFE_ARGV_WORDS = frozenset([
+    'op', 'list', 'get', 'item', 'items', 'vault', 'vaults', 'inject', 'read',
+    'account', '-',
+])
+
+
+def add_observer(observer: OpObserver) -> None:
+    _observers.append(observer)
+
+
+def remove_observer(observer: OpObserver) -> None:
+    _observers.remove(observer)
+
+
+@contextmanager
+def observing(observer: Optional[OpObserver]) -> Iterator[None]:
+    "Send events raised in the current context to observer as well"
+    if observer is None:
+        yield
+        return
+    token = _scoped_observers.set(_scoped_observers.get() + (observer,))
+    try:
+        yield
+    finally:
+        _scoped_observers.reset(token)
+
+
+def enabled() -> bool:
+    return bool(_observers) or bool(_scoped_observers.get())
+
+
+def emit(event: OpEvent) -> None:
+    for observer in _observers + list(_scoped_observers.get()):
+        observer(event)
+
+
+def emit_cache(cache: str, hit: bool) -> None:
+    if enabled():
+        emit(OpCacheEvent(cache=cache, hit=hit))
+
+
+@contextmanager
+def parsing(phase: str, size: int) -> Iterator[None]:
+    if not enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        emit(OpParseEvent(phase=phase, duration=time.perf_counter() - start, size=size))
+
+
+def argv_shape(argv: Sequence[str]) -> Tuple[str, ...]:
+    return tuple(
+        arg if arg in _SAFE_ARGV_WORDS or arg.startswith('--') else '?'
+        for arg in argv
+    )
+
+
+def _command_label(shape: Sequence[str]) -> str:
+    words = []
+    for arg in shape:
+        if arg.startswith('-') or arg == '?':
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+
+class _Histogram:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class PrometheusAggregator:
+    """In-process observer exposing counters and latency histograms.
+
+    Register with add_observer() (or pass to a Resolver) and serve
+    render() from your metrics endpoint.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._subprocess_counts: Dict[Tuple[str, int], int] = {}
+        self._subprocess_bytes: Dict[Tuple[str, str], int] = {}
+        self._subprocess_latency: Dict[str, _Histogram] = {}
+        self._parse_latency: Dict[str, _Histogram] = {}
+        self._parse_bytes: Dict[str, int] = {}
+        self._cache_counts: Dict[Tuple[str, str], int] = {}
+        self._slot_wait: Dict[str, _Histogram] = {}
+
+    def _histogram(self, histograms: Dict[str, _Histogram], key: str) -> _Histogram:
+        if key not in histograms:
+            histograms[key] = _Histogram(self._buckets)
+        return histograms[key]
+
+    def __call__(self, event: OpEvent) -> None:
+        with self._lock:
+            if isinstance(event, OpSubprocessEvent):
+                command = _command_label(event.argv_shape)
+                key = (command, event.exit_status)
+                self._subprocess_counts[key] = self._subprocess_counts.get(key, 0) + 1
+                for direction, size in (('in', event.bytes_in), ('out', event.bytes_out)):
+                    bytes_key = (command, direction)
+                    self._subprocess_bytes[bytes_key] = \
+                        self._subprocess_bytes.get(bytes_key, 0) + size
+                self._histogram(self._subprocess_latency, command).observe(event.duration)
+            elif isinstance(event, OpParseEvent):
+                self._histogram(self._parse_latency, event.phase).observe(event.duration)
+                self._parse_bytes[event.phase] = \
+                    self._parse_bytes.get(event.phase, 0) + event.size
+            elif isinstance(event, OpCacheEvent):
+                cache_key = (event.cache, 'hit' if event.hit else 'miss')
+                self._cache_counts[cache_key] = self._cache_counts.get(cache_key, 0) + 1
+            elif isinstance(event, OpSlotWaitEvent):
+                self._histogram(self._slot_wait, str(event.limit)).observe(event.wait)
+
+    def render(self) -> str:
+        "Render all metrics in the Prometheus text exposition format"
+        with self._lock:
+            lines = [
+                '# HELP op_env_subprocess_total op subprocesses run',
+                '# TYPE op_env_subprocess_total counter',
+            ]
+            for (command, exit_status), count in sorted(self._subprocess_counts.items()):
+                lines.append(f'op_env_subprocess_total{{command="{command}",'
+                             f'exit_status="{exit_status}"}} {count}')
+            lines += [
+                '# HELP op_env_subprocess_bytes_total bytes sent to and received from op',
+                '# TYPE op_env_subprocess_bytes_total counter',
+            ]
+            for (command, direction), size in sorted(self._subprocess_bytes.items()):
+                lines.append(f'op_env_subprocess_bytes_total{{command="{command}",'
+                             f'direction="{direction}"}} {size}')
+            lines += [
+                '# HELP op_env_subprocess_duration_seconds op subprocess latency',
+                '# TYPE op_env_subprocess_duration_seconds histogram',
+            ]
+            for command, histogram in sorted(self._subprocess_latency.items()):
+                lines += histogram.render('op_env_subprocess_duration_seconds',
+                                          f'command="{command}"')
+            lines += [
+                '# HELP op_env_parse_duration_seconds time spent parsing op output',
+                '# TYPE op_env_parse_duration_seconds histogram',
+            ]
+            for phase, histogram in sorted(self._parse_latency.items()):
+                lines += histogram.render('op_env_parse_duration_seconds',
+                                          f'phase="{phase}"')
+            lines += [
+                '# HELP op_env_parse_bytes_total bytes of op output parsed',
+                '# TYPE op_env_parse_bytes_total counter',
+            ]
+            for phase, size in sorted(self._parse_bytes.items()):
+                lines.append(f'op_env_parse_bytes_total{{phase="{phase}"}} {size}')
+            lines += [
+                '# HELP op_env_cache_requests_total cache lookups',
+                '# TYPE op_env_cache_requests_total counter',
+            ]
+            for (cache, result), count in sorted(self._cache_counts.items()):
+                lines.append(f'op_env_cache_requests_total{{cache="{cache}",'
+                             f'result="{result}"}} {count}')
+            lines += [
+                '# HELP op_env_slot_wait_seconds time spent waiting for a host-wide op slot',
+                '# TYPE op_env_slot_wait_seconds histogram',
+            ]
+            for limit, histogram in sorted(self._slot_wait.items()):
+                lines += histogram.render('op_env_slot_wait_seconds', f'limit="{limit}"')
+            return '\n'.join(lines) + '\n'
@@ -1,15 +1,52 @@
+import abc
 from collections import OrderedDict
+from concurrent.futures import as_completed, Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
 import json
+import math
+import os
+import re
 import subprocess
-from typing import Collection, Dict, List, Mapping, NewType, Sequence, Set, TypeVar
+from subprocess import CalledProcessError, TimeoutExpired
+import threading
+import time
+from typing import (Any, Callable, Collection, Dict, Iterator, List, Mapping, NamedTuple,
+                    NewType, Optional, Sequence, Set, Tuple, TYPE_CHECKING, TypeVar, Union)
 
 from pydantic import BaseModel
+from typing_extensions import Protocol
+
+from . import metrics
+
+if TYPE_CHECKING:
+    from .breaker import CircuitBreaker
+    from .item_cache import ItemVersionCache
 
 EnvVarName = NewType('EnvVarName', str)
 Title = NewType('Title', str)
 FieldName = NewType('FieldName', str)
 FieldValue = NewType('FieldValue', str)
 
+T = TypeVar('T')
+
+ENV_VAR_NAME_PATTERN = re.compile('[A-Za-z_][A-Za-z0-9_]*')
+
+# Linux refuses any single argument longer than 128KiB, so the fields
+# to fetch are split over several 'op get item' calls past this length.
+MAX_FIELDS_ARGUMENT_LENGTH = 100000
+
+
+class FieldReference(NamedTuple):
+    # Field to read instead of guessing from the env var name
+    field: Optional[FieldName]
+    # Item title or uuid to read instead of looking up the env var name as a tag
+    item: Optional[str] = None
+    vault: Optional[str] = None
+
+
+FieldMapping = Mapping[EnvVarName, FieldReference]
+
 
 class OpItemOverview(BaseModel):
     tags: List[EnvVarName]
@@ -78,41 +115,238 @@ class InvalidTagOPLookupError(OPLookupError):
     pass
 
 
-def _op_list_items(env_var_names: List[EnvVarName]) -> OpListItemsOutputOrderedByEnvVarName:
-    list_command = ['op', 'list', 'items', '--tags',
-                    ','.join(env_var_names)]
-    list_items_json_docs_bytes = subprocess.check_output(list_command)
+class ConflictingValuesOPLookupError(OPLookupError):
+    pass
+
+
+class UnreadableItemOPLookupError(OPLookupError):
+    "op failed to read a particular item, e.g. as there is no item with that title"
+    pass
+
+
+class TimeoutOPLookupError(OPLookupError):
+    def __init__(self, message: str, phase: str, timings: Dict[str, float]) -> None:
+        super().__init__(message)
+        # phase which ran out of time, and seconds spent in each phase
+        self.phase = phase
+        self.timings = timings
+
+
+class Deadline:
+    """Time budget shared by every op call made while it is current.
+
+    Each call is given whatever is left of the total budget (capped
+    at per_call, if given), and time spent is recorded per phase so
+    that a timeout can say where the budget went.
+    """
+
+    def __init__(self, total: float, per_call: Optional[float] = None) -> None:
+        self.total = total
+        self.per_call = per_call
+        self.expires_at = time.monotonic() + total
+        self.timings: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def record(self, phase: str, duration: float) -> None:
+        with self._lock:
+            self.timings[phase] = self.timings.get(phase, 0.0) + duration
+
+    def timeout_error(self, phase: str) -> 'TimeoutOPLookupError':
+        with self._lock:
+            timings = dict(self.timings)
+        spent = ', '.join(f'{name} {duration:.2f}s' for name, duration in timings.items())
+        return TimeoutOPLookupError(f'op {phase} call ran out of time '
+                                    f'(budget {self.total:g}s; spent {spent or "nothing"})',
+                                    phase=phase,
+                                    timings=timings)
+
+    def call_timeout(self, phase: str) -> float:
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise self.timeout_error(phase)
+        if self.per_call is not None:
+            return min(remaining, self.per_call)
+        return remaining
+
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = \
+    contextvars.ContextVar('_current_deadline', default=None)
+
+
+@contextmanager
+def deadline(total: Optional[float], per_call: Optional[float] = None) -> Iterator[None]:
+    "Limit the op calls made in this context to total seconds"
+    if total is None and per_call is None:
+        yield
+        return
+    token = _current_deadline.set(Deadline(math.inf if total is None else total, per_call))
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+_current_account: contextvars.ContextVar[Optional[str]] = \
+    contextvars.ContextVar('_current_account', default=None)
+
+
+@contextmanager
+def account(shorthand: Optional[str]) -> Iterator[None]:
+    "Run the op calls made in this context against the given signed-in account"
+    token = _current_account.set(shorthand)
+    try:
+        yield
+    finally:
+        _current_account.reset(token)
+
+
+# Item fields fetched by tagged lookups are reused from this while
+# the items are unchanged; see op_env.item_cache
+_current_item_cache: contextvars.ContextVar[Optional['ItemVersionCache']] = \
+    contextvars.ContextVar('_current_item_cache', default=None)
+
+
+OpRunner = Callable[[List[str], Optional[bytes], Optional[float]], bytes]
+
+# Runs op commands in place of _run_op, e.g. to record or replay them
+_current_runner: contextvars.ContextVar[Optional[OpRunner]] = \
+    contextvars.ContextVar('_current_runner', default=None)
+
+
+def _run_op(command: List[str], input: Optional[bytes], timeout: Optional[float]) -> bytes:
+    from .throttle import op_slot
+
+    # waiting for a slot under $OP_ENV_MAX_CONCURRENCY counts against timeout
+    with op_slot(timeout) as timeout:
+        kwargs: Dict[str, Any] = {}
+        if input is not None:
+            kwargs['input'] = input
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return subprocess.check_output(command, **kwargs)
+
+
+def _op_check_output(command: List[str],
+                     input: Optional[bytes] = None,
+                     phase: str = 'op') -> bytes:
+    "Run an op command within any current deadline, reporting to any metrics observers"
+    current_account = _current_account.get()
+    if current_account is not None:
+        command = command + ['--account', current_account]
+    run = _current_runner.get() or _run_op
+    current_deadline = _current_deadline.get()
+    if current_deadline is None and not metrics.enabled():
+        return run(command, input, None)
+    timeout = None if current_deadline is None else current_deadline.call_timeout(phase)
+    start = time.perf_counter()
+    output = b''
+    exit_status = -1
+    try:
+        output = run(command, input, timeout)
+        exit_status = 0
+        return output
+    except CalledProcessError as e:
+        exit_status = e.returncode
+        raise
+    except TimeoutExpired:
+        # subprocess has already killed op by now
+        assert current_deadline is not None
+        current_deadline.record(phase, time.perf_counter() - start)
+        raise current_deadline.timeout_error(phase) from None
+    finally:
+        duration = time.perf_counter() - start
+        if current_deadline is not None and exit_status != -1:
+            current_deadline.record(phase, duration)
+        if metrics.enabled():
+            metrics.emit(metrics.OpSubprocessEvent(argv_shape=metrics.argv_shape(command),
+                                                   duration=duration,
+                                                   bytes_in=len(input or b''),
+                                                   bytes_out=len(output),
+                                                   exit_status=exit_status))
+
+
+def _op_list_items_data(env_var_names: Optional[List[EnvVarName]]) -> List[OpListItemsEntry]:
+    "Items tagged with any of env_var_names, or every item if that's None"
+    list_command = ['op', 'list', 'items']
+    if env_var_names is not None:
+        list_command += ['--tags', ','.join(env_var_names)]
+    list_items_json_docs_bytes = _op_check_output(list_command, phase='list')
     # list_items_json_docs_str = list_items_json_docs_bytes.decode('utf-8')
-    list_items_data = [
-        OpListItemsEntry(**item)
-        for item in json.loads(list_items_json_docs_bytes)
-    ]
-    by_env_var_name: Dict[EnvVarName, OpListItemsEntry] = {}
+    with metrics.parsing('list_items', len(list_items_json_docs_bytes)):
+        return [
+            OpListItemsEntry(**item)
+            for item in json.loads(list_items_json_docs_bytes)
+        ]
+
+
+def _list_items_entry_tags(entry: OpListItemsEntry) -> List[EnvVarName]:
+    return entry.overview.tags
+
+
+def _index_list_items(list_items_data: Sequence[T],
+                      env_var_names: List[EnvVarName],
+                      tags_of: Callable[[T], List[EnvVarName]]) -> \
+        Tuple[Dict[EnvVarName, T], Dict[EnvVarName, OPLookupError]]:
+    "Find the one item for each env var name, and errors for tags with other than one"
+    by_env_var_name: Dict[EnvVarName, T] = {}
+    errors: Dict[EnvVarName, OPLookupError] = {}
 
     #
     # Ensure we have at most one item per env var name
     #
     for entry in list_items_data:
-        for env_var_name in entry.overview.tags:
+        for env_var_name in tags_of(entry):
             if env_var_name in by_env_var_name:
-                raise TooManyEntriesOPLookupError("Too many 1Password entries "
-                                                  f"with tag {env_var_name} found")
+                errors.setdefault(env_var_name,
+                                  TooManyEntriesOPLookupError("Too many 1Password entries "
+                                                              f"with tag {env_var_name} found"))
             else:
                 by_env_var_name[env_var_name] = entry
-    ordered_list_items_data = []
+    for env_var_name in errors:
+        del by_env_var_name[env_var_name]
     #
     # Ensure we have at least one item per env var name
     #
     for env_var_name in env_var_names:
-        if env_var_name not in by_env_var_name:
-            raise NoEntriesOPLookupError(f"No 1Password entries with tag {env_var_name} found")
-        else:
-            ordered_list_items_data.append(by_env_var_name[env_var_name])
+        if env_var_name not in by_env_var_name and env_var_name not in errors:
+            errors[env_var_name] = NoEntriesOPLookupError("No 1Password entries with tag "
+                                                          f"{env_var_name} found")
+    return by_env_var_name, errors
+
+
+def _tags_with_prefixes(list_items_data: Sequence[T],
+                        tag_prefixes: Sequence[str],
+                        tags_of: Callable[[T], List[EnvVarName]]) -> List[EnvVarName]:
+    """Distinct tags starting with any of tag_prefixes, in the order found.
+
+    An empty prefix matches every tag.  Tags which couldn't be
+    environment variable names, like 'Work/Finance', are skipped.
+    """
+    prefixes = tuple(tag_prefixes)
+    return _uniqify([
+        env_var_name
+        for entry in list_items_data
+        for env_var_name in tags_of(entry)
+        if env_var_name.startswith(prefixes) and ENV_VAR_NAME_PATTERN.fullmatch(env_var_name)
+    ])
+
+
+def _op_list_items(env_var_names: List[EnvVarName]) -> OpListItemsOutputOrderedByEnvVarName:
+    by_env_var_name, errors = _index_list_items(_op_list_items_data(env_var_names),
+                                                env_var_names,
+                                                _list_items_entry_tags)
+    if errors:
+        raise next(iter(errors.values()))
     #
     # With exactly one item per env var name, we know this is ordered
     # by the env var name.
     #
-    return OpListItemsOutputOrderedByEnvVarName(ordered_list_items_data)
+    return OpListItemsOutputOrderedByEnvVarName([
+        by_env_var_name[env_var_name] for env_var_name in env_var_names
+    ])
 
 
 def _fields_from_list_output(list_items_output: OpListItemsOutputOrderedByEnvVarName,
@@ -125,21 +359,45 @@ def _fields_from_list_output(list_items_output: OpListItemsOutputOrderedByEnvVar
     # separated by newlines of the fields requested if they exist in
     # the item
     #
-    sorted_fields_to_seek = sorted(all_fields_to_seek)
-    get_command: List[str] = ['op', 'get', 'item', '-', '--fields',
-                              ','.join(sorted_fields_to_seek)]
-    list_items_output_raw: bytes = json.dumps([
-        item.dict() for item in list_items_output
-    ]).encode('utf-8')
-    field_values_json_docs_bytes = subprocess.check_output(get_command,
-                                                           input=list_items_output_raw)
-    field_values_json_docs_str = field_values_json_docs_bytes.decode('utf-8')
-    field_values_data: List[Dict[FieldName, FieldValue]] = [
-        json.loads(field_values_json)
-        for field_values_json
-        in field_values_json_docs_str.split('\n')
-        if field_values_json != ''
-    ]
+    # With an item cache, only items changed since they were cached
+    # are fetched
+    cache = _current_item_cache.get()
+    listed = [item.dict() for item in list_items_output]
+    cached: Dict[int, Dict[FieldName, FieldValue]] = {}
+    to_fetch = list(range(len(listed)))
+    if cache is not None:
+        cached, to_fetch = cache.split(listed, all_fields_to_seek)
+    fetched: List[Dict[FieldName, FieldValue]] = []
+    if to_fetch:
+        sorted_fields_to_seek = sorted(all_fields_to_seek)
+        get_command: List[str] = ['op', 'get', 'item', '-', '--fields',
+                                  ','.join(sorted_fields_to_seek)]
+        list_items_output_raw: bytes = json.dumps([
+            listed[position] for position in to_fetch
+        ]).encode('utf-8')
+        field_values_json_docs_bytes = _op_check_output(get_command,
+                                                        input=list_items_output_raw,
+                                                        phase='get')
+        with metrics.parsing('get_fields', len(field_values_json_docs_bytes)):
+            field_values_json_docs_str = field_values_json_docs_bytes.decode('utf-8')
+            fetched = [
+                json.loads(field_values_json)
+                for field_values_json
+                in field_values_json_docs_str.split('\n')
+                if field_values_json != ''
+            ]
+    if cache is not None:
+        for position, field_values in zip(to_fetch, fetched):
+            cache.put(listed[position], all_fields_to_seek, field_values)
+    fetched_by_position = dict(zip(to_fetch, fetched))
+    field_values_data: List[Dict[FieldName, FieldValue]] = []
+    for position in range(len(listed)):
+        if position in cached:
+            field_values_data.append(cached[position])
+        elif position in fetched_by_position:
+            field_values_data.append(fetched_by_position[position])
+        else:
+            break
     #
     # Organize the fields found based on what the original tags were
     #
@@ -150,10 +408,73 @@ def _fields_from_list_output(list_items_output: OpListItemsOutputOrderedByEnvVar
     }
 
 
-def _fields_from_title(title: Title) -> Dict[EnvVarName, FieldValue]:
+def _fields_for_env_var_names(by_env_var_name: Mapping[EnvVarName, OpListItemsEntry],
+                              env_var_names: List[EnvVarName],
+                              field_mapping: FieldMapping) -> \
+        Dict[EnvVarName, Dict[FieldName, FieldValue]]:
+    """Fetch the fields to try for each of env_var_names from its listed item.
+
+    That's one 'op get item' call unless the fields asked for would
+    add up to more than MAX_FIELDS_ARGUMENT_LENGTH.
+    """
+    field_values_for_envvars: Dict[EnvVarName, Dict[FieldName, FieldValue]] = {}
+    for batch_env_var_names, fields_to_seek in _field_batches(env_var_names, field_mapping):
+        list_items_output = OpListItemsOutputOrderedByEnvVarName([
+            by_env_var_name[env_var_name] for env_var_name in batch_env_var_names
+        ])
+        field_values_for_envvars.update(_fields_from_list_output(list_items_output,
+                                                                 batch_env_var_names,
+                                                                 fields_to_seek))
+    return field_values_for_envvars
+
+
+def _field_batches(env_var_names: List[EnvVarName],
+                   field_mapping: FieldMapping) -> \
+        List[Tuple[List[EnvVarName], Set[FieldName]]]:
+    "Split env_var_names so the fields to seek for each batch fit in one '--fields' argument"
+    batches: List[Tuple[List[EnvVarName], Set[FieldName]]] = []
+    length = 0
+    for env_var_name in env_var_names:
+        fields = _op_fields_to_seek([env_var_name], field_mapping)
+        new_fields = fields - batches[-1][1] if batches else fields
+        added = sum(len(field) + 1 for field in new_fields)
+        if not batches or length + added > MAX_FIELDS_ARGUMENT_LENGTH:
+            batches.append(([], set()))
+            new_fields = fields
+            added = sum(len(field) + 1 for field in fields)
+            length = 0
+        length += added
+        batches[-1][0].append(env_var_name)
+        batches[-1][1].update(new_fields)
+    return batches
+
+
+def _fields_from_item(item: str,
+                      vault: Optional[str],
+                      fields_to_seek: Collection[FieldName]) -> Dict[FieldName, FieldValue]:
+    sorted_fields_to_seek = sorted(fields_to_seek)
+    get_command: List[str] = ['op', 'get', 'item', item, '--fields',
+                              ','.join(sorted_fields_to_seek)]
+    if vault is not None:
+        get_command += ['--vault', vault]
+    output_bytes = _op_check_output(get_command, phase='item')
+    with metrics.parsing('get_item_fields', len(output_bytes)):
+        output_str = output_bytes.decode('utf-8')
+        if len(sorted_fields_to_seek) == 1:
+            # op prints a lone field's value rather than a JSON object,
+            # followed by a newline; any before that are the value's own
+            if output_str.endswith('\n'):
+                output_str = output_str[:-1]
+            return {sorted_fields_to_seek[0]: FieldValue(output_str)}
+        return json.loads(output_str)
+
+
+def _op_title_field_values(title: Title) -> \
+        Tuple[List[EnvVarName], Dict[FieldName, FieldValue]]:
     get_command: List[str] = ['op', 'get', 'item', title]
-    output_bytes = subprocess.check_output(get_command)
-    output = OpGetItemEntry(**json.loads(output_bytes))
+    output_bytes = _op_check_output(get_command, phase='title')
+    with metrics.parsing('get_title', len(output_bytes)):
+        output = OpGetItemEntry(**json.loads(output_bytes))
     overview = output.overview
     tags: List[EnvVarName] = overview.tags
     details = output.details
@@ -166,9 +487,14 @@ def _fields_from_title(title: Title) -> Dict[EnvVarName, FieldValue]:
         for section in details.sections
         for field in section.fields
     }
-    field_values = {**section_field_values, **regular_field_values}
+    return tags, {**section_field_values, **regular_field_values}
+
+
+def _fields_from_title(title: Title,
+                       field_mapping: FieldMapping = {}) -> Dict[EnvVarName, FieldValue]:
+    tags, field_values = _op_title_field_values(title)
     return {
-        tag: _op_pluck_correct_field(tag, field_values)
+        tag: _op_pluck_field(tag, field_values, field_mapping)
         for tag in tags
     }
 
@@ -187,9 +513,6 @@ def _all_lowercased(env_var_name: EnvVarName) -> FieldName:
     return FieldName(env_var_name.lower())
 
 
-T = TypeVar('T')
-
-
 def _uniqify(fields: Sequence[T]) -> List[T]:
     "Removes duplicates but preserves order"
     # https://stackoverflow.com/questions/4459703/how-to-make-lists-contain-only-distinct-element-in-python
@@ -238,28 +561,294 @@ def _op_pluck_correct_field(env_var_name: EnvVarName,
                                     'one of these fields in 1Password.')
 
 
+def _op_pluck_field(env_var_name: EnvVarName,
+                    field_values: Dict[FieldName, FieldValue],
+                    field_mapping: FieldMapping) -> FieldValue:
+    field_reference = field_mapping.get(env_var_name)
+    if field_reference is None or field_reference.field is None:
+        return _op_pluck_correct_field(env_var_name, field_values)
+    field = field_reference.field
+    if field_values.get(field, '') == '':
+        raise NoFieldValueOPLookupError(f'1Password entry for {env_var_name} has no value for '
+                                        f'mapped field {field}.  Please populate this field '
+                                        'in 1Password.')
+    return field_values[field]
+
+
+def _op_fields_to_seek(env_var_names: Collection[EnvVarName],
+                       field_mapping: FieldMapping) -> Set[FieldName]:
+    "Fields to request for env_var_names, going by the mapping where there is one"
+    unmapped = [
+        env_var_name for env_var_name in env_var_names
+        if field_mapping.get(env_var_name, FieldReference(None)).field is None
+    ]
+    mapped_fields: Set[FieldName] = {
+        field_mapping[env_var_name].field  # type: ignore
+        for env_var_name in env_var_names
+        if env_var_name not in unmapped
+    }
+    if not unmapped:
+        return mapped_fields
+    if not mapped_fields:
+        return _op_consolidated_fields(unmapped)
+    return mapped_fields | _op_consolidated_fields(unmapped)
+
+
 def _validate_env_var_names(env_var_names: List[EnvVarName]) -> None:
     for env_var_name in env_var_names:
         if ',' in env_var_name:
             raise InvalidTagOPLookupError('1Password does not support tags with commas')
 
 
-def _do_env_lookups(env_var_names: List[EnvVarName]) -> Dict[EnvVarName, FieldValue]:
+def _group_by_item(env_var_names: List[EnvVarName],
+                   field_mapping: FieldMapping) -> \
+        Dict[Tuple[str, Optional[str]], List[EnvVarName]]:
+    by_item: Dict[Tuple[str, Optional[str]], List[EnvVarName]] = {}
+    for env_var_name in env_var_names:
+        field_reference = field_mapping[env_var_name]
+        assert field_reference.item is not None
+        by_item.setdefault((field_reference.item, field_reference.vault),
+                           []).append(env_var_name)
+    return by_item
+
+
+def _is_item_uuid(item: str) -> bool:
+    return len(item) == 26 and item.isalnum() and item.islower()
+
+
+ItemKey = Tuple[str, Optional[str]]
+
+
+def _fetch_item_field_values(by_item: Mapping[ItemKey, List[EnvVarName]],
+                             field_mapping: FieldMapping) -> \
+        Dict[ItemKey, Union[Dict[FieldName, FieldValue], CalledProcessError]]:
+    """Field values for each (item, vault), or the CalledProcessError from fetching it.
+
+    Items referred to by uuid alone are fetched together in one 'op get
+    item -' call, the same way tagged items are; the rest take one call
+    each.
+    """
+    results: Dict[ItemKey, Union[Dict[FieldName, FieldValue], CalledProcessError]] = {}
+    batched = [key for key in by_item if key[1] is None and _is_item_uuid(key[0])]
+    if len(batched) > 1:
+        fields_to_seek: Set[FieldName] = set()
+        for key in batched:
+            fields_to_seek |= set(_op_fields_to_seek(by_item[key], field_mapping))
+        uuid_entries = OpListItemsOutputOrderedByEnvVarName([
+            OpListItemsEntry(uuid=item, overview=OpItemOverview(tags=[]))
+            for item, _ in batched
+        ])
+        try:
+            # keyed by uuid rather than env var name here
+            field_values_by_uuid = _fields_from_list_output(uuid_entries,
+                                                            [EnvVarName(item)
+                                                             for item, _ in batched],
+                                                            fields_to_seek)
+        except CalledProcessError as e:
+            results.update({key: e for key in batched})
+        else:
+            results.update({key: field_values_by_uuid.get(EnvVarName(key[0]), {})
+                            for key in batched})
+    for (item, vault), item_env_var_names in by_item.items():
+        if (item, vault) in results:
+            continue
+        try:
+            results[(item, vault)] = _fields_from_item(item, vault,
+                                                       _op_fields_to_seek(item_env_var_names,
+                                                                          field_mapping))
+        except CalledProcessError as e:
+            results[(item, vault)] = e
+    return results
+
+
+def _do_item_lookups(env_var_names: List[EnvVarName],
+                     field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+    "Look up env var names mapped to a specific item, without listing tags"
+    item_lookups: Dict[EnvVarName, FieldValue] = {}
+    by_item = _group_by_item(env_var_names, field_mapping)
+    for key, field_values in _fetch_item_field_values(by_item, field_mapping).items():
+        if isinstance(field_values, CalledProcessError):
+            raise field_values
+        for env_var_name in by_item[key]:
+            item_lookups[env_var_name] = _op_pluck_field(env_var_name, field_values,
+                                                         field_mapping)
+    return item_lookups
+
+
+def _do_env_lookups(env_var_names: List[EnvVarName],
+                    field_mapping: FieldMapping = {}) -> Dict[EnvVarName, FieldValue]:
     if len(env_var_names) == 0:
         return {}
     _validate_env_var_names(env_var_names)
-    list_items_output = _op_list_items(env_var_names)
-    all_fields_to_seek = _op_consolidated_fields(env_var_names)
-    field_values_for_envvars: Dict[EnvVarName, Dict[FieldName, FieldValue]] = \
-        _fields_from_list_output(list_items_output,
-                                 env_var_names,
-                                 all_fields_to_seek)
+    tagged_env_var_names = [
+        env_var_name for env_var_name in env_var_names
+        if field_mapping.get(env_var_name, FieldReference(None)).item is None
+    ]
+    item_env_var_names = [
+        env_var_name for env_var_name in env_var_names
+        if field_mapping.get(env_var_name, FieldReference(None)).item is not None
+    ]
+    env_lookups: Dict[EnvVarName, FieldValue] = {}
+    if tagged_env_var_names:
+        list_items_output = _op_list_items(tagged_env_var_names)
+        field_values_for_envvars = _fields_for_env_var_names(
+            dict(zip(tagged_env_var_names, list_items_output)), tagged_env_var_names,
+            field_mapping)
+        env_lookups.update({
+            env_var_name: _op_pluck_field(env_var_name,
+                                          field_values_for_envvars[env_var_name],
+                                          field_mapping)
+            for env_var_name in field_values_for_envvars
+        })
+    if item_env_var_names:
+        env_lookups.update(_do_item_lookups(item_env_var_names, field_mapping))
     return {
-        env_var_name: _op_pluck_correct_field(env_var_name, field_values_for_envvars[env_var_name])
-        for env_var_name in field_values_for_envvars
+        env_var_name: env_lookups[env_var_name]
+        for env_var_name in env_var_names
+        if env_var_name in env_lookups
     }
 
 
+class PartialLookupResult(NamedTuple):
+    """Values which could be looked up, along with what went wrong for the rest.
+
+    Pass failed_env_var_names and failed_titles to another partial
+    lookup to try again for just those, and combine the two with
+    merged_with().
+    """
+    values: Dict[EnvVarName, FieldValue]
+    env_var_errors: Dict[EnvVarName, Exception]
+    title_errors: Dict[Title, Exception]
+
+    @property
+    def ok(self) -> bool:
+        return not self.env_var_errors and not self.title_errors
+
+    @property
+    def failed_env_var_names(self) -> List[EnvVarName]:
+        return list(self.env_var_errors)
+
+    @property
+    def failed_titles(self) -> List[Title]:
+        return list(self.title_errors)
+
+    def merged_with(self, retry: 'PartialLookupResult') -> 'PartialLookupResult':
+        "Combine with the result of retrying this result's failures"
+        return PartialLookupResult(values={**self.values, **retry.values},
+                                   env_var_errors=retry.env_var_errors,
+                                   title_errors=retry.title_errors)
+
+
+def _op_pluck_fields_partial(env_var_names: List[EnvVarName],
+                             field_values_for_envvars: Mapping[EnvVarName,
+                                                               Dict[FieldName, FieldValue]],
+                             field_mapping: FieldMapping,
+                             values: Dict[EnvVarName, FieldValue],
+                             errors: Dict[EnvVarName, Exception]) -> None:
+    for env_var_name in env_var_names:
+        try:
+            values[env_var_name] = _op_pluck_field(env_var_name,
+                                                   field_values_for_envvars[env_var_name],
+                                                   field_mapping)
+        except NoFieldValueOPLookupError as e:
+            errors[env_var_name] = e
+
+
+def _do_env_lookups_partial(env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping = {},
+                            list_items_data: Optional[List[OpListItemsEntry]] = None) -> \
+        Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+    """Like _do_env_lookups(), but collects every failure rather than stopping at the first.
+
+    Tagged items are found in list_items_data if given, rather than by
+    listing them again.
+    """
+    values: Dict[EnvVarName, FieldValue] = {}
+    errors: Dict[EnvVarName, Exception] = {}
+    valid_env_var_names: List[EnvVarName] = []
+    for env_var_name in env_var_names:
+        try:
+            _validate_env_var_names([env_var_name])
+            valid_env_var_names.append(env_var_name)
+        except InvalidTagOPLookupError as e:
+            errors[env_var_name] = e
+    tagged_env_var_names = [
+        env_var_name for env_var_name in valid_env_var_names
+        if field_mapping.get(env_var_name, FieldReference(None)).item is None
+    ]
+    item_env_var_names = [
+        env_var_name for env_var_name in valid_env_var_names
+        if field_mapping.get(env_var_name, FieldReference(None)).item is not None
+    ]
+    if tagged_env_var_names:
+        if list_items_data is None:
+            list_items_data = _op_list_items_data(tagged_env_var_names)
+        by_env_var_name, list_errors = _index_list_items(list_items_data, tagged_env_var_names,
+                                                         _list_items_entry_tags)
+        errors.update({
+            env_var_name: list_errors[env_var_name]
+            for env_var_name in tagged_env_var_names
+            if env_var_name in list_errors
+        })
+        found = [
+            env_var_name for env_var_name in tagged_env_var_names
+            if env_var_name in by_env_var_name
+        ]
+        if found:
+            field_values_for_envvars = _fields_for_env_var_names(by_env_var_name, found,
+                                                                 field_mapping)
+            _op_pluck_fields_partial(found, field_values_for_envvars, field_mapping,
+                                     values, errors)
+    by_item = _group_by_item(item_env_var_names, field_mapping)
+    for (item, vault), field_values in _fetch_item_field_values(by_item,
+                                                                field_mapping).items():
+        if isinstance(field_values, CalledProcessError):
+            for env_var_name in by_item[(item, vault)]:
+                errors[env_var_name] = UnreadableItemOPLookupError(
+                    f'Could not read 1Password item {item}: '
+                    f'op exited with status {field_values.returncode}')
+            continue
+        _op_pluck_fields_partial(by_item[(item, vault)],
+                                 {env_var_name: field_values
+                                  for env_var_name in by_item[(item, vault)]},
+                                 field_mapping, values, errors)
+    return values, errors
+
+
+def _do_tag_prefix_lookups_partial(tag_prefixes: List[str],
+                                   field_mapping: FieldMapping = {}) -> \
+        Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+    "Look up every tag starting with one of tag_prefixes, listing items only once"
+    list_items_data = _op_list_items_data(None)
+    env_var_names = _tags_with_prefixes(list_items_data, tag_prefixes, _list_items_entry_tags)
+    return _do_env_lookups_partial(env_var_names, field_mapping, list_items_data)
+
+
+def _fields_from_title_partial(title: Title,
+                               field_mapping: FieldMapping = {}) -> \
+        Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+    try:
+        tags, field_values = _op_title_field_values(title)
+    except CalledProcessError as e:
+        return {}, UnreadableItemOPLookupError(f'Could not read 1Password item {title}: '
+                                               f'op exited with status {e.returncode}')
+    return _title_values_partial(tags, field_values, field_mapping)
+
+
+def _title_values_partial(tags: List[EnvVarName],
+                          field_values: Dict[FieldName, FieldValue],
+                          field_mapping: FieldMapping) -> \
+        Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+    "Values for an item's tags, with one error for whichever have no value"
+    values: Dict[EnvVarName, FieldValue] = {}
+    errors: Dict[EnvVarName, Exception] = {}
+    _op_pluck_fields_partial(tags, dict.fromkeys(tags, field_values), field_mapping,
+                             values, errors)
+    if errors:
+        return values, NoFieldValueOPLookupError(' '.join(str(e) for e in errors.values()))
+    return values, None
+
+
 def _do_title_lookups(titles: List[Title]) -> Mapping[EnvVarName, FieldValue]:
     title_lookups: Dict[EnvVarName, FieldValue] = {}
     for title in titles:
@@ -268,8 +857,760 @@ def _do_title_lookups(titles: List[Title]) -> Mapping[EnvVarName, FieldValue]:
     return title_lookups
 
 
+class OpBackend(Protocol):
+    "How lookups are carried out with a particular generation of the 'op' CLI"
+
+    def env_lookups(self,
+                    env_var_names: List[EnvVarName],
+                    field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        ...
+
+    def env_lookups_partial(self,
+                            env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        ...
+
+    def title_lookups(self,
+                      title: Title,
+                      field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        ...
+
+    def title_lookups_partial(self,
+                              title: Title,
+                              field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+        ...
+
+    def tag_prefix_lookups_partial(self,
+                                   tag_prefixes: List[str],
+                                   field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        ...
+
+
+class OpV1Backend:
+    "The 'op list items' and 'op get item' commands of 1Password CLI 1.x"
+
+    def env_lookups(self,
+                    env_var_names: List[EnvVarName],
+                    field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        return _do_env_lookups(env_var_names, field_mapping)
+
+    def env_lookups_partial(self,
+                            env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        return _do_env_lookups_partial(env_var_names, field_mapping)
+
+    def title_lookups(self,
+                      title: Title,
+                      field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        return _fields_from_title(title, field_mapping)
+
+    def title_lookups_partial(self,
+                              title: Title,
+                              field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+        return _fields_from_title_partial(title, field_mapping)
+
+    def tag_prefix_lookups_partial(self,
+                                   tag_prefixes: List[str],
+                                   field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        return _do_tag_prefix_lookups_partial(tag_prefixes, field_mapping)
+
+
+class CollectingOpBackend(abc.ABC):
+    """Base for backends which collect every error as they go.
+
+    Subclasses provide the partial lookups; strict lookups raise the
+    first error collected.
+    """
+
+    @abc.abstractmethod
+    def env_lookups_partial(self,
+                            env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        ...
+
+    @abc.abstractmethod
+    def title_lookups_partial(self,
+                              title: Title,
+                              field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+        ...
+
+    @abc.abstractmethod
+    def tag_prefix_lookups_partial(self,
+                                   tag_prefixes: List[str],
+                                   field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        ...
+
+    def env_lookups(self,
+                    env_var_names: List[EnvVarName],
+                    field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        values, errors = self.env_lookups_partial(env_var_names, field_mapping)
+        if errors:
+            raise next(iter(errors.values()))
+        return {env_var_name: values[env_var_name] for env_var_name in env_var_names}
+
+    def title_lookups(self,
+                      title: Title,
+                      field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        values, error = self.title_lookups_partial(title, field_mapping)
+        if error is not None:
+            raise error
+        return values
+
+
+BACKEND_NAMES = ('v1', 'v2', 'connect', 'auto')
+
+
+def _detect_backend_name() -> str:
+    if os.environ.get('OP_CONNECT_HOST') and os.environ.get('OP_CONNECT_TOKEN'):
+        return 'connect'
+    version = _op_check_output(['op', '--version'], phase='version').decode('utf-8').strip()
+    return 'v1' if version.startswith('0.') or version.startswith('1.') else 'v2'
+
+
+class AutoOpBackend:
+    """Picks a backend the first time it's used.
+
+    That's the Connect backend if $OP_CONNECT_HOST and
+    $OP_CONNECT_TOKEN are set; otherwise v1 or v2 based on 'op --version'.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._backend: Optional[OpBackend] = None
+
+    def detected(self) -> OpBackend:
+        with self._lock:
+            if self._backend is None:
+                self._backend = select_backend(_detect_backend_name())
+            return self._backend
+
+    def env_lookups(self,
+                    env_var_names: List[EnvVarName],
+                    field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        return self.detected().env_lookups(env_var_names, field_mapping)
+
+    def env_lookups_partial(self,
+                            env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        return self.detected().env_lookups_partial(env_var_names, field_mapping)
+
+    def title_lookups(self,
+                      title: Title,
+                      field_mapping: FieldMapping) -> Dict[EnvVarName, FieldValue]:
+        return self.detected().title_lookups(title, field_mapping)
+
+    def title_lookups_partial(self,
+                              title: Title,
+                              field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+        return self.detected().title_lookups_partial(title, field_mapping)
+
+    def tag_prefix_lookups_partial(self,
+                                   tag_prefixes: List[str],
+                                   field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        return self.detected().tag_prefix_lookups_partial(tag_prefixes, field_mapping)
+
+
+def select_backend(name: Optional[str] = None) -> OpBackend:
+    """Backend by name: v1, v2, connect, or auto to pick one.
+
+    Defaults to $OP_ENV_BACKEND, or v1 if that isn't set.
+    """
+    name = name or os.environ.get('OP_ENV_BACKEND') or 'v1'
+    if name == 'v1':
+        return OpV1Backend()
+    elif name == 'v2':
+        from .op_v2 import OpV2Backend
+
+        return OpV2Backend()
+    elif name == 'connect':
+        from .connect import ConnectBackend
+
+        return ConnectBackend()
+    elif name == 'auto':
+        return AutoOpBackend()
+    else:
+        raise ValueError(f'Unknown op backend {name}; choose from {", ".join(BACKEND_NAMES)}')
+
+
+def _submit(executor: Executor, fn: Callable[..., T], *args: Any) -> 'Future[T]':
+    "Run fn in executor, carrying over context such as scoped metrics observers"
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class AccountLookup(NamedTuple):
+    "Env var names and titles to look up in one account"
+    env_var_names: List[EnvVarName]
+    titles: List[Title]
+
+
+def _account_label(shorthand: Optional[str]) -> str:
+    return 'the default account' if shorthand is None else f'account {shorthand}'
+
+
+def _merge_account_values(results: List[Tuple[Optional[str], Dict[EnvVarName, FieldValue]]],
+                          conflicts: Optional[Dict[EnvVarName, Exception]] = None) -> \
+        Dict[EnvVarName, FieldValue]:
+    """Merge each account's values, checking no name got different values.
+
+    Conflicts are raised, or collected into conflicts if given.
+    """
+    merged: Dict[EnvVarName, FieldValue] = {}
+    source: Dict[EnvVarName, Optional[str]] = {}
+    conflicting: Set[EnvVarName] = set()
+    for shorthand, values in results:
+        for env_var_name, value in values.items():
+            if env_var_name not in merged:
+                merged[env_var_name] = value
+                source[env_var_name] = shorthand
+            elif merged[env_var_name] != value:
+                error = ConflictingValuesOPLookupError(
+                    f'{env_var_name} has different values in '
+                    f'{_account_label(source[env_var_name])} and {_account_label(shorthand)}')
+                if conflicts is None:
+                    raise error
+                conflicts[env_var_name] = error
+                conflicting.add(env_var_name)
+    for env_var_name in conflicting:
+        del merged[env_var_name]
+    return merged
+
+
+class Resolver:
+    """Looks up env var names and titles, sharing state between calls.
+
+    Values are cached for cache_ttl seconds (0 disables caching), and
+    titles are fetched in parallel on a worker pool owned by the
+    resolver.  Instances are safe to share between threads; call
+    close() (or use as a context manager) to shut down the pool.
+    """
+
+    def __init__(self,
+                 cache_ttl: float = 0,
+                 max_workers: int = 4,
+                 observer: Optional[metrics.OpObserver] = None,
+                 field_mapping: Optional[FieldMapping] = None,
+                 backend: Optional[OpBackend] = None) -> None:
+        self.cache_ttl = cache_ttl
+        self.field_mapping: FieldMapping = field_mapping or {}
+        self.backend: OpBackend = backend or select_backend()
+        self.observer = observer
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # keyed by (account, env var name or title)
+        self._value_cache: Dict[Tuple[Optional[str], EnvVarName], Tuple[float, FieldValue]] = {}
+        self._title_cache: Dict[Tuple[Optional[str], Title],
+                                Tuple[float, Dict[EnvVarName, FieldValue]]] = {}
+
+    def __enter__(self) -> 'Resolver':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown()
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._value_cache.clear()
+            self._title_cache.clear()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers,
+                                                    thread_name_prefix='op-env')
+            return self._executor
+
+    def _cached(self, cache: Dict[Any, Tuple[float, Any]], key: Any, cache_name: str) -> Any:
+        if self.cache_ttl <= 0:
+            return None
+        key = (_current_account.get(), key)
+        with self._lock:
+            entry = cache.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del cache[key]
+                entry = None
+        metrics.emit_cache(cache_name, entry is not None)
+        return None if entry is None else entry[1]
+
+    def _is_cached(self,
+                   cache: Dict[Any, Tuple[float, Any]],
+                   key: Any,
+                   account: Optional[str]) -> bool:
+        if self.cache_ttl <= 0:
+            return False
+        with self._lock:
+            entry = cache.get((account, key))
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def uncached(self,
+                 env_var_names: List[EnvVarName],
+                 titles: List[Title],
+                 account: Optional[str] = None) -> AccountLookup:
+        """The env var names and titles resolve() would still look up in account.
+
+        Nothing is fetched, and no cache hits or misses are reported.
+        """
+        return AccountLookup(
+            env_var_names=[env_var_name for env_var_name in env_var_names
+                           if not self._is_cached(self._value_cache, env_var_name, account)],
+            titles=[title for title in titles
+                    if not self._is_cached(self._title_cache, title, account)])
+
+    def _store(self, cache: Dict[Any, Tuple[float, Any]], key: Any, value: Any) -> None:
+        if self.cache_ttl <= 0:
+            return
+        with self._lock:
+            cache[(_current_account.get(), key)] = (time.monotonic() + self.cache_ttl, value)
+
+    def _resolve_env_var_names(self,
+                               env_var_names: List[EnvVarName]) -> Dict[EnvVarName, FieldValue]:
+        found: Dict[EnvVarName, FieldValue] = {}
+        missing: List[EnvVarName] = []
+        for env_var_name in _uniqify(env_var_names):
+            value = self._cached(self._value_cache, env_var_name, 'values')
+            if value is None:
+                missing.append(env_var_name)
+            else:
+                found[env_var_name] = value
+        for env_var_name, value in self.backend.env_lookups(missing,
+                                                            self.field_mapping).items():
+            self._store(self._value_cache, env_var_name, value)
+            found[env_var_name] = value
+        return {env_var_name: found[env_var_name] for env_var_name in _uniqify(env_var_names)}
+
+    def _resolve_title(self, title: Title) -> Dict[EnvVarName, FieldValue]:
+        fields_by_env_name = self._cached(self._title_cache, title, 'titles')
+        if fields_by_env_name is None:
+            fields_by_env_name = self.backend.title_lookups(title, self.field_mapping)
+            self._store(self._title_cache, title, fields_by_env_name)
+        return fields_by_env_name
+
+    def _resolve_titles(self, titles: List[Title]) -> Dict[EnvVarName, FieldValue]:
+        if len(titles) <= 1 or getattr(self._local, 'in_worker', False):
+            # Don't wait on the pool from inside the pool, or
+            # resolve_async() callers could deadlock it.
+            results = [self._resolve_title(title) for title in titles]
+        else:
+            executor = self._get_executor()
+            futures = [_submit(executor, self._resolve_title, title) for title in titles]
+            results = [future.result() for future in futures]
+        title_lookups: Dict[EnvVarName, FieldValue] = {}
+        for fields_by_env_name in results:
+            title_lookups.update(fields_by_env_name)
+        return title_lookups
+
+    def resolve(self,
+                env_var_names: List[EnvVarName],
+                titles: List[Title],
+                timeout: Optional[float] = None,
+                per_call_timeout: Optional[float] = None) -> Dict[EnvVarName, FieldValue]:
+        """Look up env_var_names and titles.
+
+        If timeout is given, op calls are killed and
+        TimeoutOPLookupError is raised once that many seconds have been
+        spent in total; per_call_timeout limits each op call.
+        """
+        with metrics.observing(self.observer), deadline(timeout, per_call_timeout):
+            env_lookups = self._resolve_env_var_names(env_var_names)
+            title_lookups = self._resolve_titles(titles)
+        return {**env_lookups, **title_lookups}
+
+    def resolve_tag_prefixes_partial(self,
+                                     tag_prefixes: List[str],
+                                     timeout: Optional[float] = None,
+                                     per_call_timeout: Optional[float] = None) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        """Look up every tag starting with one of tag_prefixes ('' for every tag).
+
+        Items are listed once, whatever the number of tags found, and
+        the values found are cached for later resolve() calls.
+        """
+        with metrics.observing(self.observer), deadline(timeout, per_call_timeout):
+            values, errors = self.backend.tag_prefix_lookups_partial(tag_prefixes,
+                                                                     self.field_mapping)
+        for env_var_name, value in values.items():
+            self._store(self._value_cache, env_var_name, value)
+        return values, errors
+
+    def resolve_tag_prefixes(self,
+                             tag_prefixes: List[str],
+                             timeout: Optional[float] = None,
+                             per_call_timeout: Optional[float] = None) -> \
+            Dict[EnvVarName, FieldValue]:
+        values, errors = self.resolve_tag_prefixes_partial(tag_prefixes,
+                                                           timeout, per_call_timeout)
+        if errors:
+            raise next(iter(errors.values()))
+        return values
+
+    def _resolve_title_partial(self, title: Title) -> Tuple[Dict[EnvVarName, FieldValue],
+                                                            Optional[Exception]]:
+        fields_by_env_name = self._cached(self._title_cache, title, 'titles')
+        if fields_by_env_name is not None:
+            return fields_by_env_name, None
+        fields_by_env_name, error = self.backend.title_lookups_partial(title,
+                                                                       self.field_mapping)
+        if error is None:
+            self._store(self._title_cache, title, fields_by_env_name)
+        return fields_by_env_name, error
+
+    def resolve_partial(self,
+                        env_var_names: List[EnvVarName],
+                        titles: List[Title],
+                        timeout: Optional[float] = None,
+                        per_call_timeout: Optional[float] = None) -> PartialLookupResult:
+        """Look up everything possible, collecting failures instead of raising them.
+
+        Missing and duplicate tags, empty fields and unreadable items
+        are all reported in the result, in one pass.
+        """
+        with metrics.observing(self.observer), deadline(timeout, per_call_timeout):
+            env_lookups: Dict[EnvVarName, FieldValue] = {}
+            missing: List[EnvVarName] = []
+            for env_var_name in _uniqify(env_var_names):
+                value = self._cached(self._value_cache, env_var_name, 'values')
+                if value is None:
+                    missing.append(env_var_name)
+                else:
+                    env_lookups[env_var_name] = value
+            found, env_var_errors = self.backend.env_lookups_partial(missing, self.field_mapping)
+            for env_var_name, value in found.items():
+                self._store(self._value_cache, env_var_name, value)
+            env_lookups.update(found)
+            if len(titles) <= 1 or getattr(self._local, 'in_worker', False):
+                title_results = [self._resolve_title_partial(title) for title in titles]
+            else:
+                executor = self._get_executor()
+                futures = [_submit(executor, self._resolve_title_partial, title)
+                           for title in titles]
+                title_results = [future.result() for future in futures]
+        title_lookups: Dict[EnvVarName, FieldValue] = {}
+        title_errors: Dict[Title, Exception] = {}
+        for title, (fields_by_env_name, error) in zip(titles, title_results):
+            title_lookups.update(fields_by_env_name)
+            if error is not None:
+                title_errors[title] = error
+        return PartialLookupResult(values={
+                                       **{env_var_name: env_lookups[env_var_name]
+                                          for env_var_name in _uniqify(env_var_names)
+                                          if env_var_name in env_lookups},
+                                       **title_lookups,
+                                   },
+                                   env_var_errors=env_var_errors,
+                                   title_errors=title_errors)
+
+    def _in_account(self,
+                    shorthand: Optional[str],
+                    in_worker: bool,
+                    fn: Callable[..., T],
+                    *args: Any) -> T:
+        self._local.in_worker = in_worker
+        try:
+            with account(shorthand):
+                return fn(*args)
+        finally:
+            self._local.in_worker = False
+
+    def _fan_out(self,
+                 lookups: Mapping[Optional[str], AccountLookup],
+                 fn: Callable[[AccountLookup], T]) -> List[Tuple[Optional[str], T]]:
+        """Call fn with each account's lookup, in that account, all at once.
+
+        Each account gets its own thread rather than a slot in the
+        worker pool, so adding an account doesn't queue behind others.
+        """
+        in_worker = getattr(self._local, 'in_worker', False)
+        if len(lookups) <= 1:
+            return [(shorthand, self._in_account(shorthand, in_worker, fn, lookup))
+                    for shorthand, lookup in lookups.items()]
+        with ThreadPoolExecutor(max_workers=len(lookups),
+                                thread_name_prefix='op-env-account') as executor:
+            futures = [(shorthand,
+                        _submit(executor, self._in_account, shorthand, in_worker, fn, lookup))
+                       for shorthand, lookup in lookups.items()]
+            return [(shorthand, future.result()) for shorthand, future in futures]
+
+    def _resolve_lookup(self, lookup: AccountLookup) -> Dict[EnvVarName, FieldValue]:
+        return {
+            **self._resolve_env_var_names(lookup.env_var_names),
+            **self._resolve_titles(lookup.titles),
+        }
+
+    def resolve_accounts(self,
+                         lookups: Mapping[Optional[str], AccountLookup],
+                         timeout: Optional[float] = None,
+                         per_call_timeout: Optional[float] = None) -> \
+            Dict[EnvVarName, FieldValue]:
+        """Look up names and titles in several accounts in parallel, merging the results.
+
+        Keys are op account shorthands, or None for op's default
+        account.  ConflictingValuesOPLookupError is raised if two
+        accounts give different values for the same env var name.
+        """
+        with metrics.observing(self.observer), deadline(timeout, per_call_timeout):
+            results = self._fan_out(lookups, self._resolve_lookup)
+        return _merge_account_values(results)
+
+    def resolve_partial_accounts(self,
+                                 lookups: Mapping[Optional[str], AccountLookup],
+                                 timeout: Optional[float] = None,
+                                 per_call_timeout: Optional[float] = None) -> \
+            PartialLookupResult:
+        """Like resolve_accounts(), but collecting failures and conflicts instead of raising.
+
+        Failures outside op's default account are keyed ACCOUNT:NAME
+        or ACCOUNT:TITLE, so it's clear which account they came from.
+        """
+        with metrics.observing(self.observer), deadline(timeout, per_call_timeout):
+            results = self._fan_out(lookups,
+                                    lambda lookup: self.resolve_partial(lookup.env_var_names,
+                                                                        lookup.titles))
+        env_var_errors: Dict[EnvVarName, Exception] = {}
+        title_errors: Dict[Title, Exception] = {}
+        for shorthand, result in results:
+            for env_var_name, error in result.env_var_errors.items():
+                env_var_errors[env_var_name if shorthand is None
+                               else EnvVarName(f'{shorthand}:{env_var_name}')] = error
+            for title, error in result.title_errors.items():
+                title_errors[title if shorthand is None else Title(f'{shorthand}:{title}')] = \
+                    error
+        values = _merge_account_values([(shorthand, result.values)
+                                        for shorthand, result in results],
+                                       conflicts=env_var_errors)
+        return PartialLookupResult(values=values,
+                                   env_var_errors=env_var_errors,
+                                   title_errors=title_errors)
+
+    def _resolve_in_worker(self,
+                           env_var_names: List[EnvVarName],
+                           titles: List[Title],
+                           timeout: Optional[float],
+                           per_call_timeout: Optional[float]) -> Dict[EnvVarName, FieldValue]:
+        self._local.in_worker = True
+        try:
+            return self.resolve(env_var_names, titles, timeout, per_call_timeout)
+        finally:
+            self._local.in_worker = False
+
+    def resolve_async(self,
+                      env_var_names: List[EnvVarName],
+                      titles: List[Title],
+                      timeout: Optional[float] = None,
+                      per_call_timeout: Optional[float] = None) -> \
+            'Future[Dict[EnvVarName, FieldValue]]':
+        return _submit(self._get_executor(), self._resolve_in_worker,
+                       env_var_names, titles, timeout, per_call_timeout)
+
+    def prefetch(self,
+                 env_var_names: List[EnvVarName],
+                 titles: Optional[List[Title]] = None) -> 'Future[Dict[EnvVarName, FieldValue]]':
+        "Warm the cache in the background so later resolve() calls return immediately"
+        return self.resolve_async(env_var_names, titles or [])
+
+
+def _account_lookups(env_var_names: List[EnvVarName],
+                     titles: List[Title],
+                     accounts: Mapping[str, AccountLookup]) -> \
+        Dict[Optional[str], AccountLookup]:
+    lookups: Dict[Optional[str], AccountLookup] = {}
+    if env_var_names or titles:
+        lookups[None] = AccountLookup(env_var_names=env_var_names, titles=titles)
+    lookups.update(accounts)
+    return lookups
+
+
+def _guarded_backend(name: Optional[str], breaker: Optional['CircuitBreaker']) -> OpBackend:
+    backend = select_backend(name)
+    if breaker is None:
+        return backend
+    from .breaker import CircuitBreakerBackend
+
+    return CircuitBreakerBackend(backend, breaker)
+
+
 def do_lookups(env_var_names: List[EnvVarName],
-               titles: List[Title]) -> Dict[EnvVarName, FieldValue]:
-    env_lookups = _do_env_lookups(env_var_names)
-    title_lookups = _do_title_lookups(titles)
-    return {**env_lookups, **title_lookups}
+               titles: List[Title],
+               field_mapping: Optional[FieldMapping] = None,
+               timeout: Optional[float] = None,
+               per_call_timeout: Optional[float] = None,
+               backend: Optional[str] = None,
+               accounts: Optional[Mapping[str, AccountLookup]] = None,
+               breaker: Optional['CircuitBreaker'] = None,
+               tag_prefixes: Optional[List[str]] = None,
+               item_cache: Optional['ItemVersionCache'] = None) -> \
+        Dict[EnvVarName, FieldValue]:
+    """Look up env_var_names and titles in op's default account.
+
+    Anything in accounts is looked up in that account at the same time.
+    With a breaker, lookups fail fast while it is open.  Every tag
+    starting with one of tag_prefixes is looked up too.  With an
+    item_cache, fields of tagged items are only fetched if the items
+    have changed since they were cached.
+    """
+    from .item_cache import caching_items
+
+    with Resolver(field_mapping=field_mapping,
+                  backend=_guarded_backend(backend, breaker)) as resolver, \
+            deadline(timeout, per_call_timeout), caching_items(item_cache):
+        discovered = resolver.resolve_tag_prefixes(tag_prefixes) if tag_prefixes else {}
+        if accounts:
+            values = resolver.resolve_accounts(_account_lookups(env_var_names, titles, accounts))
+        else:
+            values = resolver.resolve(env_var_names, titles)
+        return {**discovered, **values}
+
+
+def do_partial_lookups(env_var_names: List[EnvVarName],
+                       titles: List[Title],
+                       field_mapping: Optional[FieldMapping] = None,
+                       timeout: Optional[float] = None,
+                       per_call_timeout: Optional[float] = None,
+                       backend: Optional[str] = None,
+                       accounts: Optional[Mapping[str, AccountLookup]] = None,
+                       breaker: Optional['CircuitBreaker'] = None,
+                       tag_prefixes: Optional[List[str]] = None,
+                       item_cache: Optional['ItemVersionCache'] = None) -> \
+        PartialLookupResult:
+    from .item_cache import caching_items
+
+    with Resolver(field_mapping=field_mapping,
+                  backend=_guarded_backend(backend, breaker)) as resolver, \
+            deadline(timeout, per_call_timeout), caching_items(item_cache):
+        discovered: Dict[EnvVarName, FieldValue] = {}
+        discovery_errors: Dict[EnvVarName, Exception] = {}
+        if tag_prefixes:
+            discovered, discovery_errors = resolver.resolve_tag_prefixes_partial(tag_prefixes)
+        if accounts:
+            result = resolver.resolve_partial_accounts(_account_lookups(env_var_names, titles,
+                                                                        accounts))
+        else:
+            result = resolver.resolve_partial(env_var_names, titles)
+        return PartialLookupResult(values={**discovered, **result.values},
+                                   env_var_errors={**discovery_errors, **result.env_var_errors},
+                                   title_errors=result.title_errors)
+
+
+def iter_partial_lookups(env_var_names: List[EnvVarName],
+                         titles: List[Title],
+                         field_mapping: Optional[FieldMapping] = None,
+                         timeout: Optional[float] = None,
+                         per_call_timeout: Optional[float] = None,
+                         backend: Optional[str] = None,
+                         accounts: Optional[Mapping[str, AccountLookup]] = None,
+                         breaker: Optional['CircuitBreaker'] = None,
+                         tag_prefixes: Optional[List[str]] = None,
+                         item_cache: Optional['ItemVersionCache'] = None) -> \
+        Iterator[PartialLookupResult]:
+    """Like do_partial_lookups(), but yielding each part of the result as soon as it's ready.
+
+    The tagged names in each account, each title and the tag prefixes
+    are looked up in parallel on the resolver's worker pool, and their
+    results are yielded in the order they finish.  A name is yielded
+    again only if a part finishing later changes what
+    do_partial_lookups() would give for it (a title overriding a tag,
+    or another account's value conflicting with it), so the last value
+    or conflict error yielded for each name matches its result.
+    """
+    from .item_cache import caching_items
+
+    lookups = _account_lookups(env_var_names, titles, accounts or {})
+    # what each part found, by account and then by how much it takes
+    # precedence within the account
+    found: Dict[Optional[str], Dict[int, Dict[EnvVarName, FieldValue]]] = {
+        shorthand: {} for shorthand in lookups
+    }
+    discovered: Dict[EnvVarName, FieldValue] = {}
+    yielded: Dict[EnvVarName, Union[FieldValue, Exception]] = {}
+
+    def current(env_var_name: EnvVarName) -> Optional[Union[FieldValue, Exception]]:
+        account_values: List[Tuple[Optional[str], FieldValue]] = []
+        for shorthand, by_precedence in found.items():
+            ranked = [values[env_var_name] for _, values in sorted(by_precedence.items())
+                      if env_var_name in values]
+            if ranked:
+                account_values.append((shorthand, ranked[-1]))
+        if not account_values:
+            return discovered.get(env_var_name)
+        first_shorthand, first_value = account_values[0]
+        for shorthand, value in account_values[1:]:
+            if value != first_value:
+                return ConflictingValuesOPLookupError(
+                    f'{env_var_name} has different values in '
+                    f'{_account_label(first_shorthand)} and {_account_label(shorthand)}')
+        return first_value
+
+    with Resolver(field_mapping=field_mapping,
+                  backend=_guarded_backend(backend, breaker)) as resolver, \
+            deadline(timeout, per_call_timeout), caching_items(item_cache):
+        executor = resolver._get_executor()
+        # each part is (account, precedence), with tag prefixes as (None, None)
+        futures: Dict['Future[PartialLookupResult]', Tuple[Optional[str], Optional[int]]] = {}
+        if tag_prefixes:
+            futures[_submit(executor, resolver._in_account, None, True,
+                            _partial_tag_prefix_lookups, resolver, tag_prefixes)] = (None, None)
+        for shorthand, lookup in lookups.items():
+            if lookup.env_var_names:
+                futures[_submit(executor, resolver._in_account, shorthand, True,
+                                resolver.resolve_partial, lookup.env_var_names, [])] = \
+                    (shorthand, 0)
+            for precedence, title in enumerate(lookup.titles, start=1):
+                futures[_submit(executor, resolver._in_account, shorthand, True,
+                                resolver.resolve_partial, [], [title])] = (shorthand, precedence)
+        for future in as_completed(futures):
+            shorthand, part_precedence = futures[future]
+            result = future.result()
+            if part_precedence is None:
+                discovered.update(result.values)
+            else:
+                found[shorthand][part_precedence] = result.values
+            values: Dict[EnvVarName, FieldValue] = {}
+            env_var_errors: Dict[EnvVarName, Exception] = {
+                env_var_name if shorthand is None else EnvVarName(f'{shorthand}:{env_var_name}'):
+                error
+                for env_var_name, error in result.env_var_errors.items()
+            }
+            for env_var_name in result.values:
+                now = current(env_var_name)
+                previous = yielded.get(env_var_name)
+                if now is None or now == previous or \
+                        (isinstance(now, Exception) and isinstance(previous, Exception) and
+                         str(now) == str(previous)):
+                    continue
+                yielded[env_var_name] = now
+                if isinstance(now, Exception):
+                    env_var_errors[env_var_name] = now
+                else:
+                    values[env_var_name] = now
+            yield PartialLookupResult(values=values,
+                                      env_var_errors=env_var_errors,
+                                      title_errors={
+                                          title if shorthand is None
+                                          else Title(f'{shorthand}:{title}'): error
+                                          for title, error in result.title_errors.items()
+                                      })
+
+
+def _partial_tag_prefix_lookups(resolver: Resolver,
+                                tag_prefixes: List[str]) -> PartialLookupResult:
+    values, errors = resolver.resolve_tag_prefixes_partial(tag_prefixes)
+    return PartialLookupResult(values=values, env_var_errors=errors, title_errors={})
@@ -0,0 +1,317 @@
+"""Lookups through the 'op item' and 'op inject' commands of 1Password CLI 2.x.
+
+Tagged env var names cost one 'op item list' and one 'op item get'
+call, no matter how many there are.  Names mapped to a field of an item
+in a specific vault are resolved together through a single 'op inject'
+template of secret references.
+"""
+import json
+from typing import Any, Dict, List, Optional, Tuple, Union
+import uuid
+
+from pydantic import BaseModel
+
+from . import metrics
+from .op import (_current_item_cache, _group_by_item, _index_list_items, _is_item_uuid,
+                 _op_check_output, _op_pluck_fields_partial, _tags_with_prefixes,
+                 _title_values_partial, _validate_env_var_names, CalledProcessError,
+                 CollectingOpBackend, EnvVarName, FieldMapping, FieldName, FieldReference,
+                 FieldValue, InvalidTagOPLookupError, NoEntriesOPLookupError, OPLookupError,
+                 Title, UnreadableItemOPLookupError)
+
+
+class OpV2Vault(BaseModel):
+    id: str
+    name: Optional[str] = None
+
+
+class OpV2Field(BaseModel):
+    id: FieldName
+    label: Optional[FieldName] = None
+    value: Optional[FieldValue] = None
+
+
+class OpV2Item(BaseModel):
+    id: str
+    title: Optional[str] = None
+    tags: List[EnvVarName] = []
+    vault: Optional[OpV2Vault] = None
+    fields: List[OpV2Field] = []
+
+    class Config:
+        # Fed back to 'op item get -', so keep everything op gave us
+        extra = 'allow'
+
+    def field_values(self) -> Dict[FieldName, FieldValue]:
+        "Field values by id, and by label where there is one"
+        values: Dict[FieldName, FieldValue] = {}
+        for field in self.fields:
+            if field.value is not None:
+                values[field.id] = field.value
+        for field in self.fields:
+            if field.value is not None and field.label:
+                values[field.label] = field.value
+        return values
+
+
+def _item_tags(item: OpV2Item) -> List[EnvVarName]:
+    return item.tags
+
+
+def _parse_items(output: bytes) -> List[OpV2Item]:
+    "Parse one or more JSON documents, each an item or a list of items"
+    decoder = json.JSONDecoder()
+    text = output.decode('utf-8')
+    items: List[OpV2Item] = []
+    pos = 0
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos == len(text):
+            return items
+        doc, pos = decoder.raw_decode(text, pos)
+        for entry in doc if isinstance(doc, list) else [doc]:
+            items.append(OpV2Item(**entry))
+
+
+def _op_item_list(env_var_names: Optional[List[EnvVarName]]) -> List[OpV2Item]:
+    "Items tagged with any of env_var_names, or every item if that's None"
+    list_command = ['op', 'item', 'list']
+    if env_var_names is not None:
+        list_command += ['--tags', ','.join(env_var_names)]
+    list_command += ['--format', 'json']
+    output = _op_check_output(list_command, phase='list')
+    with metrics.parsing('list_items', len(output)):
+        return _parse_items(output)
+
+
+def _op_item_get_all(items: List[OpV2Item]) -> Dict[str, OpV2Item]:
+    """Fetch the full contents of items found by 'op item list' in one call, by id.
+
+    With an item cache, only items changed since they were cached are
+    fetched.
+    """
+    cache = _current_item_cache.get()
+    listed = [item.dict(exclude_none=True) for item in items]
+    cached: Dict[int, Dict[str, Any]] = {}
+    to_fetch = list(range(len(listed)))
+    if cache is not None:
+        cached, to_fetch = cache.split(listed)
+    items_by_id = {listed[position]['id']: OpV2Item(**doc) for position, doc in cached.items()}
+    if not to_fetch:
+        return items_by_id
+    input = json.dumps([listed[position] for position in to_fetch]).encode('utf-8')
+    output = _op_check_output(['op', 'item', 'get', '-', '--format', 'json'],
+                              input=input, phase='get')
+    with metrics.parsing('get_fields', len(output)):
+        fetched = {item.id: item for item in _parse_items(output)}
+    if cache is not None:
+        for position in to_fetch:
+            item = fetched.get(listed[position]['id'])
+            if item is not None:
+                cache.put(listed[position], None, item.dict(exclude_none=True))
+    items_by_id.update(fetched)
+    return items_by_id
+
+
+def _op_item_get(item: str, vault: Optional[str]) -> OpV2Item:
+    get_command = ['op', 'item', 'get', item, '--format', 'json']
+    if vault is not None:
+        get_command += ['--vault', vault]
+    output = _op_check_output(get_command, phase='item')
+    with metrics.parsing('get_item_fields', len(output)):
+        return _parse_items(output)[0]
+
+
+def _secret_reference(field_reference: FieldReference) -> str:
+    return f'op://{field_reference.vault}/{field_reference.item}/{field_reference.field}'
+
+
+def _op_inject(references: Dict[EnvVarName, str]) -> Dict[EnvVarName, FieldValue]:
+    "Resolve every secret reference with a single 'op inject' call"
+    # Values may contain anything but this, so use it to split them apart
+    boundary = f'op-env-{uuid.uuid4().hex}'
+    template = ''.join(f'{boundary} {env_var_name}\n{{{{ {reference} }}}}\n'
+                       for env_var_name, reference in references.items())
+    output = _op_check_output(['op', 'inject'], input=template.encode('utf-8'), phase='inject')
+    with metrics.parsing('inject', len(output)):
+        values: Dict[EnvVarName, FieldValue] = {}
+        for chunk in output.decode('utf-8').split(f'{boundary} ')[1:]:
+            env_var_name, _, value = chunk.partition('\n')
+            values[EnvVarName(env_var_name)] = FieldValue(value[:-1])
+        return values
+
+
+def _unreadable(what: str, e: CalledProcessError) -> OPLookupError:
+    return UnreadableItemOPLookupError(f'Could not read 1Password item {what}: '
+                                       f'op exited with status {e.returncode}')
+
+
+def _do_tagged_lookups(env_var_names: List[EnvVarName],
+                       field_mapping: FieldMapping,
+                       values: Dict[EnvVarName, FieldValue],
+                       errors: Dict[EnvVarName, Exception],
+                       listed: Optional[List[OpV2Item]] = None) -> None:
+    "Look up tagged env_var_names, in listed if given rather than listing items again"
+    if listed is None:
+        listed = _op_item_list(env_var_names)
+    by_env_var_name, list_errors = _index_list_items(listed, env_var_names, _item_tags)
+    errors.update({
+        env_var_name: list_errors[env_var_name]
+        for env_var_name in env_var_names
+        if env_var_name in list_errors
+    })
+    found = [env_var_name for env_var_name in env_var_names if env_var_name in by_env_var_name]
+    if not found:
+        return
+    items = list({by_env_var_name[env_var_name].id: by_env_var_name[env_var_name]
+                  for env_var_name in found}.values())
+    items_by_id = _op_item_get_all(items)
+    for env_var_name in found:
+        item = items_by_id.get(by_env_var_name[env_var_name].id)
+        if item is None:
+            errors[env_var_name] = NoEntriesOPLookupError('1Password entry with tag '
+                                                          f'{env_var_name} could not be read')
+            continue
+        _op_pluck_fields_partial([env_var_name], {env_var_name: item.field_values()},
+                                 field_mapping, values, errors)
+
+
+def _do_injected_lookups(env_var_names: List[EnvVarName],
+                         field_mapping: FieldMapping,
+                         values: Dict[EnvVarName, FieldValue],
+                         errors: Dict[EnvVarName, Exception]) -> None:
+    references = {
+        env_var_name: _secret_reference(field_mapping[env_var_name])
+        for env_var_name in env_var_names
+    }
+    try:
+        injected = _op_inject(references)
+    except CalledProcessError as e:
+        for env_var_name in env_var_names:
+            errors[env_var_name] = UnreadableItemOPLookupError(
+                f'Could not read {references[env_var_name]}: '
+                f'op exited with status {e.returncode}')
+        return
+    for env_var_name in env_var_names:
+        field = field_mapping[env_var_name].field
+        assert field is not None
+        _op_pluck_fields_partial([env_var_name],
+                                 {env_var_name: {field: injected.get(env_var_name,
+                                                                     FieldValue(''))}},
+                                 field_mapping, values, errors)
+
+
+def _do_item_lookups(env_var_names: List[EnvVarName],
+                     field_mapping: FieldMapping,
+                     values: Dict[EnvVarName, FieldValue],
+                     errors: Dict[EnvVarName, Exception]) -> None:
+    by_item = _group_by_item(env_var_names, field_mapping)
+    fetched: Dict[Tuple[str, Optional[str]], Union[OpV2Item, CalledProcessError]] = {}
+    # Items given by uuid alone can all be fetched with one 'op item get -'
+    batched = [key for key in by_item if key[1] is None and _is_item_uuid(key[0])]
+    if len(batched) > 1:
+        try:
+            items_by_id = _op_item_get_all([OpV2Item(id=item) for item, _ in batched])
+        except CalledProcessError as e:
+            fetched.update({key: e for key in batched})
+        else:
+            fetched.update({key: items_by_id[key[0]]
+                            for key in batched if key[0] in items_by_id})
+    for item, vault in by_item:
+        if (item, vault) not in fetched:
+            try:
+                fetched[(item, vault)] = _op_item_get(item, vault)
+            except CalledProcessError as e:
+                fetched[(item, vault)] = e
+    for (item, vault), item_env_var_names in by_item.items():
+        result = fetched[(item, vault)]
+        if isinstance(result, CalledProcessError):
+            for env_var_name in item_env_var_names:
+                errors[env_var_name] = _unreadable(item, result)
+            continue
+        _op_pluck_fields_partial(item_env_var_names,
+                                 dict.fromkeys(item_env_var_names, result.field_values()),
+                                 field_mapping, values, errors)
+
+
+def _is_injectable(field_reference: FieldReference) -> bool:
+    # 'op inject' needs to be told exactly where to look
+    return (field_reference.item is not None and
+            field_reference.vault is not None and
+            field_reference.field is not None)
+
+
+def _do_env_lookups_partial(env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping = {}) -> \
+        Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+    values: Dict[EnvVarName, FieldValue] = {}
+    errors: Dict[EnvVarName, Exception] = {}
+    tagged: List[EnvVarName] = []
+    injectable: List[EnvVarName] = []
+    by_item: List[EnvVarName] = []
+    for env_var_name in env_var_names:
+        try:
+            _validate_env_var_names([env_var_name])
+        except InvalidTagOPLookupError as e:
+            errors[env_var_name] = e
+            continue
+        field_reference = field_mapping.get(env_var_name, FieldReference(None))
+        if field_reference.item is None:
+            tagged.append(env_var_name)
+        elif _is_injectable(field_reference):
+            injectable.append(env_var_name)
+        else:
+            by_item.append(env_var_name)
+    if tagged:
+        _do_tagged_lookups(tagged, field_mapping, values, errors)
+    if injectable:
+        _do_injected_lookups(injectable, field_mapping, values, errors)
+    if by_item:
+        _do_item_lookups(by_item, field_mapping, values, errors)
+    return values, errors
+
+
+def _do_tag_prefix_lookups_partial(tag_prefixes: List[str],
+                                   field_mapping: FieldMapping = {}) -> \
+        Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+    "Look up every tag starting with one of tag_prefixes, listing items only once"
+    listed = _op_item_list(None)
+    values: Dict[EnvVarName, FieldValue] = {}
+    errors: Dict[EnvVarName, Exception] = {}
+    env_var_names = _tags_with_prefixes(listed, tag_prefixes, _item_tags)
+    if env_var_names:
+        _do_tagged_lookups(env_var_names, field_mapping, values, errors, listed)
+    return values, errors
+
+
+def _fields_from_title_partial(title: Title,
+                               field_mapping: FieldMapping = {}) -> \
+        Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+    try:
+        item = _op_item_get(title, None)
+    except CalledProcessError as e:
+        return {}, _unreadable(title, e)
+    return _title_values_partial(item.tags, item.field_values(), field_mapping)
+
+
+class OpV2Backend(CollectingOpBackend):
+    "The 'op item' and 'op inject' commands of 1Password CLI 2.x"
+
+    def env_lookups_partial(self,
+                            env_var_names: List[EnvVarName],
+                            field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        return _do_env_lookups_partial(env_var_names, field_mapping)
+
+    def title_lookups_partial(self,
+                              title: Title,
+                              field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Optional[Exception]]:
+        return _fields_from_title_partial(title, field_mapping)
+
+    def tag_prefix_lookups_partial(self,
+                                   tag_prefixes: List[str],
+                                   field_mapping: FieldMapping) -> \
+            Tuple[Dict[EnvVarName, FieldValue], Dict[EnvVarName, Exception]]:
+        return _do_tag_prefix_lookups_partial(tag_prefixes, field_mapping)
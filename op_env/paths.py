@@ -0,0 +1,32 @@
+"""Where op-env keeps its files.
+
+Kept free of heavy imports, so that shell completion can use it.
+"""
+import os
+import tempfile
+
+
+def _xdg_dir(env_var: str, default: str) -> str:
+    return os.path.join(os.environ.get(env_var) or os.path.expanduser(default), 'op-env')
+
+
+def default_cache_dir() -> str:
+    return os.environ.get('OP_ENV_CACHE_DIR') or _xdg_dir('XDG_CACHE_HOME', '~/.cache')
+
+
+def default_key_file() -> str:
+    return os.path.join(_xdg_dir('XDG_CONFIG_HOME', '~/.config'), 'store.key')
+
+
+def _write_private_file(path: str, contents: bytes) -> None:
+    "Atomically replace path with contents, readable only by the current user"
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
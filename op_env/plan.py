@@ -0,0 +1,390 @@
+"""Dry runs of lookups: the op calls a lookup would make, without making them."""
+import json
+import os
+import time
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, Set
+
+from .op import (_account_label, _field_batches, _group_by_item, _is_item_uuid,
+                 _op_fields_to_seek, _op_fields_to_try, _validate_env_var_names,
+                 AccountLookup, EnvVarName, FieldMapping, FieldName, FieldReference,
+                 InvalidTagOPLookupError, OpItemOverview, OpListItemsEntry, Resolver, Title)
+from .store import describe_age
+
+# Length of the boundary op_env.op_v2 puts between values in an
+# 'op inject' template
+INJECT_BOUNDARY_LENGTH = len('op-env-') + 32
+
+# Added to the calls an item cache can skip
+ITEM_CACHE_NOTE = ', skipping items unchanged since they were cached (and the call, if all are)'
+
+
+class PlannedCall(NamedTuple):
+    "One op command (or Connect HTTP request) a lookup would make"
+    argv: List[str]
+    purpose: str
+    # size of what is piped into the command, where it's known up front
+    stdin_bytes: Optional[int] = None
+    # what is piped in, where the size isn't known until earlier calls run
+    stdin_from: Optional[str] = None
+
+    @property
+    def argv_bytes(self) -> int:
+        return sum(len(arg.encode('utf-8')) + 1 for arg in self.argv)
+
+
+class LookupPlan(NamedTuple):
+    "The calls one account's share of a lookup would make"
+    backend: str
+    account: Optional[str]
+    calls: List[PlannedCall]
+    # candidate fields in the order they would be tried
+    fields_to_try: Dict[EnvVarName, List[FieldName]]
+    # names which would fail before any call is made
+    problems: Dict[EnvVarName, str]
+    # whether those failures would stop the whole lookup
+    stopped: bool = False
+    # names and titles a Resolver already holds, so wouldn't look up
+    cached: Sequence[str] = ()
+
+    @property
+    def op_processes(self) -> int:
+        return sum(1 for call in self.calls if call.argv[0] == 'op')
+
+
+def _plural(count: int, noun: str, plural: Optional[str] = None) -> str:
+    return f'{count} {noun}' if count == 1 else f'{count} {plural or noun + "s"}'
+
+
+def _fields_to_try(env_var_name: EnvVarName, field_mapping: FieldMapping) -> List[FieldName]:
+    field_reference = field_mapping.get(env_var_name, FieldReference(None))
+    if field_reference.field is not None:
+        return [field_reference.field]
+    return _op_fields_to_try(env_var_name)
+
+
+def _plan_v1(tagged: List[EnvVarName],
+             by_item: Mapping[EnvVarName, FieldReference],
+             titles: List[Title],
+             field_mapping: FieldMapping) -> List[PlannedCall]:
+    calls: List[PlannedCall] = []
+    if tagged:
+        calls.append(PlannedCall(['op', 'list', 'items', '--tags', ','.join(tagged)],
+                                 f'find the items tagged with {_plural(len(tagged), "name")}'))
+        # split the same way as the lookup, so long field lists take
+        # more than one call
+        batches = _field_batches(tagged, field_mapping)
+        for number, (batch, batch_fields) in enumerate(batches, start=1):
+            purpose = 'read the fields of every tagged item'
+            if len(batches) > 1:
+                purpose = (f'read the fields of {_plural(len(batch), "tagged item")} '
+                           f'(part {number} of {len(batches)}, to keep --fields short enough)')
+            calls.append(PlannedCall(['op', 'get', 'item', '-', '--fields',
+                                      ','.join(sorted(batch_fields))],
+                                     purpose,
+                                     stdin_from=f"the 'op list items' output for "
+                                     f'{_plural(len(batch), "item")}'))
+    grouped = _group_by_item(list(by_item), field_mapping)
+    batched = [key for key in grouped if key[1] is None and _is_item_uuid(key[0])]
+    if len(batched) > 1:
+        fields_to_seek: Set[FieldName] = set()
+        for key in batched:
+            fields_to_seek |= _op_fields_to_seek(grouped[key], field_mapping)
+        stdin = json.dumps([OpListItemsEntry(uuid=item, overview=OpItemOverview(tags=[])).dict()
+                            for item, _ in batched]).encode('utf-8')
+        calls.append(PlannedCall(['op', 'get', 'item', '-', '--fields',
+                                  ','.join(sorted(fields_to_seek))],
+                                 f'read the fields of {len(batched)} items given by uuid',
+                                 stdin_bytes=len(stdin)))
+    else:
+        batched = []
+    for (item, vault), item_env_var_names in grouped.items():
+        if (item, vault) in batched:
+            continue
+        argv = ['op', 'get', 'item', item, '--fields',
+                ','.join(sorted(_op_fields_to_seek(item_env_var_names, field_mapping)))]
+        if vault is not None:
+            argv += ['--vault', vault]
+        calls.append(PlannedCall(argv, f'read {", ".join(item_env_var_names)}'))
+    for title in titles:
+        calls.append(PlannedCall(['op', 'get', 'item', title],
+                                 f'read every tagged field of {title}'))
+    return calls
+
+
+def _plan_v2(tagged: List[EnvVarName],
+             by_item: Mapping[EnvVarName, FieldReference],
+             titles: List[Title],
+             field_mapping: FieldMapping) -> List[PlannedCall]:
+    from .op_v2 import _is_injectable, _secret_reference, OpV2Item
+
+    calls: List[PlannedCall] = []
+    if tagged:
+        calls.append(PlannedCall(['op', 'item', 'list', '--tags', ','.join(tagged),
+                                  '--format', 'json'],
+                                 f'find the items tagged with {_plural(len(tagged), "name")}'))
+        calls.append(PlannedCall(['op', 'item', 'get', '-', '--format', 'json'],
+                                 'read every tagged item',
+                                 stdin_from=f"the 'op item list' output for "
+                                 f'{_plural(len(tagged), "item")}'))
+    injectable = [env_var_name for env_var_name in by_item
+                  if _is_injectable(by_item[env_var_name])]
+    if injectable:
+        template = ''.join(f'{"-" * INJECT_BOUNDARY_LENGTH} {env_var_name}\n'
+                           f'{{{{ {_secret_reference(by_item[env_var_name])} }}}}\n'
+                           for env_var_name in injectable)
+        calls.append(PlannedCall(['op', 'inject'],
+                                 f'read {_plural(len(injectable), "op:// reference")}',
+                                 stdin_bytes=len(template.encode('utf-8'))))
+    grouped = _group_by_item([env_var_name for env_var_name in by_item
+                              if env_var_name not in injectable], field_mapping)
+    batched = [key for key in grouped if key[1] is None and _is_item_uuid(key[0])]
+    if len(batched) > 1:
+        stdin = json.dumps([OpV2Item(id=item).dict(exclude_none=True)
+                            for item, _ in batched]).encode('utf-8')
+        calls.append(PlannedCall(['op', 'item', 'get', '-', '--format', 'json'],
+                                 f'read {len(batched)} items given by uuid',
+                                 stdin_bytes=len(stdin)))
+    else:
+        batched = []
+    for (item, vault), item_env_var_names in grouped.items():
+        if (item, vault) in batched:
+            continue
+        argv = ['op', 'item', 'get', item, '--format', 'json']
+        if vault is not None:
+            argv += ['--vault', vault]
+        calls.append(PlannedCall(argv, f'read {", ".join(item_env_var_names)}'))
+    for title in titles:
+        calls.append(PlannedCall(['op', 'item', 'get', title, '--format', 'json'],
+                                 f'read every tagged field of {title}'))
+    return calls
+
+
+def _plan_connect(tagged: List[EnvVarName],
+                  by_item: Mapping[EnvVarName, FieldReference],
+                  titles: List[Title],
+                  field_mapping: FieldMapping) -> List[PlannedCall]:
+    # Every title, and the env var names together, search all vaults
+    searches = (1 if tagged or by_item else 0) + len(titles)
+    if searches == 0:
+        return []
+    repeats = f', {searches} times (repeats are revalidated by ETag)' if searches > 1 else ''
+    items = len(tagged) + len(_group_by_item(list(by_item), field_mapping)) + len(titles)
+    return [
+        PlannedCall(['GET', '/v1/vaults'], f'list vaults{repeats}'),
+        PlannedCall(['GET', '/v1/vaults/VAULT/items'],
+                    f'list the items of each vault, one request per vault{repeats}'),
+        PlannedCall(['GET', '/v1/vaults/VAULT/items/ITEM'],
+                    f'read each item found, up to {items} requests'),
+    ]
+
+
+def _describe_tag_prefixes(tag_prefixes: Sequence[str]) -> str:
+    if '' in tag_prefixes:
+        return 'every tag'
+    return f'the tags starting with {", ".join(tag_prefixes)}'
+
+
+def _plan_tag_prefixes(backend_name: str, tag_prefixes: Sequence[str]) -> List[PlannedCall]:
+    "Calls finding and reading every tag with one of tag_prefixes; the tags aren't known yet"
+    tags = _describe_tag_prefixes(tag_prefixes)
+    if backend_name == 'v1':
+        return [
+            PlannedCall(['op', 'list', 'items'], f'list every item, to find {tags}'),
+            PlannedCall(['op', 'get', 'item', '-', '--fields', 'FIELDS'],
+                        'read the fields to try for each tag found, split over more calls '
+                        'only if the field list gets too long for one',
+                        stdin_from="the 'op list items' output for each tag found"),
+        ]
+    if backend_name == 'v2':
+        return [
+            PlannedCall(['op', 'item', 'list', '--format', 'json'],
+                        f'list every item, to find {tags}'),
+            PlannedCall(['op', 'item', 'get', '-', '--format', 'json'],
+                        'read every item with a tag found',
+                        stdin_from="the 'op item list' output for those items"),
+        ]
+    return [
+        PlannedCall(['GET', '/v1/vaults'], f'list vaults, to find {tags}'),
+        PlannedCall(['GET', '/v1/vaults/VAULT/items'],
+                    'list the items of each vault, one request per vault'),
+        PlannedCall(['GET', '/v1/vaults/VAULT/items/ITEM'],
+                    'read each item with a tag found, one request per item'),
+    ]
+
+
+PLANNERS = {
+    'v1': _plan_v1,
+    'v2': _plan_v2,
+    'connect': _plan_connect,
+}
+
+
+def planned_backend_name(name: Optional[str] = None) -> str:
+    """The backend select_backend(name) would use, as far as can be told without op.
+
+    'auto' stays 'auto' unless Connect is configured, as telling v1 and
+    v2 apart means running 'op --version'.
+    """
+    name = name or os.environ.get('OP_ENV_BACKEND') or 'v1'
+    if name == 'auto' and os.environ.get('OP_CONNECT_HOST') and \
+            os.environ.get('OP_CONNECT_TOKEN'):
+        return 'connect'
+    if name not in PLANNERS and name != 'auto':
+        raise ValueError(f'Unknown op backend {name}')
+    return name
+
+
+def plan_lookups(env_var_names: List[EnvVarName],
+                 titles: List[Title],
+                 field_mapping: Optional[FieldMapping] = None,
+                 backend: Optional[str] = None,
+                 account: Optional[str] = None,
+                 partial: bool = False,
+                 detect_backend: bool = True,
+                 tag_prefixes: Sequence[str] = (),
+                 item_cache: bool = False,
+                 resolver: Optional[Resolver] = None) -> LookupPlan:
+    """Plan the calls looking up env_var_names and titles in one account would make.
+
+    Unless partial, a name which can't be looked up stops the lookup
+    before any call is made.  The 'auto' backend is planned as v1, after
+    the 'op --version' call which decides it, unless detect_backend is
+    False.  Tags found through tag_prefixes can't be known in advance,
+    so their fields aren't listed.
+
+    Names and titles resolver already holds values for are left out.
+    With item_cache, which items are unchanged is only known once they
+    are listed, so the calls which would skip them are marked instead.
+    """
+    cached: List[str] = []
+    if resolver is not None:
+        field_mapping = field_mapping or resolver.field_mapping
+        uncached = resolver.uncached(env_var_names, titles, account)
+        cached = [*[env_var_name for env_var_name in env_var_names
+                    if env_var_name not in uncached.env_var_names],
+                  *[title for title in titles if title not in uncached.titles]]
+        env_var_names, titles = uncached.env_var_names, uncached.titles
+    field_mapping = field_mapping or {}
+    backend_name = planned_backend_name(backend)
+    calls: List[PlannedCall] = []
+    if backend_name == 'auto':
+        if detect_backend:
+            calls.append(PlannedCall(['op', '--version'],
+                                     'choose between v1 and v2; v1 is assumed below'))
+        backend_name = 'v1'
+    problems: Dict[EnvVarName, str] = {}
+    tagged: List[EnvVarName] = []
+    by_item: Dict[EnvVarName, FieldReference] = {}
+    for env_var_name in env_var_names:
+        try:
+            _validate_env_var_names([env_var_name])
+        except InvalidTagOPLookupError as e:
+            problems[env_var_name] = str(e)
+            continue
+        field_reference = field_mapping.get(env_var_name, FieldReference(None))
+        if field_reference.item is None:
+            tagged.append(env_var_name)
+        else:
+            by_item[env_var_name] = field_reference
+    stopped = bool(problems) and not partial
+    if not stopped:
+        if tag_prefixes:
+            calls += _plan_tag_prefixes(backend_name, tag_prefixes)
+        calls += PLANNERS[backend_name](tagged, by_item, titles, field_mapping)
+    if item_cache:
+        calls = [call._replace(purpose=call.purpose + ITEM_CACHE_NOTE)
+                 if call.argv[0] == 'op' and call.argv[3:4] == ['-'] else call
+                 for call in calls]
+    if account is not None:
+        calls = [call._replace(argv=call.argv + ['--account', account])
+                 if call.argv[0] == 'op' else call
+                 for call in calls]
+    return LookupPlan(backend=backend_name,
+                      account=account,
+                      calls=calls,
+                      fields_to_try={
+                          env_var_name: _fields_to_try(env_var_name, field_mapping)
+                          for env_var_name in ([] if stopped else tagged + list(by_item))
+                      },
+                      problems=problems,
+                      stopped=stopped,
+                      cached=cached)
+
+
+def plan_account_lookups(lookups: Mapping[Optional[str], AccountLookup],
+                         field_mapping: Optional[FieldMapping] = None,
+                         backend: Optional[str] = None,
+                         partial: bool = False,
+                         tag_prefixes: Sequence[str] = (),
+                         item_cache: bool = False,
+                         resolver: Optional[Resolver] = None) -> List[LookupPlan]:
+    """Plan lookups in several accounts at once; any backend detection happens only once.
+
+    Tags are found through tag_prefixes in op's default account.
+    """
+    if tag_prefixes and None not in lookups:
+        lookups = {None: AccountLookup(env_var_names=[], titles=[]), **lookups}
+    return [plan_lookups(lookup.env_var_names, lookup.titles, field_mapping, backend, account,
+                         partial, detect_backend=(index == 0),
+                         tag_prefixes=tag_prefixes if account is None else (),
+                         item_cache=item_cache, resolver=resolver)
+            for index, (account, lookup) in enumerate(lookups.items())]
+
+
+def _format_bytes(size: int) -> str:
+    return f'{size} bytes' if size < 1024 else f'{size / 1024:.1f} KiB'
+
+
+def render_plan(plans: List[LookupPlan],
+                snapshot_path: Optional[str] = None,
+                max_stale: Optional[float] = None) -> str:
+    "Describe plans for a person to read"
+    lines: List[str] = []
+    op_processes = sum(plan.op_processes for plan in plans)
+    backend = plans[0].backend if plans else 'v1'
+    if backend == 'connect':
+        lines.append('No op processes: requests go to 1Password Connect (backend connect)')
+    else:
+        lines.append(f'{_plural(op_processes, "op process", "op processes")} '
+                     f'(backend {backend})')
+    for plan in plans:
+        lines.append('')
+        lines.append(f'In {_account_label(plan.account)}:')
+        if not plan.calls and not plan.stopped:
+            lines.append('  nothing to look up')
+        for number, call in enumerate(plan.calls, start=1):
+            lines.append(f'  {number}. {" ".join(call.argv)}')
+            lines.append(f'     to {call.purpose}')
+            if call.argv[0] != 'op':
+                continue
+            payload = f'argv {_format_bytes(call.argv_bytes)}'
+            if call.stdin_bytes is not None:
+                payload += f', stdin {_format_bytes(call.stdin_bytes)}'
+            elif call.stdin_from is not None:
+                payload += f', stdin {call.stdin_from}'
+            lines.append(f'     ({payload})')
+        if plan.cached:
+            lines.append(f'  Already cached, so not looked up: {", ".join(plan.cached)}')
+        if plan.fields_to_try:
+            lines.append('  Fields tried, in order:')
+            for env_var_name, fields in plan.fields_to_try.items():
+                lines.append(f'    {env_var_name}: {", ".join(fields)}')
+        for env_var_name, problem in plan.problems.items():
+            lines.append(f'  {env_var_name} cannot be looked up: {problem}')
+        if plan.stopped:
+            lines.append('  so the lookup would stop there; with --partial the rest would '
+                         'still be looked up')
+    lines.append('')
+    if snapshot_path is None or not os.path.exists(snapshot_path):
+        lines.append('No snapshot saved: every value would come from 1Password.')
+    else:
+        age = time.time() - os.path.getmtime(snapshot_path)
+        lines.append(f'Snapshot {snapshot_path} ({_format_bytes(os.path.getsize(snapshot_path))}) '
+                     f'was saved {describe_age(age)} ago.')
+        if max_stale is not None and age <= max_stale:
+            lines.append('sh --stale-while-revalidate would print it without waiting on op, '
+                         'then refresh it in the background.')
+        elif max_stale is not None:
+            lines.append('It is older than --max-stale, so sh --stale-while-revalidate '
+                         'would look values up first.')
+    return '\n'.join(lines)
@@ -0,0 +1,269 @@
+"""Recording op calls, with secrets redacted, and replaying them later.
+
+A recording is a directory holding one JSON file (optionally gzipped)
+per op call: its argv, stdin, stdout, exit status and duration.  Every
+field value in stdin and stdout is replaced by a string of the same
+length derived from an HMAC of the value, under a key which is thrown
+away when recording ends.  The same secret always gets the same
+replacement within a recording, so lookups replay exactly as they ran,
+but the recording can't be used to check guesses at the secrets.
+"""
+from contextlib import contextmanager
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import re
+from subprocess import CalledProcessError, TimeoutExpired
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from . import op
+from .op import _current_runner, OPLookupError
+
+# Values under these keys in op's JSON describe an item rather than
+# hold its secrets, and lookups depend on them being kept as-is.
+STRUCTURAL_KEYS = frozenset([
+    'category', 'changerUuid', 'createdAt', 'designation', 'id', 'itemVersion', 'k', 'label',
+    'n', 'name', 'purpose', 'reference', 'section', 't', 'tags', 'templateUuid', 'title',
+    'trashed', 'type', 'updatedAt', 'uuid', 'vault', 'vaultUuid', 'version',
+])
+
+# op_env.op_v2 separates 'op inject' values with a boundary which
+# differs on every call; recordings hold this in its place.
+BOUNDARY_PATTERN = re.compile(r'op-env-[0-9a-f]{32}')
+BOUNDARY_PLACEHOLDER = 'op-env-' + '0' * 32
+
+
+class ReplayMissOPLookupError(OPLookupError):
+    pass
+
+
+def _split_json_docs(text: str) -> Optional[List[Tuple[str, Any]]]:
+    "Each JSON document in text with the whitespace before it, or None if text isn't JSON"
+    decoder = json.JSONDecoder()
+    docs: List[Tuple[str, Any]] = []
+    pos = 0
+    while pos < len(text):
+        start = pos
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos == len(text):
+            docs.append((text[start:], None))
+            break
+        try:
+            doc, end = decoder.raw_decode(text, pos)
+        except ValueError:
+            return None
+        docs.append((text[start:pos], (doc, text[pos:end])))
+        pos = end
+    return docs if any(doc is not None for _, doc in docs) else None
+
+
+class Redactor:
+    "Replaces secrets with same-length stand-ins, consistently for a given key"
+
+    def __init__(self, key: Optional[bytes] = None) -> None:
+        self._key = key or os.urandom(32)
+
+    def value(self, secret: str) -> str:
+        if secret == '':
+            return secret
+        digest = hmac.new(self._key, secret.encode('utf-8'), hashlib.sha256).hexdigest()
+        return (digest * (len(secret) // len(digest) + 1))[:len(secret)]
+
+    def json_doc(self, doc: Any, all_values: bool = False, key: Optional[str] = None) -> Any:
+        "doc with secrets replaced; all_values treats every string as a secret"
+        if isinstance(doc, dict):
+            return {k: self.json_doc(v, all_values, k) for k, v in doc.items()}
+        if isinstance(doc, list):
+            return [self.json_doc(v, all_values, key) for v in doc]
+        if isinstance(doc, str) and (all_values or key not in STRUCTURAL_KEYS):
+            return self.value(doc)
+        return doc
+
+    def output(self, command: List[str], text: str) -> str:
+        "op's output for command, with secrets replaced"
+        if command[:2] == ['op', 'inject']:
+            # 'BOUNDARY NAME' lines, each followed by a value and a newline
+            chunks = text.split(f'{BOUNDARY_PLACEHOLDER} ')
+            parts = [self.value(chunks[0])]
+            for chunk in chunks[1:]:
+                name, _, value = chunk.partition('\n')
+                parts.append(f'{name}\n{self.value(value[:-1])}{value[-1:]}')
+            return f'{BOUNDARY_PLACEHOLDER} '.join(parts)
+        # 'op get item --fields' prints objects keyed by field name
+        redacted = self.json_text(text, all_values='--fields' in command)
+        if redacted is None:
+            # a lone field's value, printed as-is
+            stripped = text.rstrip('\n')
+            return self.value(stripped) + text[len(stripped):]
+        return redacted
+
+    def json_text(self, text: str, all_values: bool = False) -> Optional[str]:
+        "JSON documents in text with secrets replaced, or None if text isn't JSON"
+        docs = _split_json_docs(text)
+        if docs is None:
+            return None
+        out = []
+        for whitespace, parsed in docs:
+            out.append(whitespace)
+            if parsed is not None:
+                doc, doc_text = parsed
+                indent = 2 if '\n' in doc_text else None
+                separators = None if indent else (',', ':')
+                out.append(json.dumps(self.json_doc(doc, all_values), indent=indent,
+                                      separators=separators, ensure_ascii=False))
+        return ''.join(out)
+
+
+def _without_boundary(text: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    "text with any inject boundary replaced by the placeholder, and the boundary"
+    if text is None:
+        return None, None
+    match = BOUNDARY_PATTERN.search(text)
+    if match is None:
+        return text, None
+    return text.replace(match.group(0), BOUNDARY_PLACEHOLDER), match.group(0)
+
+
+def _canonical_stdin(text: Optional[str]) -> Optional[str]:
+    # JSON piped back into op is re-serialized by op-env, so compare
+    # what it says rather than how it's spaced
+    if text is None:
+        return None
+    docs = _split_json_docs(text)
+    if docs is None:
+        return text
+    return json.dumps([parsed[0] for _, parsed in docs if parsed is not None], sort_keys=True)
+
+
+class Recorder:
+    "An op runner which runs op as usual, saving a redacted capture of each call"
+
+    def __init__(self, directory: str, compress: bool = True,
+                 redactor: Optional[Redactor] = None) -> None:
+        self.directory = directory
+        self.compress = compress
+        self.redactor = redactor or Redactor()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _save(self, capture: Dict[str, Any]) -> None:
+        with self._lock:
+            sequence = next(self._counter)
+        # Ordered by when calls finished, across processes sharing a directory
+        name = f'{time.time_ns()}-{os.getpid()}-{sequence:04d}.json'
+        data = json.dumps(capture, indent=1).encode('utf-8')
+        if self.compress:
+            with gzip.open(os.path.join(self.directory, name + '.gz'), 'wb') as f:
+                f.write(data)
+        else:
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(data)
+
+    def _record(self, command: List[str], input: Optional[bytes], output: bytes,
+                returncode: int, duration: float) -> None:
+        stdin, _ = _without_boundary(None if input is None else input.decode('utf-8'))
+        stdout, _ = _without_boundary(output.decode('utf-8'))
+        assert stdout is not None
+        if stdin is not None and command[:2] != ['op', 'inject']:
+            # inject templates hold only op:// references, not values
+            stdin = self.redactor.json_text(stdin) or stdin
+        self._save({
+            'argv': command,
+            'stdin': stdin,
+            'stdout': self.redactor.output(command, stdout),
+            'returncode': returncode,
+            'duration': duration,
+        })
+
+    def __call__(self, command: List[str], input: Optional[bytes],
+                 timeout: Optional[float]) -> bytes:
+        start = time.perf_counter()
+        try:
+            output = op._run_op(command, input, timeout)
+        except CalledProcessError as e:
+            self._record(command, input, e.output or b'', e.returncode,
+                         time.perf_counter() - start)
+            raise
+        self._record(command, input, output, 0, time.perf_counter() - start)
+        return output
+
+
+class Replayer:
+    """An op runner which answers from a recording instead of running op.
+
+    Calls are matched by argv and stdin; repeated calls are answered
+    in the order they were recorded.  Each answer takes as long as the
+    original call did, times speed.
+    """
+
+    def __init__(self, directory: str, speed: float = 1.0) -> None:
+        self.speed = speed
+        self._captures: Dict[Tuple[Tuple[str, ...], Optional[str]], List[Dict[str, Any]]] = {}
+        self._served: Dict[Tuple[Tuple[str, ...], Optional[str]], int] = {}
+        self._lock = threading.Lock()
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith('.json.gz'):
+                with gzip.open(path, 'rb') as f:
+                    capture = json.loads(f.read())
+            elif name.endswith('.json'):
+                with open(path, 'rb') as f:
+                    capture = json.loads(f.read())
+            else:
+                continue
+            key = (tuple(capture['argv']), _canonical_stdin(capture['stdin']))
+            self._captures.setdefault(key, []).append(capture)
+
+    def __call__(self, command: List[str], input: Optional[bytes],
+                 timeout: Optional[float]) -> bytes:
+        stdin, boundary = _without_boundary(None if input is None else input.decode('utf-8'))
+        key = (tuple(command), _canonical_stdin(stdin))
+        with self._lock:
+            captures = self._captures.get(key)
+            if not captures:
+                raise ReplayMissOPLookupError(f'No recorded op call matches {" ".join(command)}')
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        # once every recorded answer has been given, keep giving the last
+        capture = captures[min(served, len(captures) - 1)]
+        duration = capture['duration'] * self.speed
+        if timeout is not None and duration > timeout:
+            time.sleep(timeout)
+            raise TimeoutExpired(command, timeout)
+        time.sleep(duration)
+        stdout = capture['stdout']
+        if boundary is not None:
+            stdout = stdout.replace(BOUNDARY_PLACEHOLDER, boundary)
+        output = stdout.encode('utf-8')
+        if capture['returncode'] != 0:
+            raise CalledProcessError(capture['returncode'], command, output=output)
+        return output
+
+
+@contextmanager
+def recording(directory: str, compress: bool = True) -> Iterator[Recorder]:
+    "Record every op call made in this context to directory"
+    recorder = Recorder(directory, compress)
+    token = _current_runner.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_runner.reset(token)
+
+
+@contextmanager
+def replaying(directory: str, speed: float = 1.0) -> Iterator[Replayer]:
+    "Answer every op call made in this context from the recording in directory"
+    replayer = Replayer(directory, speed)
+    token = _current_runner.set(replayer)
+    try:
+        yield replayer
+    finally:
+        _current_runner.reset(token)
@@ -0,0 +1,140 @@
+"""Encrypted on-disk snapshots of previously resolved values."""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+from .op import EnvVarName, FieldMapping, FieldValue, Title
+from .paths import _write_private_file, default_cache_dir, default_key_file
+
+
+class SnapshotStoreError(Exception):
+    pass
+
+
+class Snapshot(NamedTuple):
+    values: Dict[EnvVarName, FieldValue]
+    saved_at: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.saved_at
+
+
+def describe_age(seconds: float) -> str:
+    "How long ago something was saved, for a person to read"
+    if seconds < 120:
+        return f'{seconds:.0f} seconds'
+    if seconds < 7200:
+        return f'{seconds / 60:.0f} minutes'
+    return f'{seconds / 3600:.1f} hours'
+
+
+def snapshot_name(env_var_names: List[EnvVarName],
+                  titles: List[Title],
+                  field_mapping: Optional[FieldMapping] = None,
+                  backend: Optional[str] = None) -> str:
+    """Stable file name for the snapshot of a particular lookup request.
+
+    Lookups of the same names through different field mappings (or
+    references) or backends can find different values, so get
+    different names.
+    """
+    request: Dict[str, Any] = {'environment': sorted(env_var_names), 'title': sorted(titles)}
+    if field_mapping:
+        request['field_mapping'] = {env_var_name: list(field_reference)
+                                    for env_var_name, field_reference in field_mapping.items()}
+    if backend is not None:
+        request['backend'] = backend
+    request_json = json.dumps(request, sort_keys=True)
+    return hashlib.sha256(request_json.encode('utf-8')).hexdigest()[:32]
+
+
+@contextmanager
+def locked_json_state(path: str) -> Iterator[Dict[str, Any]]:
+    """The JSON object kept in path, saved again on exit.
+
+    Other processes using the same path are kept out meanwhile.
+    """
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            state = json.loads(f.read() or '{}')
+        except ValueError:
+            # a damaged state file shouldn't keep lookups from happening
+            state = {}
+        original = json.loads(json.dumps(state))
+        yield state
+        if state != original:
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+
+
+class SnapshotStore:
+    """Keeps the last known good values of lookups, encrypted at rest.
+
+    Values are encrypted with Fernet from the optional 'cryptography'
+    package (pip install 'op-env[store]').  The key is taken from
+    $OP_ENV_STORE_KEY if set; otherwise one is generated and kept in
+    ~/.config/op-env/store.key, away from the snapshots themselves.
+    """
+
+    def __init__(self,
+                 directory: Optional[str] = None,
+                 key: Optional[bytes] = None) -> None:
+        self.directory = directory or default_cache_dir()
+        self._key = key
+        self._fernet: Any = None
+
+    def _cipher(self) -> Any:
+        if self._fernet is None:
+            try:
+                from cryptography.fernet import Fernet
+            except ImportError as e:
+                raise SnapshotStoreError("Snapshots require the 'cryptography' package; "
+                                         "install with pip install 'op-env[store]'") from e
+            self._fernet = Fernet(self._key or self._load_or_create_key(Fernet))
+        return self._fernet
+
+    @staticmethod
+    def _load_or_create_key(fernet_class: Any) -> bytes:
+        key_from_env = os.environ.get('OP_ENV_STORE_KEY')
+        if key_from_env:
+            return key_from_env.encode('utf-8')
+        key_file = default_key_file()
+        if not os.path.exists(key_file):
+            _write_private_file(key_file, fernet_class.generate_key())
+        with open(key_file, 'rb') as f:
+            return f.read().strip()
+
+    def path(self, name: str, suffix: str = 'snapshot') -> str:
+        return os.path.join(self.directory, f'{name}.{suffix}')
+
+    def load(self, name: str) -> Optional[Snapshot]:
+        "Returns the saved snapshot, or None if there is none or it can't be decrypted"
+        try:
+            with open(self.path(name), 'rb') as f:
+                token = f.read()
+        except FileNotFoundError:
+            return None
+        cipher = self._cipher()
+        from cryptography.fernet import InvalidToken
+
+        try:
+            data = json.loads(cipher.decrypt(token))
+        except InvalidToken:
+            return None
+        return Snapshot(values=data['values'], saved_at=data['saved_at'])
+
+    def save(self, name: str, values: Dict[EnvVarName, FieldValue]) -> bool:
+        "Saves values, returning whether they differ from the previous snapshot"
+        previous = self.load(name)
+        data = json.dumps({'values': values, 'saved_at': time.time()}).encode('utf-8')
+        _write_private_file(self.path(name), self._cipher().encrypt(data))
+        return previous is None or previous.values != values
@@ -0,0 +1,130 @@
+"""Running several commands at once with the same looked-up environment."""
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+from types import FrameType
+from typing import Dict, IO, List, Mapping, NamedTuple, Optional
+
+# Seconds to wait for the remaining commands to exit after SIGTERM
+# before killing them
+SHUTDOWN_TIMEOUT = 10.0
+
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
+
+
+class ProcfileEntry(NamedTuple):
+    name: str
+    command: str
+
+
+def load_procfile(filename: str) -> List[ProcfileEntry]:
+    "Load a Procfile, with one 'name: command' entry per line"
+    entries = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            name, sep, command = line.partition(':')
+            if sep == '' or name.strip() == '' or command.strip() == '':
+                raise ValueError(f'Procfile lines must look like "name: command"; found {line}')
+            entries.append(ProcfileEntry(name=name.strip(), command=command.strip()))
+    if not entries:
+        raise ValueError(f'No commands found in {filename}')
+    return entries
+
+
+def _exit_status(returncode: int) -> int:
+    # Report death by signal the way shells do
+    return 128 - returncode if returncode < 0 else returncode
+
+
+def _copy_output(name: str, stream: IO[bytes], out: IO[str], lock: threading.Lock) -> None:
+    for line in iter(stream.readline, b''):
+        with lock:
+            out.write(f'{name} | {line.decode("utf-8", errors="replace")}')
+            if not line.endswith(b'\n'):
+                out.write('\n')
+            out.flush()
+    stream.close()
+
+
+def _report_exit(process: 'subprocess.Popen[bytes]',
+                 exited: 'queue.Queue[subprocess.Popen[bytes]]') -> None:
+    process.wait()
+    exited.put(process)
+
+
+def _signal_group(process: 'subprocess.Popen[bytes]', signum: int) -> None:
+    try:
+        os.killpg(process.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        # everything in the group has already exited
+        pass
+
+
+def supervise(entries: List[ProcfileEntry],
+              env: Mapping[str, str],
+              out: IO[str] = sys.stdout) -> int:
+    """Run every entry concurrently, prefixing each line of output with its name.
+
+    Signals received are forwarded to every command.  As soon as one
+    command exits, the rest are stopped, and its exit status is
+    returned.
+    """
+    width = max(len(entry.name) for entry in entries)
+    lock = threading.Lock()
+    exited: 'queue.Queue[subprocess.Popen[bytes]]' = queue.Queue()
+    processes: List['subprocess.Popen[bytes]'] = []
+    threads: List[threading.Thread] = []
+
+    def forward(signum: int, frame: Optional[FrameType]) -> None:
+        for process in processes:
+            _signal_group(process, signum)
+
+    previous_handlers: Dict[int, object] = {
+        signum: signal.signal(signum, forward) for signum in FORWARDED_SIGNALS
+    }
+    try:
+        for entry in entries:
+            # Each in its own process group, so shells' children get
+            # signals too.
+            process = subprocess.Popen(['/bin/sh', '-c', entry.command],
+                                       env=dict(env),
+                                       stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+            processes.append(process)
+            assert process.stdout is not None
+            threads.append(threading.Thread(target=_copy_output,
+                                            args=(entry.name.ljust(width), process.stdout,
+                                                  out, lock),
+                                            daemon=True))
+            threads.append(threading.Thread(target=_report_exit,
+                                            args=(process, exited),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+        first_exited = exited.get()
+        for process in processes:
+            _signal_group(process, signal.SIGTERM)
+        for process in processes:
+            try:
+                process.wait(timeout=SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                _signal_group(process, signal.SIGKILL)
+                process.wait()
+        for thread in threads:
+            # output from any stragglers which escaped the process group
+            # isn't worth hanging around for
+            thread.join(timeout=SHUTDOWN_TIMEOUT)
+        return _exit_status(first_exited.returncode)
+    finally:
+        for process in processes:
+            _signal_group(process, signal.SIGKILL)
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)  # type: ignore
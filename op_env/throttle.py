@@ -0,0 +1,144 @@
+"""A host-wide cap on the number of op processes running at once.
+
+Set $OP_ENV_MAX_CONCURRENCY to the number of op processes every op-env
+on the machine may run between them.  The slots are kept in a small
+state file in the cache directory, so processes which die while
+holding or waiting for a slot are noticed and skipped.  Waiters are
+served in the order they arrived.
+"""
+from contextlib import contextmanager
+import os
+from subprocess import TimeoutExpired
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+import uuid
+
+from . import metrics
+from .store import default_cache_dir, locked_json_state
+
+# Waiters check for a free slot this often at first, backing off to
+# MAX_POLL_INTERVAL while the wait goes on.
+POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.1
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's process, but running
+        return True
+    return True
+
+
+def _live(entries: List[List[Any]]) -> List[List[Any]]:
+    return [entry for entry in entries if _alive(entry[0])]
+
+
+class OpSlots:
+    """A counting semaphore shared by every process using the same path.
+
+    Holders and waiters are recorded as [pid, token] pairs, so several
+    threads in one process each count as a holder.
+    """
+
+    def __init__(self, limit: int, path: Optional[str] = None) -> None:
+        if limit < 1:
+            raise ValueError('op concurrency limit must be at least 1')
+        self.limit = limit
+        self.path = path or os.path.join(default_cache_dir(), 'op-slots.json')
+
+    def _take_if_free(self, state: Dict[str, Any], me: List[Any]) -> bool:
+        holders = _live(state.get('holders', []))
+        queue = _live(state.get('queue', []))
+        if me not in queue:
+            queue.append(me)
+        free = self.limit - len(holders)
+        taken = me in queue[:max(free, 0)]
+        if taken:
+            queue.remove(me)
+            holders.append(me)
+        state['holders'] = holders
+        state['queue'] = queue
+        return taken
+
+    def acquire(self, timeout: Optional[float] = None) -> str:
+        """Wait for a slot, returning a token to release it with.
+
+        subprocess.TimeoutExpired is raised if none is free within
+        timeout seconds.
+        """
+        token = f'{threading.get_ident()}-{uuid.uuid4().hex}'
+        me: List[Any] = [os.getpid(), token]
+        start = time.monotonic()
+        queued = 0
+        interval = POLL_INTERVAL
+        try:
+            while True:
+                with locked_json_state(self.path) as state:
+                    if self._take_if_free(state, me):
+                        break
+                    if interval == POLL_INTERVAL:
+                        queued = state['queue'].index(me)
+                wait = interval
+                if timeout is not None:
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        raise TimeoutExpired(['op'], timeout)
+                    wait = min(interval, remaining)
+                time.sleep(wait)
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+        except BaseException:
+            with locked_json_state(self.path) as state:
+                if me in state.get('queue', []):
+                    state['queue'].remove(me)
+            raise
+        if metrics.enabled():
+            metrics.emit(metrics.OpSlotWaitEvent(wait=time.monotonic() - start,
+                                                 limit=self.limit,
+                                                 queued=queued))
+        return token
+
+    def release(self, token: str) -> None:
+        with locked_json_state(self.path) as state:
+            state['holders'] = [holder for holder in state.get('holders', [])
+                                if holder != [os.getpid(), token]]
+
+    @contextmanager
+    def slot(self, timeout: Optional[float] = None) -> Iterator[Optional[float]]:
+        "Hold a slot in this context, which gets the part of timeout left after waiting"
+        start = time.monotonic()
+        token = self.acquire(timeout)
+        try:
+            yield None if timeout is None else max(0.0, timeout - (time.monotonic() - start))
+        finally:
+            self.release(token)
+
+
+def configured_limit() -> Optional[int]:
+    "The limit set by $OP_ENV_MAX_CONCURRENCY, if any"
+    limit = os.environ.get('OP_ENV_MAX_CONCURRENCY')
+    if not limit:
+        return None
+    try:
+        return int(limit)
+    except ValueError:
+        raise ValueError('$OP_ENV_MAX_CONCURRENCY must be a whole number of op processes; '
+                         f'found {limit}') from None
+
+
+@contextmanager
+def op_slot(timeout: Optional[float]) -> Iterator[Optional[float]]:
+    """Hold one of the host's op slots, if they're limited, for an op call.
+
+    Yields the timeout left for the call itself.
+    """
+    limit = configured_limit()
+    if limit is None:
+        yield timeout
+        return
+    with OpSlots(limit).slot(timeout) as remaining:
+        yield remaining
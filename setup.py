@@ -6,7 +6,7 @@
 from decimal import Decimal
 import os
 import os.path
-from typing import List
+from typing import Dict, List
 
 # This must be above distutils, despite flake8's opinions.  Otherwise,
 # this diagnostic is emitted:
@@ -31,6 +31,11 @@ requirements: List[str] = ['typing_extensions', 'PyYAML', 'pydantic>=1,<2']
 
 test_requirements: List[str] = ['pytest>=3']
 
+extras_requirements: Dict[str, List[str]] = {
+    # encrypted snapshots of looked-up values
+    'store': ['cryptography'],
+}
+
 
 # From https://github.com/bluelabsio/records-mover/blob/master/setup.py
 class CoverageRatchetCommand(Command):
@@ -115,6 +120,7 @@ setup(
     entry_points={
         'console_scripts': [
             'op-env=op_env._cli:main',
+            'op-env-complete=op_env.completion:main',
         ],
     },
     cmdclass={
@@ -122,6 +128,7 @@ setup(
         'mypy_ratchet': MypyCoverageRatchetCommand,
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     long_description_content_type='text/x-rst',
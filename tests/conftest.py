@@ -1 +1,98 @@
+"""Fixtures shared between test modules."""
+
+import json
+import os
+import sys
+
+import pytest
+
 collect_ignore = ['setup.py']
+
+FAKE_OP = """#!{python}
+import json
+import os
+import re
+import sys
+
+args = sys.argv[1:]
+with open(os.environ['OP_FAKE_LOG'], 'a') as log:
+    log.write(json.dumps(args) + '\\n')
+with open(os.environ['OP_FAKE_ITEMS']) as f:
+    items = json.load(f)
+
+
+def find(ref, vault=None):
+    for item in items:
+        if ref in (item['id'], item['title']) and \\
+           vault in (None, item['vault']['id'], item['vault']['name']):
+            return item
+    sys.exit(f'"{{ref}}" isn\\'t an item')
+
+
+def value(vault, ref, field_ref):
+    for field in find(ref, vault)['fields']:
+        if field_ref in (field['id'], field.get('label')):
+            return field.get('value', '')
+    sys.exit(f'"{{field_ref}}" isn\\'t a field')
+
+
+if args == ['--version']:
+    print('2.24.0')
+elif args[:2] == ['item', 'list']:
+    tags = args[args.index('--tags') + 1].split(',') if '--tags' in args else None
+    print(json.dumps([{{k: v for k, v in item.items() if k != 'fields'}}
+                      for item in items if tags is None or set(item['tags']) & set(tags)]))
+elif args[:3] == ['item', 'get', '-']:
+    for listed in json.load(sys.stdin):
+        print(json.dumps(find(listed['id']), indent=2))
+elif args[:2] == ['item', 'get']:
+    vault = args[args.index('--vault') + 1] if '--vault' in args else None
+    print(json.dumps(find(args[2], vault)))
+elif args == ['inject']:
+    sys.stdout.write(re.sub(r'{{{{ op://([^/]+)/([^/]+)/([^ ]+) }}}}',
+                            lambda m: value(*m.groups()), sys.stdin.read()))
+else:
+    sys.exit(f'unknown command {{args}}')
+"""
+
+ITEMS = [
+    {
+        'id': 'id1', 'title': 'web db', 'tags': ['WEB_DB_PASSWORD', 'WEB_DB_USERNAME'],
+        'vault': {'id': 'v1', 'name': 'prod'},
+        'fields': [
+            {'id': 'username', 'label': 'username', 'value': 'webuser'},
+            {'id': 'password', 'label': 'password', 'value': 'multi\nline'},
+        ],
+    },
+    {
+        'id': 'id2', 'title': 'stripe', 'tags': ['STRIPE_API_KEY'],
+        'vault': {'id': 'v1', 'name': 'prod'},
+        'fields': [{'id': 'abc', 'label': 'key', 'value': 'sk_123'}],
+    },
+    {
+        'id': 'id3', 'title': 'dup 1', 'tags': ['DUPLICATE'],
+        'vault': {'id': 'v1', 'name': 'prod'}, 'fields': [],
+    },
+    {
+        'id': 'id4', 'title': 'dup 2', 'tags': ['DUPLICATE'],
+        'vault': {'id': 'v1', 'name': 'prod'}, 'fields': [],
+    },
+]
+
+
+@pytest.fixture
+def fake_op(tmp_path, monkeypatch):
+    op = tmp_path / 'op'
+    op.write_text(FAKE_OP.format(python=sys.executable))
+    op.chmod(0o755)
+    items_file = tmp_path / 'items.json'
+    items_file.write_text(json.dumps(ITEMS))
+    log_file = tmp_path / 'calls.log'
+    log_file.write_text('')
+    monkeypatch.setenv('PATH', str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv('OP_FAKE_ITEMS', str(items_file))
+    monkeypatch.setenv('OP_FAKE_LOG', str(log_file))
+
+    def calls():
+        return [json.loads(line) for line in log_file.read_text().splitlines()]
+    return calls
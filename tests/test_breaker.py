@@ -0,0 +1,147 @@
+"""Tests for `op_env.breaker`."""
+
+import json
+from subprocess import CalledProcessError
+import time
+from unittest.mock import patch
+
+import pytest
+
+from op_env._cli import main
+from op_env.breaker import CircuitBreaker, CircuitBreakerBackend, CircuitOpenOPLookupError
+from op_env.op import (NoEntriesOPLookupError, OPLookupError, OpV1Backend,
+                       UnreadableItemOPLookupError)
+
+
+@pytest.fixture
+def breaker_path(tmp_path):
+    return str(tmp_path / 'circuit-breaker.json')
+
+
+def unreachable():
+    return CalledProcessError(1, ['op', 'list', 'items'])
+
+
+def fail():
+    raise unreachable()
+
+
+def test_breaker_trips_after_consecutive_failures(breaker_path):
+    breaker = CircuitBreaker(2, reset_after=60, path=breaker_path)
+    for _ in range(2):
+        with pytest.raises(CalledProcessError):
+            with breaker.guard():
+                fail()
+    # shared with every other breaker using the same file
+    other = CircuitBreaker(2, reset_after=60, path=breaker_path)
+    assert other.state() == 'open'
+    with pytest.raises(CircuitOpenOPLookupError, match='after 2 consecutive failures') as excinfo:
+        other.before_call()
+    assert 0 < excinfo.value.retry_in <= 60
+
+
+def test_breaker_success_resets_failure_count(breaker_path):
+    breaker = CircuitBreaker(2, path=breaker_path)
+    with pytest.raises(CalledProcessError):
+        with breaker.guard():
+            fail()
+    with breaker.guard():
+        pass
+    with pytest.raises(CalledProcessError):
+        with breaker.guard():
+            fail()
+    assert breaker.state() == 'closed'
+
+
+def test_breaker_half_open_probe(breaker_path):
+    breaker = CircuitBreaker(1, reset_after=60, path=breaker_path)
+    with pytest.raises(CalledProcessError):
+        with breaker.guard():
+            fail()
+    with open(breaker_path) as f:
+        state = json.load(f)
+    state['opened_at'] -= 61
+    with open(breaker_path, 'w') as f:
+        json.dump(state, f)
+    assert breaker.state() == 'half-open'
+    breaker.before_call()
+    # only one probe at a time
+    with pytest.raises(CircuitOpenOPLookupError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state() == 'closed'
+
+
+def test_breaker_ignores_answered_lookups(breaker_path):
+    breaker = CircuitBreaker(1, path=breaker_path)
+    backend = CircuitBreakerBackend(OpV1Backend(), breaker)
+    with patch('op_env.op._do_env_lookups',
+               side_effect=NoEntriesOPLookupError('No 1Password entries with tag A found')):
+        with pytest.raises(NoEntriesOPLookupError):
+            backend.env_lookups(['A'], {})
+    assert breaker.state() == 'closed'
+
+
+def test_breaker_counts_outages_returned_by_partial_lookups(breaker_path):
+    breaker = CircuitBreaker(2, path=breaker_path)
+    backend = CircuitBreakerBackend(OpV1Backend(), breaker)
+    unreachable = OPLookupError('1Password item x could not be read')
+    with patch('op_env.op._fields_from_title_partial', return_value=({}, unreachable)):
+        backend.title_lookups_partial('x', {})
+    with patch('op_env.op._do_env_lookups_partial',
+               return_value=({}, {'A': NoEntriesOPLookupError('No entries')})):
+        backend.env_lookups_partial(['A'], {})
+    assert breaker.state() == 'closed'
+    for _ in range(2):
+        with patch('op_env.op._do_env_lookups_partial', return_value=({}, {'A': unreachable})):
+            backend.env_lookups_partial(['A'], {})
+    assert breaker.state() == 'open'
+
+
+def test_breaker_ignores_bad_titles(breaker_path):
+    breaker = CircuitBreaker(1, path=breaker_path)
+    backend = CircuitBreakerBackend(OpV1Backend(), breaker)
+    no_such_item = CalledProcessError(1, ['op', 'get', 'item', 'no such item'])
+    with patch('op_env.op._op_check_output', side_effect=no_such_item):
+        with pytest.raises(CalledProcessError):
+            backend.title_lookups('no such item', {})
+        values, error = backend.title_lookups_partial('no such item', {})
+    assert isinstance(error, UnreadableItemOPLookupError)
+    assert breaker.state() == 'closed'
+    with patch('op_env.op._op_check_output',
+               side_effect=CalledProcessError(1, ['op', 'list', 'items'])):
+        with pytest.raises(CalledProcessError):
+            backend.env_lookups(['A'], {})
+    assert breaker.state() == 'open'
+
+
+def test_cli_falls_back_to_snapshot_when_open(tmp_path, monkeypatch, capsys):
+    fernet = pytest.importorskip('cryptography.fernet')
+    monkeypatch.setenv('OP_ENV_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('OP_ENV_STORE_KEY', fernet.Fernet.generate_key().decode())
+    argv = ['op-env', 'json', '-e', 'A', '--circuit-breaker', '1', '--fallback-snapshot']
+    with patch('op_env.op._do_env_lookups', return_value={'A': 'good'}):
+        main(argv)
+    assert json.loads(capsys.readouterr().out) == {'A': 'good'}
+    with patch('op_env.op._do_env_lookups', side_effect=unreachable()):
+        main(argv)
+    out, err = capsys.readouterr()
+    assert json.loads(out) == {'A': 'good'}
+    assert 'using the last known good values' in err
+    with patch('op_env.op._do_env_lookups') as do_env_lookups:
+        start = time.perf_counter()
+        main(argv)
+        assert time.perf_counter() - start < 5
+    do_env_lookups.assert_not_called()
+    out, err = capsys.readouterr()
+    assert json.loads(out) == {'A': 'good'}
+    assert 'failing fast' in err
+
+
+def test_cli_without_snapshot_raises(tmp_path, monkeypatch):
+    monkeypatch.setenv('OP_ENV_CACHE_DIR', str(tmp_path))
+    with patch('op_env.op._do_env_lookups', side_effect=unreachable()):
+        with pytest.raises(CalledProcessError):
+            main(['op-env', 'json', '-e', 'A', '--circuit-breaker', '1'])
+        with pytest.raises(CircuitOpenOPLookupError):
+            main(['op-env', 'json', '-e', 'A', '--circuit-breaker', '1'])
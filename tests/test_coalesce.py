@@ -0,0 +1,123 @@
+"""Tests for `op_env.coalesce`."""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+from op_env.coalesce import Coalescer
+from op_env.op import (_current_account, _submit, account, CollectingOpBackend,
+                       NoEntriesOPLookupError, Resolver, UnreadableItemOPLookupError)
+
+
+class RecordingBackend(CollectingOpBackend):
+    def __init__(self, values, failure=None, titles=None):
+        self.values = values
+        self.failure = failure
+        self.titles = titles or {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def env_lookups_partial(self, env_var_names, field_mapping):
+        with self.lock:
+            self.calls.append((_current_account.get(), sorted(env_var_names)))
+        if self.failure is not None:
+            raise self.failure
+        return ({name: self.values[name] for name in env_var_names if name in self.values},
+                {name: NoEntriesOPLookupError(f'No 1Password entries with tag {name} found')
+                 for name in env_var_names if name not in self.values})
+
+    def title_lookups_partial(self, title, field_mapping):
+        with self.lock:
+            self.calls.append((_current_account.get(), title))
+        if self.failure is not None:
+            raise self.failure
+        if title not in self.titles:
+            return {}, UnreadableItemOPLookupError(f'Could not read 1Password item {title}')
+        return dict(self.titles[title]), None
+
+    def tag_prefix_lookups_partial(self, tag_prefixes, field_mapping):
+        with self.lock:
+            self.calls.append((_current_account.get(), sorted(tag_prefixes)))
+        if self.failure is not None:
+            raise self.failure
+        return ({name: value for name, value in self.values.items()
+                 if any(name.startswith(tag_prefix) for tag_prefix in tag_prefixes)},
+                {})
+
+
+def lookup_concurrently(coalescer, requests, method='lookup'):
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        futures = [_submit(executor, getattr(coalescer, method), names) for names in requests]
+        return futures
+
+
+def test_coalescer_merges_concurrent_requests():
+    backend = RecordingBackend({'A': '1', 'B': '2', 'C': '3'})
+    coalescer = Coalescer(window=0.5, backend=backend)
+    futures = lookup_concurrently(coalescer, [['A', 'B'], ['B'], ['C']])
+    assert [future.result() for future in futures] == [{'A': '1', 'B': '2'}, {'B': '2'},
+                                                       {'C': '3'}]
+    assert backend.calls == [(None, ['A', 'B', 'C'])]
+    assert (coalescer.batches, coalescer.requests) == (1, 3)
+
+
+def test_coalescer_gives_each_caller_its_own_error():
+    backend = RecordingBackend({'A': '1'})
+    coalescer = Coalescer(window=0.5, max_batch_size=2, backend=backend)
+    futures = lookup_concurrently(coalescer, [['A'], ['MISSING']])
+    assert futures[0].result() == {'A': '1'}
+    with pytest.raises(NoEntriesOPLookupError, match='tag MISSING'):
+        futures[1].result()
+    assert len(backend.calls) == 1
+
+
+def test_coalescer_partial_lookups():
+    backend = RecordingBackend({'A': '1'})
+    coalescer = Coalescer(window=0.5, max_batch_size=2, backend=backend)
+    futures = lookup_concurrently(coalescer, [['A'], ['A', 'MISSING']], 'lookup_partial')
+    assert futures[0].result() == ({'A': '1'}, {})
+    values, errors = futures[1].result()
+    assert values == {'A': '1'}
+    assert list(errors) == ['MISSING']
+
+
+def test_coalescer_batch_failure_reaches_every_caller():
+    backend = RecordingBackend({}, failure=RuntimeError('op is broken'))
+    coalescer = Coalescer(window=0.5, max_batch_size=2, backend=backend)
+    futures = lookup_concurrently(coalescer, [['A'], ['B']])
+    for future in futures:
+        with pytest.raises(RuntimeError, match='op is broken'):
+            future.result()
+
+
+def test_coalescer_runs_full_batches_without_waiting():
+    backend = RecordingBackend({'A': '1', 'B': '2'})
+    coalescer = Coalescer(window=30, max_batch_size=2, backend=backend)
+    start = time.perf_counter()
+    assert coalescer.lookup(['A', 'B']) == {'A': '1', 'B': '2'}
+    assert time.perf_counter() - start < 5
+
+
+def test_coalescer_keeps_accounts_apart():
+    backend = RecordingBackend({'A': '1'})
+    coalescer = Coalescer(window=0.2, backend=backend)
+
+    def lookup_in(shorthand):
+        with account(shorthand):
+            return coalescer.lookup(['A'])
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(lookup_in, shorthand) for shorthand in (None, 'work')]
+        assert [future.result() for future in futures] == [{'A': '1'}, {'A': '1'}]
+    assert len(backend.calls) == 2
+    assert {shorthand for shorthand, _ in backend.calls} == {None, 'work'}
+
+
+def test_recording_backend_serves_a_resolver():
+    backend = RecordingBackend({'A': '1', 'WEB_B': '2'}, titles={'stripe': {'C': '3'}})
+    with Resolver(backend=backend) as resolver:
+        assert resolver.resolve(['A'], ['stripe']) == {'A': '1', 'C': '3'}
+        assert resolver.resolve_tag_prefixes(['WEB_']) == {'WEB_B': '2'}
+        result = resolver.resolve_partial([], ['missing'])
+    assert list(result.title_errors) == ['missing']
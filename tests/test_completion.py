@@ -0,0 +1,105 @@
+"""Tests for `op_env.completion`."""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+
+import pytest
+
+from op_env import completion
+from op_env._cli import main as cli_main
+from op_env.completion import (candidates, load_index, main, note_lookup, refresh_index,
+                               save_index, SUBCOMMAND_OPTIONS)
+
+INDEX = {'tags': ['API_KEY', 'WEB_DB_PASSWORD', 'WEB_DB_USERNAME'],
+         'titles': ['stripe', 'web db']}
+
+
+@pytest.fixture
+def index_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('OP_ENV_CACHE_DIR', str(tmp_path))
+    return completion.index_path()
+
+
+def test_candidates():
+    assert candidates([''], INDEX) == ['check', 'json', 'k8s', 'matrix', 'plan', 'run', 'sh',
+                                       '--help']
+    assert candidates(['j'], INDEX) == ['json']
+    assert candidates(['json', '-e', 'WEB'], INDEX) == ['WEB_DB_PASSWORD', 'WEB_DB_USERNAME']
+    assert candidates(['run', '--title', ''], INDEX) == ['stripe', 'web db']
+    assert candidates(['json', '--tag-prefix', ''], INDEX) == ['API_', 'WEB_', 'WEB_DB_']
+    assert candidates(['sh', '--backend', 'v'], INDEX) == ['v1', 'v2']
+    assert candidates(['k8s', '--sec'], INDEX) == ['--secret', '--secrets-file']
+    # arguments to run are left to the shell
+    assert candidates(['run', '-e', 'API_KEY', 'ec'], INDEX) == []
+
+
+@pytest.mark.parametrize('subcommand', sorted(SUBCOMMAND_OPTIONS))
+def test_subcommand_options_match_cli(subcommand, capsys):
+    with pytest.raises(SystemExit):
+        cli_main(['op-env', subcommand, '--help'])
+    help_options = set(re.findall(r'(?<![\w-])--[a-z][a-z-]*', capsys.readouterr().out))
+    assert help_options == set(SUBCOMMAND_OPTIONS[subcommand])
+
+
+def test_note_lookup_only_extends_existing_index(index_file):
+    note_lookup(['A'], ['t'])
+    assert not os.path.exists(index_file)
+    save_index(['B'], [], 100.0)
+    note_lookup(['A'], ['t'])
+    index, _ = load_index()
+    assert index == {'refreshed_at': 100.0, 'tags': ['A', 'B'], 'titles': ['t']}
+
+
+def test_refresh_index_lists_items_once(index_file, monkeypatch):
+    monkeypatch.delenv('OP_ENV_BACKEND', raising=False)
+    listing = [{'uuid': 'a', 'overview': {'title': 'web db', 'tags': ['B', 'A']}},
+               {'uuid': 'b', 'overview': {'title': 'stripe', 'tags': ['A']}}]
+    with patch('op_env.op._op_check_output', return_value=json.dumps(listing)) as check_output:
+        refresh_index()
+    check_output.assert_called_once_with(['op', 'list', 'items'], phase='list')
+    index, age = load_index()
+    assert index['tags'] == ['A', 'B']
+    assert index['titles'] == ['stripe', 'web db']
+    assert age is not None and age < 60
+
+
+def test_completion_stays_light(index_file, tmp_path):
+    save_index(INDEX['tags'], INDEX['titles'], time.time())
+    script = """
+import sys, time
+start = time.perf_counter()
+from op_env.completion import main
+main(['op-env-complete', '--', 'json', '-e', 'WEB_DB_P'])
+print(time.perf_counter() - start, file=sys.stderr)
+print('pydantic' in sys.modules, 'op_env.op' in sys.modules, file=sys.stderr)
+"""
+    done = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                          env={**os.environ, 'OP_ENV_CACHE_DIR': str(tmp_path)}, check=True)
+    assert done.stdout == 'WEB_DB_PASSWORD\n'
+    elapsed, loaded = done.stderr.splitlines()
+    assert loaded == 'False False'
+    assert float(elapsed) < 0.5
+
+
+def test_stale_index_is_refreshed_in_background(index_file, capsys):
+    save_index(['A'], [], time.time() - 2 * completion.REFRESH_AFTER)
+    with patch('op_env.completion.spawn_index_refresh') as spawn:
+        assert main(['op-env-complete', '--', 'json', '-e', '']) == 0
+        spawn.assert_called_once_with()
+        # a refresh which has just started or failed isn't tried again at once
+        open(f'{index_file}.lock', 'w').close()
+        main(['op-env-complete', '--', 'json', '-e', ''])
+        spawn.assert_called_once_with()
+    assert capsys.readouterr().out == 'A\nA\n'
+
+
+@pytest.mark.parametrize('shell', ['bash', 'zsh', 'fish'])
+def test_scripts(shell, capsys):
+    assert main(['op-env-complete', '--script', shell]) == 0
+    assert 'op-env-complete -- ' in capsys.readouterr().out
+    assert main(['op-env-complete', '--script', 'tcsh']) == 2
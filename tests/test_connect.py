@@ -0,0 +1,195 @@
+"""Tests for `op_env.connect`, against a local stand-in Connect server."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+import pytest
+
+from op_env.connect import ConnectBackend, ConnectOPLookupError
+from op_env.op import (AutoOpBackend, FieldReference, NoEntriesOPLookupError, Resolver,
+                       select_backend, TooManyEntriesOPLookupError)
+
+TOKEN = 'test-token'
+
+VAULTS = [{'id': 'vault1', 'name': 'prod'}, {'id': 'vault2', 'name': 'staging'}]
+
+ITEMS = {
+    'vault1': [
+        {
+            'id': 'item1', 'title': 'web db', 'tags': ['WEB_DB_PASSWORD', 'WEB_DB_USERNAME'],
+            'vault': {'id': 'vault1'},
+            'fields': [
+                {'id': 'username', 'label': 'username', 'value': 'webuser'},
+                {'id': 'password', 'label': 'password', 'value': 'p@ss'},
+            ],
+        },
+        {
+            'id': 'item2', 'title': 'stripe', 'tags': ['STRIPE_API_KEY'],
+            'vault': {'id': 'vault1'},
+            'fields': [{'id': 'abc', 'label': 'key', 'value': 'sk_123'}],
+        },
+    ],
+    'vault2': [
+        {
+            'id': 'item3', 'title': 'web db', 'tags': ['DUPLICATE'],
+            'vault': {'id': 'vault2'},
+            'fields': [{'id': 'password', 'label': 'password', 'value': 'staging'}],
+        },
+        {
+            'id': 'item4', 'title': 'other', 'tags': ['DUPLICATE'],
+            'vault': {'id': 'vault2'}, 'fields': [],
+        },
+    ],
+}
+
+
+class StandInConnectHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', etag=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('If-None-Match')))
+        server.client_ports.add(self.client_address[1])
+        if self.headers.get('Authorization') != f'Bearer {TOKEN}':
+            return self._send(401)
+        parts = self.path.strip('/').split('/')
+        if parts == ['v1', 'vaults']:
+            data = VAULTS
+        elif len(parts) == 4 and parts[3] == 'items':
+            data = [{k: v for k, v in item.items() if k != 'fields'}
+                    for item in ITEMS.get(parts[2], [])]
+        elif len(parts) == 5:
+            matches = [item for item in ITEMS.get(parts[2], []) if item['id'] == parts[4]]
+            if not matches:
+                return self._send(404)
+            data = matches[0]
+        else:
+            return self._send(404)
+        etag = f'"{server.version}-{self.path}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, etag=etag)
+        self._send(200, json.dumps(data).encode('utf-8'), etag=etag)
+
+
+@pytest.fixture
+def connect_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInConnectHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.client_ports = set()
+    server.version = 1
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backend(connect_server):
+    host = f'http://127.0.0.1:{connect_server.server_address[1]}'
+    backend = ConnectBackend(host=host, token=TOKEN, max_connections=2)
+    yield backend
+    backend.client.pool.close()
+
+
+def test_connect_tagged_lookups(backend, connect_server):
+    with Resolver(backend=backend) as resolver:
+        out = resolver.resolve(['WEB_DB_USERNAME', 'WEB_DB_PASSWORD', 'STRIPE_API_KEY'], [])
+    assert out == {
+        'WEB_DB_USERNAME': 'webuser',
+        'WEB_DB_PASSWORD': 'p@ss',
+        'STRIPE_API_KEY': 'sk_123',
+    }
+    paths = sorted(path for path, _ in connect_server.requests)
+    assert paths == [
+        '/v1/vaults',
+        '/v1/vaults/vault1/items',
+        '/v1/vaults/vault1/items/item1',
+        '/v1/vaults/vault1/items/item2',
+        '/v1/vaults/vault2/items',
+    ]
+    # five requests over no more connections than the pool allows
+    assert len(connect_server.client_ports) <= 2
+
+
+def test_connect_tag_prefix_lookups(backend, connect_server):
+    with Resolver(backend=backend) as resolver:
+        out = resolver.resolve_tag_prefixes(['WEB_'])
+    assert out == {'WEB_DB_USERNAME': 'webuser', 'WEB_DB_PASSWORD': 'p@ss'}
+    assert sorted(path for path, _ in connect_server.requests) == [
+        '/v1/vaults',
+        '/v1/vaults/vault1/items',
+        '/v1/vaults/vault1/items/item1',
+        '/v1/vaults/vault2/items',
+    ]
+
+
+def test_connect_revalidates_with_etags(backend, connect_server):
+    with Resolver(backend=backend) as resolver:
+        first = resolver.resolve(['STRIPE_API_KEY'], [])
+        connect_server.requests.clear()
+        second = resolver.resolve(['STRIPE_API_KEY'], [])
+    assert first == second == {'STRIPE_API_KEY': 'sk_123'}
+    assert connect_server.requests
+    assert all(etag is not None for _, etag in connect_server.requests)
+
+
+def test_connect_item_and_title_lookups(backend):
+    field_mapping = {
+        'PROD_PASSWORD': FieldReference(field='password', item='web db', vault='prod'),
+        'STAGING_PASSWORD': FieldReference(field='password', item='web db', vault='vault2'),
+    }
+    with Resolver(backend=backend, field_mapping=field_mapping) as resolver:
+        out = resolver.resolve(['PROD_PASSWORD', 'STAGING_PASSWORD'], ['stripe'])
+    assert out == {
+        'PROD_PASSWORD': 'p@ss',
+        'STAGING_PASSWORD': 'staging',
+        'STRIPE_API_KEY': 'sk_123',
+    }
+
+
+def test_connect_partial_lookups(backend):
+    field_mapping = {'AMBIGUOUS': FieldReference(field='password', item='web db')}
+    with Resolver(backend=backend, field_mapping=field_mapping) as resolver:
+        result = resolver.resolve_partial(['STRIPE_API_KEY', 'DUPLICATE', 'MISSING',
+                                           'AMBIGUOUS'],
+                                          ['no such title'])
+    assert result.values == {'STRIPE_API_KEY': 'sk_123'}
+    assert isinstance(result.env_var_errors['DUPLICATE'], TooManyEntriesOPLookupError)
+    assert isinstance(result.env_var_errors['MISSING'], NoEntriesOPLookupError)
+    assert isinstance(result.env_var_errors['AMBIGUOUS'], TooManyEntriesOPLookupError)
+    assert isinstance(result.title_errors['no such title'], NoEntriesOPLookupError)
+
+
+def test_connect_bad_token(connect_server):
+    host = f'http://127.0.0.1:{connect_server.server_address[1]}'
+    backend = ConnectBackend(host=host, token='wrong')
+    with pytest.raises(ConnectOPLookupError, match='HTTP 401') as excinfo:
+        backend.env_lookups(['STRIPE_API_KEY'], {})
+    assert excinfo.value.status == 401
+
+
+def test_select_connect_backend(monkeypatch):
+    monkeypatch.delenv('OP_CONNECT_HOST', raising=False)
+    monkeypatch.delenv('OP_CONNECT_TOKEN', raising=False)
+    with pytest.raises(ValueError, match='needs OP_CONNECT_HOST and OP_CONNECT_TOKEN'):
+        select_backend('connect')
+    monkeypatch.setenv('OP_CONNECT_HOST', 'http://localhost:8080')
+    monkeypatch.setenv('OP_CONNECT_TOKEN', TOKEN)
+    assert isinstance(select_backend('connect'), ConnectBackend)
+    auto = select_backend('auto')
+    assert isinstance(auto, AutoOpBackend)
+    assert isinstance(auto.detected(), ConnectBackend)
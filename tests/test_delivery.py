@@ -0,0 +1,50 @@
+"""Tests for `op_env.delivery`."""
+
+import os
+import stat
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+
+from op_env.delivery import delivered_env, SecretFileDirError
+
+
+def test_delivered_env_via_file():
+    with delivered_env({'A': 'a', 'BIG': 'x' * 1000000},
+                       file_env_var_names=['BIG']) as delivered:
+        assert delivered.env['A'] == 'a'
+        path = delivered.env['BIG']
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        with open(path) as f:
+            assert f.read() == 'x' * 1000000
+        assert delivered.pass_fds == ()
+    assert not os.path.exists(path)
+
+
+def test_delivered_env_via_fd():
+    value = 'y' * 1000000
+    with delivered_env({'BIG': value}, fd_env_var_names=['BIG']) as delivered:
+        script = ('import os, sys\n'
+                  'with os.fdopen(int(os.environ["BIG"]), "rb") as f:\n'
+                  '    sys.stdout.write(str(len(f.read())))\n')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env={**os.environ, **delivered.env},
+                                         pass_fds=delivered.pass_fds)
+    assert output == str(len(value)).encode('ascii')
+
+
+def test_delivered_env_child_ignoring_fd_does_not_hang():
+    with delivered_env({'BIG': 'z' * 1000000}, fd_env_var_names=['BIG']) as delivered:
+        subprocess.check_call([sys.executable, '-c', 'pass'],
+                              env={**os.environ, **delivered.env},
+                              pass_fds=delivered.pass_fds)
+
+
+def test_delivered_env_refuses_disk_backed_files(monkeypatch):
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    with patch('op_env.delivery.os.access', return_value=False), \
+            pytest.raises(SecretFileDirError, match='try --fd-variable'):
+        with delivered_env({'A': 'a'}, file_env_var_names=['A']):
+            pass
@@ -0,0 +1,101 @@
+"""Tests for `op_env.item_cache`."""
+
+import json
+from unittest.mock import patch
+
+import pytest
+
+from op_env import metrics
+from op_env._cli import main
+from op_env.item_cache import item_version, ItemVersionCache
+from op_env.op import do_lookups, do_partial_lookups, FieldReference
+from op_env.store import SnapshotStore
+from .conftest import ITEMS
+
+NAMES = ['WEB_DB_USERNAME', 'WEB_DB_PASSWORD', 'STRIPE_API_KEY']
+
+
+@pytest.fixture
+def versioned_items(fake_op, tmp_path):
+    items = [dict(item, version=1) for item in json.loads(json.dumps(ITEMS))]
+
+    def write(changes={}):
+        for item in items:
+            if item['title'] in changes:
+                item['version'] += 1
+                item['fields'][0]['value'] = changes[item['title']]
+        (tmp_path / 'items.json').write_text(json.dumps(items))
+    write()
+    return write
+
+
+def test_item_version():
+    assert item_version({'uuid': 'a', 'itemVersion': 3, 'updatedAt': 'x'}) == \
+        'itemVersion=3;updatedAt=x'
+    assert item_version({'id': 'a', 'version': 2}) == 'version=2'
+    assert item_version({'uuid': 'a'}) is None
+
+
+def test_v2_fetches_only_changed_items(versioned_items, fake_op):
+    cache = ItemVersionCache()
+    first = do_lookups(NAMES, [], backend='v2', item_cache=cache)
+    assert do_lookups(NAMES, [], backend='v2', item_cache=cache) == first
+    assert [call[:2] for call in fake_op()] == [['item', 'list'], ['item', 'get'],
+                                                ['item', 'list']]
+    versioned_items({'stripe': 'sk_456'})
+    cached = do_lookups(NAMES, [], backend='v2', item_cache=cache)
+    assert cached == do_lookups(NAMES, [], backend='v2')
+    assert cached['STRIPE_API_KEY'] == 'sk_456'
+    assert (cache.hits, cache.misses) == (3, 3)
+    assert cache.hit_rate == 0.5
+
+
+def test_v1_fetches_only_changed_items():
+    listing = [{'uuid': 'a', 'itemVersion': 1, 'overview': {'tags': ['A']}},
+               {'uuid': 'b', 'itemVersion': 1, 'overview': {'tags': ['B']}}]
+    fetched = []
+
+    def fake_run_op(command, input, timeout):
+        if command[1] == 'list':
+            return json.dumps(listing).encode('utf-8')
+        items = json.loads(input)
+        fetched.append([item['uuid'] for item in items])
+        return b''.join(json.dumps({'a': f"{item['uuid']}{item['itemVersion']}",
+                                    'b': f"{item['uuid']}{item['itemVersion']}"}).encode() + b'\n'
+                        for item in items)
+    cache = ItemVersionCache()
+    aggregator = metrics.PrometheusAggregator()
+    with patch('op_env.op._run_op', side_effect=fake_run_op), metrics.observing(aggregator):
+        assert do_lookups(['A', 'B'], [], item_cache=cache) == {'A': 'a1', 'B': 'b1'}
+        listing[1]['itemVersion'] = 2
+        result = do_partial_lookups(['A', 'B'], [], item_cache=cache)
+        # asking for other fields fetches unchanged items again
+        do_partial_lookups(['A', 'B'], [], field_mapping={'A': FieldReference(field='c')},
+                           item_cache=cache)
+    assert result.values == {'A': 'a1', 'B': 'b2'}
+    assert fetched == [['a', 'b'], ['b'], ['a', 'b']]
+    assert 'op_env_cache_requests_total{cache="items",result="hit"} 1' in aggregator.render()
+
+
+def test_saved_encrypted_between_runs(versioned_items, fake_op, tmp_path):
+    fernet = pytest.importorskip('cryptography.fernet')
+    key = fernet.Fernet.generate_key()
+    store = SnapshotStore(directory=str(tmp_path / 'cache'), key=key)
+    do_lookups(NAMES, [], backend='v2', item_cache=ItemVersionCache(store))
+    assert b'sk_123' not in open(store.path('item-cache'), 'rb').read()
+    cache = ItemVersionCache(SnapshotStore(directory=str(tmp_path / 'cache'), key=key))
+    do_lookups(NAMES, [], backend='v2', item_cache=cache)
+    assert cache.hit_rate == 1.0
+    assert [call[:2] for call in fake_op()] == [['item', 'list'], ['item', 'get'],
+                                                ['item', 'list']]
+
+
+def test_cli_item_cache(versioned_items, fake_op, tmp_path, monkeypatch, capsys):
+    pytest.importorskip('cryptography.fernet')
+    monkeypatch.setenv('OP_ENV_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'config'))
+    for _ in range(2):
+        main(['op-env', 'json', '--backend', 'v2', '--item-cache', '-e', 'STRIPE_API_KEY'])
+        assert json.loads(capsys.readouterr().out) == {'STRIPE_API_KEY': 'sk_123'}
+    assert [call[:2] for call in fake_op()] == [['item', 'list'], ['item', 'get'],
+                                                ['item', 'list']]
@@ -0,0 +1,86 @@
+"""Tests for `op_env.k8s`."""
+
+import base64
+import io
+import os
+import stat
+
+import pytest
+import yaml
+
+from op_env.k8s import (load_secret_specs, parse_secret_spec, SecretSpec, stream_manifests,
+                        write_manifests)
+
+
+def test_parse_secret_spec():
+    assert parse_secret_spec('prod/web') == SecretSpec(namespace='prod', name='web')
+    with pytest.raises(ValueError, match='NAMESPACE/NAME'):
+        parse_secret_spec('web')
+
+
+def test_load_secret_specs_fans_out_namespaces(tmp_path):
+    secrets_file = tmp_path / 'secrets.yml'
+    secrets_file.write_text(yaml.dump([
+        {'name': 'web', 'namespaces': ['staging', 'prod'], 'environment': ['A']},
+        {'name': 'worker'},
+    ]))
+    assert load_secret_specs(str(secrets_file)) == [
+        SecretSpec(namespace='staging', name='web', environment=['A']),
+        SecretSpec(namespace='prod', name='web', environment=['A']),
+        SecretSpec(namespace='default', name='worker', environment=None),
+    ]
+
+
+def test_stream_manifests():
+    out = io.StringIO()
+    stream_manifests([SecretSpec(namespace='prod', name='web', environment=['A'])],
+                     {'A': 'secret', 'B': 'other'},
+                     out)
+    manifest = yaml.safe_load(out.getvalue())
+    assert manifest['kind'] == 'Secret'
+    assert manifest['metadata'] == {'name': 'web', 'namespace': 'prod'}
+    assert manifest['data'] == {'A': base64.b64encode(b'secret').decode('ascii')}
+
+
+def test_stream_manifests_missing_value():
+    with pytest.raises(LookupError, match='No value found for C in secret prod/web'):
+        stream_manifests([SecretSpec(namespace='prod', name='web', environment=['C'])],
+                         {'A': 'secret'},
+                         io.StringIO())
+
+
+def test_write_manifests_skips_unchanged(tmp_path):
+    specs = [SecretSpec(namespace='prod', name='web', environment=['A']),
+             SecretSpec(namespace='prod', name='worker', environment=['B'])]
+    written = list(write_manifests(specs, {'A': 'a', 'B': 'b'}, str(tmp_path)))
+    assert [os.path.basename(path) for path in written] == [
+        'prod.web.yaml', 'prod.worker.yaml'
+    ]
+    written = list(write_manifests(specs, {'A': 'a', 'B': 'changed'}, str(tmp_path)))
+    assert [os.path.basename(path) for path in written] == ['prod.worker.yaml']
+
+
+def test_load_secret_specs_rejects_scalar_namespaces(tmp_path):
+    secrets_file = tmp_path / 'secrets.yml'
+    secrets_file.write_text(yaml.dump([{'name': 'web', 'namespaces': 'prod'}]))
+    with pytest.raises(ValueError, match='namespaces must be a list; found prod'):
+        load_secret_specs(str(secrets_file))
+
+
+@pytest.mark.parametrize('previous', ['data: {A: not base64!}\n', 'data: {A: 42}\n', '{[\n'])
+def test_write_manifests_rewrites_unreadable_manifest(tmp_path, previous):
+    specs = [SecretSpec(namespace='prod', name='web', environment=['A'])]
+    (tmp_path / 'prod.web.yaml').write_text(previous)
+    written = list(write_manifests(specs, {'A': 'a'}, str(tmp_path)))
+    assert [os.path.basename(path) for path in written] == ['prod.web.yaml']
+
+
+def test_write_manifests_makes_existing_files_private(tmp_path):
+    specs = [SecretSpec(namespace='prod', name='web', environment=['A'])]
+    path = tmp_path / 'prod.web.yaml'
+    path.write_text('data: {A: b2xk}\n')
+    path.chmod(0o644)
+    list(write_manifests(specs, {'A': 'new'}, str(tmp_path)))
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    assert yaml.safe_load(path.read_text())['data'] == {'A': 'bmV3'}
+    assert os.listdir(tmp_path) == ['prod.web.yaml']
@@ -0,0 +1,53 @@
+"""Tests for `op_env.lazy`."""
+
+from unittest.mock import patch
+
+import pytest
+
+import op_env
+from op_env.lazy import LazyOpEnviron
+from op_env.op import NoEntriesOPLookupError
+
+
+@patch('op_env.op._do_env_lookups_partial', autospec=op_env.op._do_env_lookups_partial)
+def test_lazy_environ_resolves_nothing_up_front(_do_env_lookups_partial):
+    environ = LazyOpEnviron(['A', 'B'])
+    assert len(environ) == 2
+    assert list(environ) == ['A', 'B']
+    assert 'A' in environ
+    assert 'C' not in environ
+    _do_env_lookups_partial.assert_not_called()
+
+
+@patch('op_env.op._do_env_lookups_partial', autospec=op_env.op._do_env_lookups_partial)
+def test_lazy_environ_batches_pending_names_on_first_miss(_do_env_lookups_partial):
+    _do_env_lookups_partial.return_value = ({'A': 'a', 'B': 'b', 'C': 'c'}, {})
+    environ = LazyOpEnviron(['A', 'B', 'C'])
+    assert environ['B'] == 'b'
+    assert environ['A'] == 'a'
+    assert dict(environ) == {'A': 'a', 'B': 'b', 'C': 'c'}
+    _do_env_lookups_partial.assert_called_once_with(['A', 'B', 'C'], {})
+    assert environ.pending == []
+
+
+@patch('op_env.op._do_env_lookups_partial', autospec=op_env.op._do_env_lookups_partial)
+def test_lazy_environ_undeclared_name(_do_env_lookups_partial):
+    environ = LazyOpEnviron(['A'])
+    with pytest.raises(KeyError):
+        environ['B']
+    assert environ.get('B') is None
+    _do_env_lookups_partial.assert_not_called()
+
+
+@patch('op_env.op._do_env_lookups_partial', autospec=op_env.op._do_env_lookups_partial)
+def test_lazy_environ_failing_name_only_affects_itself(_do_env_lookups_partial):
+    missing = NoEntriesOPLookupError('No 1Password entries with tag MISSING found')
+    _do_env_lookups_partial.return_value = ({'GOOD': 'g'}, {'MISSING': missing})
+    environ = LazyOpEnviron(['GOOD', 'MISSING'])
+    for _ in range(2):
+        assert environ['GOOD'] == 'g'
+        with pytest.raises(NoEntriesOPLookupError, match='MISSING'):
+            environ['MISSING']
+    assert environ.get('GOOD') == 'g'
+    _do_env_lookups_partial.assert_called_once_with(['GOOD', 'MISSING'], {})
+    assert environ.pending == []
@@ -0,0 +1,79 @@
+"""Tests for `op_env.matrix`."""
+
+import json
+
+import pytest
+
+from op_env._cli import main
+from op_env.matrix import diff_environments, parse_selector, resolve_matrix
+from op_env.op import PartialLookupResult
+
+
+def test_parse_selector():
+    assert parse_selector('prod=prefix:PROD_') == ('prod', 'prefix', 'PROD_')
+    assert parse_selector('bare=prefix:') == ('bare', 'prefix', '')
+    assert parse_selector('db=title:web db') == ('db', 'title', 'web db')
+    for bad in ['prod', 'prod=PROD_', 'prod=vault:prod', '=title:x', 'work=account:']:
+        with pytest.raises(ValueError, match='Environment must be given as'):
+            parse_selector(bad)
+
+
+def test_matrix_shares_listings(fake_op):
+    selectors = [parse_selector(selector)
+                 for selector in ['web=prefix:WEB_', 'none=prefix:NONE_', 'item=title:web db',
+                                  'work=account:work']]
+    results = resolve_matrix(['DB_PASSWORD', 'DB_USERNAME'], selectors, backend='v2')
+    assert results['web'].values == {'DB_PASSWORD': 'multi\nline', 'DB_USERNAME': 'webuser'}
+    assert set(results['none'].env_var_errors) == {'DB_PASSWORD', 'DB_USERNAME'}
+    assert results['item'].values == {}
+    assert str(results['item'].env_var_errors['DB_PASSWORD']) == \
+        '1Password item web db has no field tagged DB_PASSWORD'
+    assert set(results['work'].env_var_errors) == {'DB_PASSWORD', 'DB_USERNAME'}
+    # both prefixes share one listing and one fetch
+    assert sorted(call[:3] for call in fake_op()) == [
+        ['item', 'get', '-'],
+        ['item', 'get', 'web db'],
+        ['item', 'list', '--tags'],
+        ['item', 'list', '--tags'],
+    ]
+    prefix_listings = [call for call in fake_op() if '--account' not in call and
+                       call[:2] == ['item', 'list']]
+    assert prefix_listings[0][3] == \
+        'WEB_DB_PASSWORD,WEB_DB_USERNAME,NONE_DB_PASSWORD,NONE_DB_USERNAME'
+
+
+def test_diff_environments():
+    results = {
+        'dev': PartialLookupResult(values={'A': 'x', 'B': 'y', 'C': 'z'},
+                                   env_var_errors={}, title_errors={}),
+        'prod': PartialLookupResult(values={'A': 'x', 'B': 'changed'},
+                                    env_var_errors={}, title_errors={}),
+    }
+    diff = diff_environments(results, ['A', 'B', 'C'], key=b'k')
+    assert [name_diff.status for name_diff in diff.values()] == ['same', 'changed', 'missing']
+    assert diff['A'].hashes['dev'] == diff['A'].hashes['prod']
+    assert diff['C'].hashes['prod'] is None
+    assert len(diff['A'].hashes['dev']) == 12
+    # a fresh key each time unless one is given
+    assert diff_environments(results, ['A'])['A'] != diff_environments(results, ['A'])['A']
+
+
+def test_cli_matrix_diff_only(fake_op, capsys):
+    assert main(['op-env', 'matrix', '--backend', 'v2', '-e', 'WEB_DB_PASSWORD',
+                 '-e', 'STRIPE_API_KEY', '--env', 'a=prefix:', '--env', 'b=title:web db',
+                 '--diff-only']) == 1
+    out = capsys.readouterr().out
+    assert 'multi' not in out and 'sk_123' not in out
+    document = json.loads(out)
+    assert list(document['environments']['a']) == ['errors']
+    assert document['environments']['b']['errors'] == {
+        'STRIPE_API_KEY': '1Password item web db has no field tagged STRIPE_API_KEY',
+    }
+    assert document['diff']['WEB_DB_PASSWORD']['status'] == 'same'
+    assert document['diff']['STRIPE_API_KEY']['status'] == 'missing'
+
+
+def test_cli_matrix_rejects_repeated_labels(capsys):
+    with pytest.raises(SystemExit):
+        main(['op-env', 'matrix', '-e', 'A', '--env', 'a=prefix:', '--env', 'a=prefix:X_'])
+    assert 'each --env needs a different LABEL' in capsys.readouterr().err
@@ -0,0 +1,82 @@
+"""Tests for `op_env.metrics`."""
+
+import json
+from subprocess import CalledProcessError
+from unittest.mock import patch
+
+import pytest
+
+import op_env
+from op_env import metrics
+from op_env.op import _do_env_lookups
+
+
+@pytest.fixture
+def aggregator():
+    aggregator = metrics.PrometheusAggregator(buckets=(0.1, 1.0))
+    metrics.add_observer(aggregator)
+    yield aggregator
+    metrics.remove_observer(aggregator)
+
+
+def test_argv_shape_hides_tags_and_titles():
+    assert metrics.argv_shape(['op', 'list', 'items', '--tags', 'SECRET_A,SECRET_B']) ==\
+        ('op', 'list', 'items', '--tags', '?')
+    assert metrics.argv_shape(['op', 'get', 'item', 'My Title']) ==\
+        ('op', 'get', 'item', '?')
+
+
+def test_disabled_without_observers():
+    assert not metrics.enabled()
+    with metrics.observing(lambda event: None):
+        assert metrics.enabled()
+    assert not metrics.enabled()
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_do_env_lookups_emits_events(subprocess, aggregator):
+    events = []
+    list_output = json.dumps([{"uuid": "dummy",
+                               "overview": {"tags": ["ANY_TEST_VALUE"]}}]).encode('utf-8')
+    get_output = b'{"any_test_value":"v1","value":""}\n'
+    subprocess.check_output.side_effect = [list_output, get_output]
+    with metrics.observing(events.append):
+        _do_env_lookups(['ANY_TEST_VALUE'])
+    subprocess_events = [event for event in events
+                         if isinstance(event, metrics.OpSubprocessEvent)]
+    assert [event.argv_shape for event in subprocess_events] == [
+        ('op', 'list', 'items', '--tags', '?'),
+        ('op', 'get', 'item', '-', '--fields', '?'),
+    ]
+    assert subprocess_events[0].bytes_out == len(list_output)
+    assert subprocess_events[1].bytes_in > 0
+    assert [event.phase for event in events
+            if isinstance(event, metrics.OpParseEvent)] == ['list_items', 'get_fields']
+    rendered = aggregator.render()
+    assert 'op_env_subprocess_total{command="op list items",exit_status="0"} 1' in rendered
+    assert ('op_env_subprocess_bytes_total{command="op get item",direction="out"} '
+            f'{len(get_output)}') in rendered
+    assert 'op_env_subprocess_duration_seconds_count{command="op list items"} 1' in rendered
+    assert 'op_env_parse_duration_seconds_count{phase="get_fields"} 1' in rendered
+    assert 'ANY_TEST_VALUE' not in rendered
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_failed_subprocess_records_exit_status(subprocess, aggregator):
+    subprocess.check_output.side_effect = CalledProcessError(1, ['op'])
+    with pytest.raises(CalledProcessError):
+        _do_env_lookups(['ANY_TEST_VALUE'])
+    assert ('op_env_subprocess_total{command="op list items",exit_status="1"} 1'
+            in aggregator.render())
+
+
+def test_histogram_buckets_are_cumulative(aggregator):
+    for duration in (0.05, 0.5, 5.0):
+        aggregator(metrics.OpParseEvent(phase='get_title', duration=duration, size=10))
+    aggregator(metrics.OpCacheEvent(cache='values', hit=True))
+    rendered = aggregator.render()
+    assert 'op_env_parse_duration_seconds_bucket{phase="get_title",le="0.1"} 1' in rendered
+    assert 'op_env_parse_duration_seconds_bucket{phase="get_title",le="1.0"} 2' in rendered
+    assert 'op_env_parse_duration_seconds_bucket{phase="get_title",le="+Inf"} 3' in rendered
+    assert 'op_env_parse_bytes_total{phase="get_title"} 30' in rendered
+    assert 'op_env_cache_requests_total{cache="values",result="hit"} 1' in rendered
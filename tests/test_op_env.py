@@ -6,9 +6,12 @@ import argparse
 import io
 import json
 import os
+import signal
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 from typing import Dict
 from unittest.mock import ANY, call, patch
 
@@ -17,22 +20,38 @@ import yaml
 
 
 import op_env
-from op_env._cli import Arguments, main, parse_argv, process_args
+from op_env._cli import (Arguments, load_field_mapping, lookup_argv, lookup_snapshot_name, main,
+                         parse_argv, process_args)
+from op_env.k8s import SecretSpec
 from op_env.op import (
+    _current_account,
     _do_env_lookups,
     _do_title_lookups,
     _fields_from_title,
     _op_fields_to_try,
     _op_pluck_correct_field,
+    account,
+    AccountLookup,
+    ConflictingValuesOPLookupError,
+    deadline,
+    do_lookups,
+    do_partial_lookups,
     EnvVarName,
     FieldName,
+    FieldReference,
     FieldValue,
     InvalidTagOPLookupError,
+    iter_partial_lookups,
     NoEntriesOPLookupError,
     NoFieldValueOPLookupError,
+    PartialLookupResult,
+    Resolver,
+    TimeoutOPLookupError,
     Title,
     TooManyEntriesOPLookupError,
 )
+from op_env.store import Snapshot
+from op_env.supervisor import ProcfileEntry
 
 
 @pytest.fixture
@@ -224,8 +243,10 @@ def test_process_args_shows_json_with_simple_env(stdout_stringio,
                                                  op_get_item,
                                                  op_consolidated_fields,
                                                  op_list_items) -> None:
-    list_items_output = op_list_items.return_value
-    all_fields_to_seek = op_consolidated_fields.return_value
+    list_items_output = [op_list_items.return_value]
+    op_list_items.return_value = list_items_output
+    all_fields_to_seek = {FieldName('password')}
+    op_consolidated_fields.return_value = all_fields_to_seek
     Dict[EnvVarName, Dict[FieldName, FieldValue]]
     retval: Dict[EnvVarName, Dict[FieldName, FieldValue]] = {
         EnvVarName('a'): {
@@ -266,6 +287,61 @@ def test_process_args_runs_simple_command_with_simple_env(subprocess,
                                                   'ORIGINAL_ENV': 'TRUE'})
 
 
+@patch.dict(os.environ, {'ORIGINAL_ENV': 'TRUE'}, clear=True)
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+def test_process_args_runs_command_with_file_variable(do_lookups, tmp_path):
+    output_file = tmp_path / 'output'
+    command = [sys.executable, '-c',
+               'import os, sys\n'
+               'with open(sys.argv[1], "w") as out, open(os.environ["a"]) as f:\n'
+               '    out.write(f.read())\n',
+               str(output_file)]
+    args = {'operation': 'run', 'command': command,
+            'environment': ['a'], 'title': [], 'file_variable': ['a']}
+    do_lookups.return_value = {'a': 'big value'}
+    process_args(args)
+    assert output_file.read_text() == 'big value'
+
+
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+def test_process_args_run_forwards_sigterm_before_removing_files(do_lookups, tmp_path):
+    output_file = tmp_path / 'output'
+    command = [sys.executable, '-c',
+               'import os, signal, sys, time\n'
+               'def stop(signum, frame):\n'
+               '    with open(sys.argv[1], "w") as out:\n'
+               '        out.write(open(os.environ["a"]).read())\n'
+               '    sys.exit(3)\n'
+               'signal.signal(signal.SIGTERM, stop)\n'
+               'open(sys.argv[1] + ".started", "w").close()\n'
+               'time.sleep(30)\n',
+               str(output_file)]
+    args = {'operation': 'run', 'command': command,
+            'environment': ['a'], 'title': [], 'file_variable': ['a']}
+    do_lookups.return_value = {'a': 'big value'}
+
+    def terminate() -> None:
+        while not os.path.exists(f'{output_file}.started'):
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+    threading.Thread(target=terminate, daemon=True).start()
+    assert process_args(args) == 3
+    # the command could still read its file after op-env was told to stop
+    assert output_file.read_text() == 'big value'
+
+
+@patch.dict(os.environ, {'ORIGINAL_ENV': 'TRUE'}, clear=True)
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('op_env._cli.subprocess', autospec=op_env._cli.subprocess)
+def test_process_args_run_rejects_unknown_fd_variable(subprocess, do_lookups):
+    args = {'operation': 'run', 'command': ['env'],
+            'environment': ['a'], 'title': [], 'fd_variable': ['b']}
+    do_lookups.return_value = {'a': '1'}
+    with pytest.raises(ValueError, match='b was not looked up'):
+        process_args(args)
+    subprocess.check_call.assert_not_called()
+
+
 @patch.dict(os.environ, {'ORIGINAL_ENV': 'TRUE'}, clear=True)
 @patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
 @patch('sys.stdout', new_callable=io.StringIO)
@@ -305,6 +381,105 @@ def test_process_args_shows_env_with_simple_env(stdout_stringio,
     assert stdout_stringio.getvalue() == 'a=b; export a\n'
 
 
+@patch('op_env._cli.SnapshotStore', autospec=op_env._cli.SnapshotStore)
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('op_env._cli.subprocess', autospec=op_env._cli.subprocess)
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_process_args_sh_stale_while_revalidate_serves_snapshot(stdout_stringio,
+                                                                subprocess,
+                                                                do_lookups,
+                                                                SnapshotStore):
+    store = SnapshotStore.return_value
+    store.load.return_value = Snapshot(values={'a': 'old'}, saved_at=time.time() - 10)
+    args = {'operation': 'sh', 'environment': ['a'], 'title': [],
+            'stale_while_revalidate': True, 'changed_marker': 'marker'}
+    process_args(args)
+    assert stdout_stringio.getvalue() == 'a=old; export a\n'
+    do_lookups.assert_not_called()
+    refresh_argv = subprocess.Popen.call_args[0][0]
+    assert refresh_argv[2:] == ['op_env._cli', 'sh', '--refresh-snapshot', '-e', 'a',
+                                '--changed-marker', 'marker']
+    assert subprocess.Popen.call_args[1]['start_new_session'] is True
+
+
+@patch('op_env._cli.SnapshotStore', autospec=op_env._cli.SnapshotStore)
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('op_env._cli.subprocess', autospec=op_env._cli.subprocess)
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_process_args_sh_stale_while_revalidate_blocks_when_too_stale(stdout_stringio,
+                                                                      subprocess,
+                                                                      do_lookups,
+                                                                      SnapshotStore):
+    store = SnapshotStore.return_value
+    store.load.return_value = Snapshot(values={'a': 'old'}, saved_at=time.time() - 100)
+    do_lookups.return_value = {'a': 'new'}
+    args = {'operation': 'sh', 'environment': ['a'], 'title': [],
+            'stale_while_revalidate': True, 'max_stale': 50}
+    process_args(args)
+    assert stdout_stringio.getvalue() == 'a=new; export a\n'
+    store.save.assert_called_with(ANY, {'a': 'new'})
+    subprocess.Popen.assert_not_called()
+
+
+def test_lookup_snapshot_name_separates_configurations(tmp_path, monkeypatch):
+    monkeypatch.delenv('OP_ENV_BACKEND', raising=False)
+    mapping_file = tmp_path / 'mapping.yml'
+    mapping_file.write_text(yaml.dump({'A': 'other field'}))
+
+    def name(*argv: str) -> str:
+        return lookup_snapshot_name(parse_argv(['op-env', 'sh', *argv]))
+    names = [
+        name('-e', 'A'),
+        name('-e', f'A={"a" * 26}'),
+        name('-e', 'A', '--field-mapping', str(mapping_file)),
+        name('-e', 'A', '--backend', 'v2'),
+    ]
+    assert len(set(names)) == len(names)
+    assert name('-e', 'A', '--backend', 'v1') == names[0]
+
+
+@patch('op_env._cli.SnapshotStore', autospec=op_env._cli.SnapshotStore)
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_process_args_sh_refresh_snapshot_touches_marker(stdout_stringio,
+                                                         do_lookups,
+                                                         SnapshotStore,
+                                                         tmp_path):
+    store = SnapshotStore.return_value
+    store.directory = str(tmp_path)
+    store.path.return_value = str(tmp_path / 'snapshot.lock')
+    store.save.return_value = True
+    do_lookups.return_value = {'a': 'new'}
+    marker = tmp_path / 'changed'
+    args = {'operation': 'sh', 'environment': ['a'], 'title': [],
+            'refresh_snapshot': True, 'changed_marker': str(marker)}
+    process_args(args)
+    assert stdout_stringio.getvalue() == ''
+    assert marker.exists()
+
+
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_process_args_k8s_looks_up_union_once(stdout_stringio, do_lookups, tmp_path):
+    secrets_file = tmp_path / 'secrets.yml'
+    secrets_file.write_text(yaml.dump([{'name': 'web',
+                                        'namespaces': ['staging', 'prod'],
+                                        'environment': ['B']}]))
+    do_lookups.return_value = {'A': 'a', 'B': 'b'}
+    args = {'operation': 'k8s', 'environment': ['A'], 'title': [],
+            'secret': [SecretSpec(namespace='default', name='all')],
+            'secrets_file': [str(secrets_file)]}
+    process_args(args)
+    do_lookups.assert_called_once_with(['A', 'B'], [])
+    manifests = list(yaml.safe_load_all(stdout_stringio.getvalue()))
+    assert [(manifest['metadata']['namespace'], manifest['metadata']['name'],
+             sorted(manifest['data'])) for manifest in manifests] == [
+                 ('default', 'all', ['A', 'B']),
+                 ('staging', 'web', ['B']),
+                 ('prod', 'web', ['B']),
+             ]
+
+
 @pytest.mark.skip(reason="need to mock op binary in test PATH")
 @patch.dict(os.environ, {'ORIGINAL_ENV': 'TRUE'}, clear=True)
 @patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
@@ -560,6 +735,463 @@ def test_op_do_env_lookups_one_var(subprocess):
     assert out == {'ANY_TEST_VALUE': 'v1'}
 
 
+@patch('op_env.op._fields_from_title', autospec=op_env.op._fields_from_title)
+@patch('op_env.op._do_env_lookups', autospec=op_env.op._do_env_lookups)
+def test_resolver_caches_values_between_calls(_do_env_lookups, _fields_from_title):
+    _do_env_lookups.side_effect = lambda names, field_mapping: {name: name.lower()
+                                                                for name in names}
+    _fields_from_title.return_value = {'T1': 't1val'}
+    with Resolver(cache_ttl=60) as resolver:
+        assert resolver.resolve(['A'], ['title']) == {'A': 'a', 'T1': 't1val'}
+        assert resolver.resolve(['A', 'B'], ['title']) == {'A': 'a', 'B': 'b', 'T1': 't1val'}
+    _do_env_lookups.assert_has_calls([call(['A'], {}), call(['B'], {})])
+    _fields_from_title.assert_called_once_with('title', {})
+
+
+@patch('op_env.op._fields_from_title', autospec=op_env.op._fields_from_title)
+@patch('op_env.op._do_env_lookups', autospec=op_env.op._do_env_lookups)
+def test_resolver_without_ttl_does_not_cache(_do_env_lookups, _fields_from_title):
+    _do_env_lookups.return_value = {'A': 'a'}
+    with Resolver() as resolver:
+        resolver.resolve(['A'], [])
+        resolver.resolve(['A'], [])
+    assert _do_env_lookups.call_count == 2
+
+
+@patch('op_env.op._fields_from_title', autospec=op_env.op._fields_from_title)
+@patch('op_env.op._do_env_lookups', autospec=op_env.op._do_env_lookups)
+def test_resolver_resolve_async_with_many_titles(_do_env_lookups, _fields_from_title):
+    _do_env_lookups.return_value = {}
+    _fields_from_title.side_effect = lambda title, field_mapping: {
+        EnvVarName(title.upper()): title
+    }
+    with Resolver(max_workers=1) as resolver:
+        future = resolver.resolve_async([], ['a', 'b', 'c'])
+        assert future.result(timeout=5) == {'A': 'a', 'B': 'b', 'C': 'c'}
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_env_lookups_with_field_mapping(subprocess):
+    list_output_data = [
+        {"uuid": "dummy1", "overview": {"tags": ["MAPPED_VALUE"]}},
+        {"uuid": "dummy2", "overview": {"tags": ["ANY_TEST_VALUE"]}},
+    ]
+    list_output = json.dumps(list_output_data).encode('utf-8')
+    get_output = b'{"secret key":"v1"}\n{"any_test_value":"v2","value":""}\n'
+    subprocess.check_output.side_effect = [
+        list_output,
+        get_output,
+    ]
+    field_mapping = {'MAPPED_VALUE': FieldReference(field='secret key')}
+    out = _do_env_lookups(['MAPPED_VALUE', 'ANY_TEST_VALUE'], field_mapping)
+    subprocess.check_output.\
+        assert_has_calls([call(['op', 'list', 'items', '--tags',
+                                'MAPPED_VALUE,ANY_TEST_VALUE']),
+                          call(['op', 'get', 'item', '-', '--fields',
+                                'any_test_value,secret key,value'],
+                               input=ANY)])
+    assert out == {'MAPPED_VALUE': 'v1', 'ANY_TEST_VALUE': 'v2'}
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_env_lookups_with_item_mapping_skips_list(subprocess):
+    subprocess.check_output.return_value = b'{"username":"u1","password":"p1"}'
+    field_mapping = {
+        'DB_USER': FieldReference(field='username', item='web-db', vault='prod'),
+        'DB_PASSWORD': FieldReference(field='password', item='web-db', vault='prod'),
+    }
+    out = _do_env_lookups(['DB_USER', 'DB_PASSWORD'], field_mapping)
+    subprocess.check_output.assert_called_once_with(['op', 'get', 'item', 'web-db',
+                                                     '--fields', 'password,username',
+                                                     '--vault', 'prod'])
+    assert out == {'DB_USER': 'u1', 'DB_PASSWORD': 'p1'}
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_env_lookups_with_item_mapping_single_field(subprocess):
+    subprocess.check_output.return_value = b'p1\n'
+    field_mapping = {'DB_PASSWORD': FieldReference(field='password', item='web-db')}
+    out = _do_env_lookups(['DB_PASSWORD'], field_mapping)
+    subprocess.check_output.assert_called_once_with(['op', 'get', 'item', 'web-db',
+                                                     '--fields', 'password'])
+    assert out == {'DB_PASSWORD': 'p1'}
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_env_lookups_with_item_mapping_keeps_trailing_newlines(subprocess):
+    subprocess.check_output.return_value = b'-----END KEY-----\n\n'
+    field_mapping = {'KEY': FieldReference(field='key', item='web-db')}
+    out = _do_env_lookups(['KEY'], field_mapping)
+    assert out == {'KEY': '-----END KEY-----\n'}
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_env_lookups_with_field_mapping_no_value(subprocess):
+    subprocess.check_output.return_value = b'\n'
+    field_mapping = {'DB_PASSWORD': FieldReference(field='secret', item='web-db')}
+    with pytest.raises(NoFieldValueOPLookupError,
+                       match='1Password entry for DB_PASSWORD has no value for mapped '
+                       'field secret'):
+        _do_env_lookups(['DB_PASSWORD'], field_mapping)
+
+
+def test_load_field_mapping(tmp_path):
+    mapping_file = tmp_path / 'mapping.yml'
+    mapping_file.write_text(yaml.dump({
+        'A': 'field a',
+        'B': {'field': 'b', 'item': 'item b', 'vault': 'vault b'},
+    }))
+    assert load_field_mapping([str(mapping_file)]) == {
+        'A': FieldReference(field='field a'),
+        'B': FieldReference(field='b', item='item b', vault='vault b'),
+    }
+
+
+def test_load_field_mapping_invalid(tmp_path):
+    mapping_file = tmp_path / 'mapping.yml'
+    mapping_file.write_text(yaml.dump({'A': {'vault': 'v'}}))
+    with pytest.raises(argparse.ArgumentTypeError, match='Field mapping must map'):
+        load_field_mapping([str(mapping_file)])
+
+
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_process_args_json_with_field_mapping(stdout_stringio, do_lookups, tmp_path):
+    mapping_file = tmp_path / 'mapping.yml'
+    mapping_file.write_text(yaml.dump({'A': 'field a'}))
+    do_lookups.return_value = {'A': '1'}
+    args = {'operation': 'json', 'environment': ['A'], 'title': [],
+            'field_mapping': [str(mapping_file)]}
+    process_args(args)
+    do_lookups.assert_called_with(['A'], [],
+                                  field_mapping={'A': FieldReference(field='field a')})
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_env_lookups_passes_remaining_budget_as_timeout(subprocess):
+    list_output = json.dumps([{"uuid": "dummy",
+                               "overview": {"tags": ["ANY_TEST_VALUE"]}}]).encode('utf-8')
+    subprocess.check_output.side_effect = [
+        list_output,
+        b'{"any_test_value":"v1","value":""}\n',
+    ]
+    with deadline(30, per_call=5):
+        out = _do_env_lookups(['ANY_TEST_VALUE'])
+    assert out == {'ANY_TEST_VALUE': 'v1'}
+    for call_args in subprocess.check_output.call_args_list:
+        assert 0 < call_args[1]['timeout'] <= 5
+
+
+def test_op_do_env_lookups_kills_hung_op(tmp_path, monkeypatch):
+    hung_op = tmp_path / 'op'
+    hung_op.write_text('#!/bin/sh\nsleep 30\n')
+    hung_op.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path), prepend=os.pathsep)
+    start = time.monotonic()
+    with pytest.raises(TimeoutOPLookupError, match='op list call ran out of time') as excinfo:
+        with deadline(0.5):
+            _do_env_lookups(['ANY_TEST_VALUE'])
+    assert time.monotonic() - start < 10
+    assert excinfo.value.phase == 'list'
+    # op is given whatever is left of the budget, a hair under 0.5s
+    assert excinfo.value.timings['list'] >= 0.4
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_env_lookups_with_exhausted_budget(subprocess):
+    with pytest.raises(TimeoutOPLookupError) as excinfo:
+        with deadline(0):
+            _do_env_lookups(['ANY_TEST_VALUE'])
+    assert excinfo.value.phase == 'list'
+    subprocess.check_output.assert_not_called()
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_partial_lookups_collects_every_failure(subprocess):
+    list_output_data = [
+        {"uuid": "dummy1", "overview": {"tags": ["GOOD"]}},
+        {"uuid": "dummy2", "overview": {"tags": ["EMPTY"]}},
+        {"uuid": "dummy3", "overview": {"tags": ["TWICE"]}},
+        {"uuid": "dummy4", "overview": {"tags": ["TWICE"]}},
+    ]
+    subprocess.check_output.side_effect = [
+        json.dumps(list_output_data).encode('utf-8'),
+        b'{"good":"g","value":""}\n{"empty":"","value":""}\n',
+    ]
+    result = do_partial_lookups(['GOOD', 'EMPTY', 'TWICE', 'MISSING', 'BAD,NAME'], [])
+    assert result.values == {'GOOD': 'g'}
+    assert set(result.failed_env_var_names) == {'EMPTY', 'TWICE', 'MISSING', 'BAD,NAME'}
+    assert isinstance(result.env_var_errors['EMPTY'], NoFieldValueOPLookupError)
+    assert isinstance(result.env_var_errors['TWICE'], TooManyEntriesOPLookupError)
+    assert isinstance(result.env_var_errors['MISSING'], NoEntriesOPLookupError)
+    assert isinstance(result.env_var_errors['BAD,NAME'], InvalidTagOPLookupError)
+    assert not result.ok
+    subprocess.check_output.\
+        assert_has_calls([call(['op', 'list', 'items', '--tags', 'GOOD,EMPTY,TWICE,MISSING']),
+                          call(['op', 'get', 'item', '-', '--fields', 'empty,good'],
+                               input=ANY)])
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_partial_lookups_reports_unreadable_items_and_titles(subprocess):
+    subprocess.check_output.side_effect = [
+        op_env.op.CalledProcessError(1, 'op'),
+        op_env.op.CalledProcessError(1, 'op'),
+    ]
+    field_mapping = {'DB_PASSWORD': FieldReference(field='password', item='web-db')}
+    result = do_partial_lookups(['DB_PASSWORD'], ['some title'], field_mapping)
+    assert result.values == {}
+    assert result.failed_env_var_names == ['DB_PASSWORD']
+    assert result.failed_titles == ['some title']
+    assert 'Could not read 1Password item web-db' in str(result.env_var_errors['DB_PASSWORD'])
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_partial_lookups_retry_only_failures(subprocess):
+    list_output_data = [{"uuid": "dummy1", "overview": {"tags": ["A"]}}]
+    subprocess.check_output.side_effect = [
+        json.dumps(list_output_data).encode('utf-8'),
+        b'{"a":"1","value":""}\n',
+        json.dumps([{"uuid": "dummy2", "overview": {"tags": ["B"]}}]).encode('utf-8'),
+        b'{"b":"2","value":""}\n',
+    ]
+    first = do_partial_lookups(['A', 'B'], [])
+    assert first.failed_env_var_names == ['B']
+    retry = do_partial_lookups(first.failed_env_var_names, first.failed_titles)
+    subprocess.check_output.assert_any_call(['op', 'list', 'items', '--tags', 'B'])
+    merged = first.merged_with(retry)
+    assert merged.ok
+    assert merged.values == {'A': '1', 'B': '2'}
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_lookups_by_tag_prefix_lists_once(subprocess):
+    list_output_data = [
+        {"uuid": "dummy1", "overview": {"tags": ["WEB_DB_PASSWORD", "WEB_DB_USER", "personal"]}},
+        {"uuid": "dummy2", "overview": {"tags": ["STRIPE_KEY"]}},
+        {"uuid": "dummy3", "overview": {"tags": ["WEB_TOKEN", "Work/Web"]}},
+    ]
+    subprocess.check_output.side_effect = [
+        json.dumps(list_output_data).encode('utf-8'),
+        b'{"password":"p","user":"u"}\n{"password":"p","user":"u"}\n{"token":"t"}\n',
+    ]
+    out = do_lookups([], [], tag_prefixes=['WEB_'])
+    assert out == {'WEB_DB_PASSWORD': 'p', 'WEB_DB_USER': 'u', 'WEB_TOKEN': 't'}
+    subprocess.check_output.\
+        assert_has_calls([call(['op', 'list', 'items']),
+                          call(['op', 'get', 'item', '-', '--fields',
+                                'password,token,user,username,web_db_password,web_db_user,'
+                                'web_token'],
+                               input=ANY)])
+    assert subprocess.check_output.call_count == 2
+
+
+def test_op_iter_partial_lookups_yields_each_part_when_ready():
+    release_work = threading.Event()
+    release_title = threading.Event()
+
+    def resolve_partial(self, env_var_names, titles):
+        if titles:
+            assert release_title.wait(5)
+            return PartialLookupResult(values={'A': 'a', 'T': 't'}, env_var_errors={},
+                                       title_errors={})
+        if _current_account.get() == 'work':
+            assert release_work.wait(5)
+            return PartialLookupResult(values={'B': 'other'}, env_var_errors={}, title_errors={})
+        return PartialLookupResult(values={'A': 'a', 'B': 'b'}, env_var_errors={},
+                                   title_errors={})
+    with patch('op_env.op.Resolver.resolve_partial', resolve_partial):
+        parts = iter_partial_lookups(['A', 'B'], ['item'],
+                                     accounts={'work': AccountLookup(env_var_names=['B'],
+                                                                     titles=[])})
+        first = next(parts)
+        release_work.set()
+        second = next(parts)
+        release_title.set()
+        third = next(parts)
+        assert list(parts) == []
+    assert first.values == {'A': 'a', 'B': 'b'}
+    assert second.values == {}
+    assert isinstance(second.env_var_errors['B'], ConflictingValuesOPLookupError)
+    # A was already given the same value
+    assert third.values == {'T': 't'}
+
+
+@pytest.mark.parametrize('title_first', [True, False])
+def test_op_iter_partial_lookups_ends_with_do_partial_lookups_value(title_first):
+    release_second = threading.Event()
+    threads = set()
+
+    def resolve_partial(self, env_var_names, titles):
+        threads.add(threading.current_thread().name)
+        if bool(titles) != title_first:
+            assert release_second.wait(5)
+        value = 'from title' if titles else 'from tag'
+        return PartialLookupResult(values={'A': value}, env_var_errors={}, title_errors={})
+    with patch('op_env.op.Resolver.resolve_partial', resolve_partial):
+        parts = iter_partial_lookups(['A'], ['item'])
+        values = [next(parts).values]
+        release_second.set()
+        values += [part.values for part in parts]
+        # on the resolver's own worker pool
+        assert all(name.startswith('op-env_') for name in threads)
+        assert do_partial_lookups(['A'], ['item']).values == {'A': 'from title'}
+    if title_first:
+        assert values == [{'A': 'from title'}, {}]
+    else:
+        assert values == [{'A': 'from tag'}, {'A': 'from title'}]
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_partial_lookups_all_tags(subprocess):
+    list_output_data = [
+        {"uuid": "dummy1", "overview": {"tags": ["GOOD", "personal"]}},
+        {"uuid": "dummy2", "overview": {"tags": ["TWICE"]}},
+        {"uuid": "dummy3", "overview": {"tags": ["TWICE", "Work/Web"]}},
+    ]
+    subprocess.check_output.side_effect = [
+        json.dumps(list_output_data).encode('utf-8'),
+        b'{"good":"g"}\n{}\n',
+    ]
+    result = do_partial_lookups([], [], tag_prefixes=[''])
+    assert result.values == {'GOOD': 'g'}
+    assert set(result.failed_env_var_names) == {'TWICE', 'personal'}
+    assert isinstance(result.env_var_errors['TWICE'], TooManyEntriesOPLookupError)
+
+
+@patch('op_env.op.MAX_FIELDS_ARGUMENT_LENGTH', 20)
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_lookups_by_tag_prefix_splits_long_field_lists(subprocess):
+    list_output_data = [
+        {"uuid": f"dummy{n}", "overview": {"tags": [f"WEB_SECRET_{n}"]}}
+        for n in range(3)
+    ]
+    subprocess.check_output.side_effect = [
+        json.dumps(list_output_data).encode('utf-8'),
+        b'{"web_secret_0":"0"}\n',
+        b'{"web_secret_1":"1"}\n',
+        b'{"web_secret_2":"2"}\n',
+    ]
+    out = do_lookups([], [], tag_prefixes=['WEB_'])
+    assert out == {'WEB_SECRET_0': '0', 'WEB_SECRET_1': '1', 'WEB_SECRET_2': '2'}
+    subprocess.check_output.assert_called_with(['op', 'get', 'item', '-', '--fields',
+                                                '2,web_secret_2'], input=ANY)
+
+
+@patch('op_env.op.MAX_FIELDS_ARGUMENT_LENGTH', 20)
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_lookups_splits_long_field_lists(subprocess):
+    list_output_data = [
+        {"uuid": f"dummy{n}", "overview": {"tags": [f"WEB_SECRET_{n}"]}}
+        for n in range(3)
+    ]
+    subprocess.check_output.side_effect = [
+        json.dumps(list_output_data).encode('utf-8'),
+        b'{"web_secret_0":"0"}\n',
+        b'{"web_secret_1":"1"}\n',
+        b'{"web_secret_2":"2"}\n',
+    ]
+    out = do_lookups(['WEB_SECRET_0', 'WEB_SECRET_1', 'WEB_SECRET_2'], [])
+    assert out == {'WEB_SECRET_0': '0', 'WEB_SECRET_1': '1', 'WEB_SECRET_2': '2'}
+    assert subprocess.check_output.call_count == 4
+
+
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_cli_json_tag_prefixes(stdout_stringio, do_lookups):
+    do_lookups.return_value = {'WEB_A': '1'}
+    main(['op-env', 'json', '--tag-prefix', 'WEB_', '--tag-prefix', 'API_', '--all-tags'])
+    do_lookups.assert_called_with([], [], tag_prefixes=['WEB_', 'API_', ''])
+    assert json.loads(stdout_stringio.getvalue()) == {'WEB_A': '1'}
+
+
+@patch('op_env._cli.do_partial_lookups', autospec=op_env._cli.do_partial_lookups)
+@patch('sys.stderr', new_callable=io.StringIO)
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_process_args_json_partial(stdout_stringio, stderr_stringio, do_partial_lookups):
+    do_partial_lookups.return_value = PartialLookupResult(
+        values={'A': '1'},
+        env_var_errors={'B': NoEntriesOPLookupError('No 1Password entries with tag B found')},
+        title_errors={})
+    args = {'operation': 'json', 'environment': ['A', 'B'], 'title': [], 'partial': True}
+    assert process_args(args) == 1
+    do_partial_lookups.assert_called_with(['A', 'B'], [])
+    assert json.loads(stdout_stringio.getvalue()) == {'A': '1'}
+    assert stderr_stringio.getvalue() == 'B: No 1Password entries with tag B found\n'
+
+
+def test_cli_json_stream(fake_op, capsys):
+    assert main(['op-env', 'json', '--stream', '--backend', 'v2', '-e', 'STRIPE_API_KEY',
+                 '-e', 'MISSING', '-t', 'web db', '-t', 'no such item']) == 1
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record['title'] for record in records if 'title' in record] == ['no such item']
+    assert sorted((record['name'], record.get('value', record.get('error')))
+                  for record in records if 'name' in record) == [
+        ('MISSING', 'No 1Password entries with tag MISSING found'),
+        ('STRIPE_API_KEY', 'sk_123'),
+        ('WEB_DB_PASSWORD', 'multi\nline'),
+        ('WEB_DB_USERNAME', 'webuser'),
+    ]
+
+
+def test_cli_json_stream_rejects_fallback_snapshot(capsys):
+    with pytest.raises(SystemExit):
+        main(['op-env', 'json', '--stream', '--fallback-snapshot', '-e', 'A'])
+    assert '--stream cannot be used with --fallback-snapshot' in capsys.readouterr().err
+
+
+def test_cli_check_reports_every_problem_once(fake_op, tmp_path, capsys):
+    repo = tmp_path / 'repo'
+    for service, names in [('a', ['WEB_DB_USERNAME', 'MISSING', 'DUPLICATE']),
+                           ('b', ['WEB_DB_USERNAME', 'STRIPE_API_KEY', 'MISSING', 'BAD,NAME']),
+                           ('.hidden', ['HIDDEN'])]:
+        os.makedirs(repo / service)
+        (repo / service / 'vars.yml').write_text(yaml.dump(names))
+    os.makedirs(repo / 'c')
+    (repo / 'c' / 'vars.yml').write_text('{not: a list}')
+    (repo / 'web.env').write_text('WEB_DB_PASSWORD\n\n')
+    assert main(['op-env', 'check', '--backend', 'v2', str(repo / 'web.env'), str(repo)]) == 1
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        f"{repo / 'a' / 'vars.yml'}: MISSING: No 1Password entries with tag MISSING found",
+        f"{repo / 'a' / 'vars.yml'}: DUPLICATE: Too many 1Password entries with tag DUPLICATE "
+        'found',
+        f"{repo / 'b' / 'vars.yml'}: MISSING: No 1Password entries with tag MISSING found",
+        f"{repo / 'b' / 'vars.yml'}: BAD,NAME: 1Password does not support tags with commas",
+        f"{repo / 'c' / 'vars.yml'}: YAML file must be a list; found {{'not': 'a list'}}",
+    ]
+    assert err == '4 files and 6 names checked: 5 problems\n'
+    for value in ['webuser', 'multi', 'sk_123']:
+        assert value not in out + err
+    # one consolidated lookup for every file
+    assert [call[:2] for call in fake_op()] == [['item', 'list'], ['item', 'get']]
+
+
+@patch('op_env._cli.do_partial_lookups', autospec=op_env._cli.do_partial_lookups)
+def test_cli_check_keeps_accounts_apart(do_partial_lookups, tmp_path, capsys):
+    do_partial_lookups.return_value = PartialLookupResult(
+        values={'A': '1'},
+        env_var_errors={'work:A': NoEntriesOPLookupError('No 1Password entries with tag A found')},
+        title_errors={})
+    (tmp_path / 'default.txt').write_text('A\n')
+    (tmp_path / 'work.txt').write_text('work:A\n')
+    assert main(['op-env', 'check', str(tmp_path / 'default.txt'),
+                 str(tmp_path / 'work.txt')]) == 1
+    assert capsys.readouterr().out == \
+        f"{tmp_path / 'work.txt'}: work:A: No 1Password entries with tag A found\n"
+
+
+def test_cli_check_names_referring_to_different_fields(fake_op, tmp_path, capsys):
+    for service, field in [('a', 'username'), ('b', 'nothing'), ('c', 'username')]:
+        os.makedirs(tmp_path / service)
+        (tmp_path / service / 'db.txt').write_text(f'DB=op://prod/web db/{field}\n')
+    assert main(['op-env', 'check', '--backend', 'v2', '--name', '*.txt', str(tmp_path)]) == 1
+    out, _ = capsys.readouterr()
+    assert out.startswith(f"{tmp_path / 'b' / 'db.txt'}: DB: ")
+    assert len(out.splitlines()) == 1
+    assert fake_op() == [['inject'], ['inject']]
+
+
 @patch('op_env.op._op_fields_to_try', autospec=_op_fields_to_try)
 def test_op_pluck_correct_field_multiple_fields(op_fields_to_try):
     op_fields_to_try.return_value = ['floogle', 'blah']
@@ -796,6 +1428,215 @@ def test_parse_args_run_simple():
     assert args == {'command': ['mycmd'], 'environment': ['DUMMY'], 'operation': 'run', 'title': []}
 
 
+def test_parse_args_run_with_procfile():
+    argv = ['op-env', 'run', '-e', 'DUMMY', '--procfile', 'Procfile']
+    args = parse_argv(argv)
+    assert args == {'command': [], 'environment': ['DUMMY'], 'operation': 'run', 'title': [],
+                    'procfile': 'Procfile'}
+
+
+def test_parse_args_json_with_direct_references(two_item_text_file):
+    argv = ['op-env', 'json', '-e', 'DB_PASSWORD=op://prod/web-db/password',
+            '-e', 'API_KEY=abcdefghijklmnopqrstuvwxyz', '-f', two_item_text_file]
+    args = parse_argv(argv)
+    assert args == {
+        'operation': 'json', 'title': [],
+        'environment': ['DB_PASSWORD', 'API_KEY', 'TVAR1', 'TVAR2'],
+        'references': {
+            'DB_PASSWORD': FieldReference(field='password', item='web-db', vault='prod'),
+            'API_KEY': FieldReference(field=None, item='abcdefghijklmnopqrstuvwxyz'),
+        },
+    }
+    assert lookup_argv(args) == ['-e', 'DB_PASSWORD=op://prod/web-db/password',
+                                 '-e', 'API_KEY=abcdefghijklmnopqrstuvwxyz',
+                                 '-e', 'TVAR1', '-e', 'TVAR2']
+
+
+def test_parse_args_json_with_invalid_direct_reference():
+    with pytest.raises(SystemExit):
+        parse_argv(['op-env', 'json', '-e', 'DB_PASSWORD=op://prod/web-db'])
+
+
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_process_args_json_with_direct_references(stdout_stringio, do_lookups):
+    do_lookups.return_value = {'A': '1'}
+    args = parse_argv(['op-env', 'json', '-e', 'A=op://prod/item/field'])
+    process_args(args)
+    do_lookups.assert_called_with(['A'], [],
+                                  field_mapping={'A': FieldReference(field='field',
+                                                                     item='item',
+                                                                     vault='prod')})
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_do_env_lookups_mixes_tags_and_direct_references(subprocess):
+    list_output = json.dumps([{"uuid": "dummy",
+                               "overview": {"tags": ["TAGGED"]}}]).encode('utf-8')
+    subprocess.check_output.side_effect = [
+        list_output,
+        b'{"tagged":"t"}\n',
+        b'{"uuid_one":"u1"}\n{"uuid_two":"u2"}\n',
+        b'p1\n',
+    ]
+    field_mapping = {
+        'DB_PASSWORD': FieldReference(field='password', item='web-db', vault='prod'),
+        'UUID_ONE': FieldReference(field=None, item='a' * 26),
+        'UUID_TWO': FieldReference(field=None, item='b' * 26),
+    }
+    out = _do_env_lookups(['TAGGED', 'DB_PASSWORD', 'UUID_ONE', 'UUID_TWO'], field_mapping)
+    assert out == {'TAGGED': 't', 'DB_PASSWORD': 'p1', 'UUID_ONE': 'u1', 'UUID_TWO': 'u2'}
+    assert subprocess.check_output.call_args_list == [
+        call(['op', 'list', 'items', '--tags', 'TAGGED']),
+        call(['op', 'get', 'item', '-', '--fields', 'tagged'], input=ANY),
+        call(['op', 'get', 'item', '-', '--fields', 'one,two,uuid_one,uuid_two'], input=ANY),
+        call(['op', 'get', 'item', 'web-db', '--fields', 'password', '--vault', 'prod']),
+    ]
+    batched_input = json.loads(subprocess.check_output.call_args_list[2][1]['input'])
+    assert [entry['uuid'] for entry in batched_input] == ['a' * 26, 'b' * 26]
+
+
+def test_parse_args_json_with_accounts():
+    argv = ['op-env', 'json', '-e', 'corp:A', '-e', 'B', '-e', 'client:C=op://v/i/f',
+            '--account-title', 'client:Some: Title']
+    args = parse_argv(argv)
+    assert args == {
+        'operation': 'json', 'title': [], 'environment': ['B'],
+        'references': {'C': FieldReference(field='f', item='i', vault='v')},
+        'accounts': {
+            'corp': AccountLookup(env_var_names=['A'], titles=[]),
+            'client': AccountLookup(env_var_names=['C'], titles=['Some: Title']),
+        },
+    }
+    assert lookup_argv(args) == ['-e', 'B', '-e', 'corp:A', '-e', 'client:C=op://v/i/f',
+                                 '--account-title', 'client:Some: Title']
+
+
+def test_parse_args_json_with_unscoped_account_title():
+    with pytest.raises(SystemExit):
+        parse_argv(['op-env', 'json', '--account-title', 'Some Title'])
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_calls_within_account(subprocess):
+    subprocess.check_output.return_value = b'p1\n'
+    field_mapping = {'DB_PASSWORD': FieldReference(field='password', item='web-db')}
+    with account('corp'):
+        _do_env_lookups(['DB_PASSWORD'], field_mapping)
+    subprocess.check_output.assert_called_once_with(['op', 'get', 'item', 'web-db',
+                                                     '--fields', 'password',
+                                                     '--account', 'corp'])
+
+
+@patch('op_env.op._do_env_lookups', autospec=op_env.op._do_env_lookups)
+def test_resolver_resolve_accounts_in_parallel(_do_env_lookups):
+    # Each account's lookup waits for the other, so this only
+    # completes if they run at the same time.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def lookup(env_var_names, field_mapping):
+        barrier.wait()
+        return {name: f'{_current_account.get()}-{name}' for name in env_var_names}
+    _do_env_lookups.side_effect = lookup
+    with Resolver() as resolver:
+        out = resolver.resolve_accounts({
+            'corp': AccountLookup(env_var_names=['A'], titles=[]),
+            'client': AccountLookup(env_var_names=['B'], titles=[]),
+        })
+    assert out == {'A': 'corp-A', 'B': 'client-B'}
+
+
+@patch('op_env.op._do_env_lookups', autospec=op_env.op._do_env_lookups)
+def test_resolver_resolve_accounts_detects_conflicts(_do_env_lookups):
+    _do_env_lookups.side_effect = lambda names, field_mapping: {
+        name: f'{_current_account.get()}-{name}' for name in names
+    }
+    lookups = {
+        None: AccountLookup(env_var_names=['A'], titles=[]),
+        'corp': AccountLookup(env_var_names=['A', 'B'], titles=[]),
+    }
+    with Resolver() as resolver:
+        with pytest.raises(ConflictingValuesOPLookupError,
+                           match='A has different values in the default account and '
+                           'account corp'):
+            resolver.resolve_accounts(lookups)
+
+
+@patch('op_env.op._do_env_lookups_partial', autospec=op_env.op._do_env_lookups_partial)
+def test_resolver_resolve_partial_accounts_collects_conflicts(_do_env_lookups_partial):
+    _do_env_lookups_partial.side_effect = lambda names, field_mapping: (
+        {name: f'{_current_account.get()}-{name}' for name in names}, {}
+    )
+    lookups = {
+        'client': AccountLookup(env_var_names=['A'], titles=[]),
+        'corp': AccountLookup(env_var_names=['A', 'B'], titles=[]),
+    }
+    with Resolver() as resolver:
+        result = resolver.resolve_partial_accounts(lookups)
+    assert result.values == {'B': 'corp-B'}
+    assert isinstance(result.env_var_errors['A'], ConflictingValuesOPLookupError)
+
+
+@patch('op_env.op._do_env_lookups_partial', autospec=op_env.op._do_env_lookups_partial)
+def test_resolver_resolve_partial_accounts_labels_errors(_do_env_lookups_partial):
+    _do_env_lookups_partial.side_effect = lambda names, field_mapping: (
+        ({}, {'A': NoEntriesOPLookupError('No 1Password entries with tag A found')})
+        if _current_account.get() == 'corp' else ({'A': 'a'}, {})
+    )
+    lookups = {
+        None: AccountLookup(env_var_names=['A'], titles=[]),
+        'corp': AccountLookup(env_var_names=['A'], titles=[]),
+    }
+    with Resolver() as resolver:
+        result = resolver.resolve_partial_accounts(lookups)
+    assert result.values == {'A': 'a'}
+    assert list(result.env_var_errors) == ['corp:A']
+
+
+@patch.dict(os.environ, {'ORIGINAL_ENV': 'TRUE'}, clear=True)
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+@patch('op_env._cli.supervise', autospec=op_env._cli.supervise)
+def test_process_args_procfile_checks_delivered_variables(supervise, do_lookups, tmp_path):
+    procfile = tmp_path / 'Procfile'
+    procfile.write_text('web: env\n')
+    do_lookups.return_value = {'a': '1'}
+    args = {'operation': 'run', 'command': [], 'procfile': str(procfile),
+            'environment': ['a'], 'title': [], 'file_variable': ['b']}
+    with pytest.raises(ValueError, match='b was not looked up'):
+        process_args(args)
+    args = {'operation': 'run', 'command': [], 'procfile': str(procfile),
+            'environment': ['a'], 'title': [], 'fd_variable': ['a']}
+    with pytest.raises(ValueError, match='--fd-variable cannot be used with --procfile'):
+        process_args(args)
+    supervise.assert_not_called()
+
+
+def test_parse_args_run_requires_command_or_procfile():
+    with pytest.raises(SystemExit):
+        parse_argv(['op-env', 'run', '-e', 'DUMMY'])
+    with pytest.raises(SystemExit):
+        parse_argv(['op-env', 'run', '--procfile', 'Procfile', 'mycmd'])
+    with pytest.raises(SystemExit):
+        parse_argv(['op-env', 'run', '--procfile', 'Procfile', '--fd-variable', 'DUMMY'])
+
+
+@patch.dict(os.environ, {'ORIGINAL_ENV': 'TRUE'}, clear=True)
+@patch('op_env._cli.supervise', autospec=op_env._cli.supervise)
+@patch('op_env._cli.do_lookups', autospec=op_env._cli.do_lookups)
+def test_process_args_run_procfile_looks_up_once(do_lookups, supervise, tmp_path):
+    procfile = tmp_path / 'Procfile'
+    procfile.write_text('web: bin/web\nworker: bin/worker\n')
+    do_lookups.return_value = {'a': '1'}
+    supervise.return_value = 3
+    args = {'operation': 'run', 'command': [], 'environment': ['a'], 'title': [],
+            'procfile': str(procfile)}
+    assert process_args(args) == 3
+    do_lookups.assert_called_once_with(['a'], [])
+    supervise.assert_called_once_with([ProcfileEntry('web', 'bin/web'),
+                                       ProcfileEntry('worker', 'bin/worker')],
+                                      {'ORIGINAL_ENV': 'TRUE', 'a': '1'})
+
+
 def test_parse_args_sh_simple():
     argv = ['op-env', 'sh', '-e', 'DUMMY']
     args = parse_argv(argv)
@@ -817,7 +1658,15 @@ def test_cli_help_run():
     env.update(request_long_lines)
 
     expected_help = """usage: op-env run [-h] [--title TITLE] [--environment ENVVAR] [--yaml-environment YAMLENV] \
-[--file-environment FILEENV] command [command ...]
+[--file-environment FILEENV] [--tag-prefix PREFIX] [--all-tags] \
+[--field-mapping MAPPINGYAML] [--timeout SECONDS] \
+[--op-timeout SECONDS] [--account-title ACCOUNT:TITLE] \
+[--backend {v1,v2,connect,auto}] \
+[--circuit-breaker FAILURES] [--circuit-reset SECONDS] [--item-cache] \
+[--fallback-snapshot] \
+[--record DIR | --replay DIR] \
+[--file-variable ENVVAR] [--fd-variable ENVVAR] \
+[--procfile PROCFILE] [command ...]
 
 Run the specified command with the given environment variables
 
@@ -835,6 +1684,40 @@ will be set
                         YAML config specifying a list of environment variable names to set
   --file-environment FILEENV, -f FILEENV
                         Text config specifying environment variable names to set, one on each line
+  --tag-prefix PREFIX   also set every environment variable named by a 1Password tag starting \
+with this, found with a single listing of items
+  --all-tags            also set every environment variable named by any 1Password tag
+  --field-mapping MAPPINGYAML, -m MAPPINGYAML
+                        YAML config mapping environment variable names to the 1Password field (and \
+optionally item and vault) to read
+  --timeout SECONDS     give up if looking up values takes longer than this in total
+  --op-timeout SECONDS  give up if any single op command takes longer than this
+  --account-title ACCOUNT:TITLE
+                        title of 1Password item in the given op account from which all tagged \
+environment variable names will be set; env variables can be scoped to an account the same way, as \
+ACCOUNT:NAME
+  --backend {v1,v2,connect,auto}
+                        generation of the 1Password 'op' CLI to use; 'auto' asks op for its \
+version (default: $OP_ENV_BACKEND, or v1)
+  --circuit-breaker FAILURES
+                        after this many lookups in a row fail to reach 1Password, fail fast \
+instead of waiting on op (shared by every op-env on this machine)
+  --circuit-reset SECONDS
+                        with --circuit-breaker, try 1Password again after this long (default 60)
+  --item-cache          keep the fields of tagged items, encrypted, and fetch them again only once \
+1Password lists a new version of the item
+  --fallback-snapshot   save values after each lookup, and use the saved values, with a warning, \
+when 1Password cannot be reached
+  --record DIR          save each op call made, with secret values redacted, to this directory
+  --replay DIR          answer op calls from a directory written by --record instead of running \
+op, taking as long as they originally did
+  --file-variable ENVVAR
+                        set this environment variable to the path of a private file holding its \
+value, removed when the command exits
+  --fd-variable ENVVAR  set this environment variable to the number of an inherited file \
+descriptor from which its value can be read
+  --procfile PROCFILE   run each 'name: command' line of this file at once, instead of a single \
+command
 """
     if sys.version_info <= (3, 10):
         # 3.10 changed the wording a bit
@@ -851,7 +1734,13 @@ def test_cli_help_json():
     env.update(os.environ)
     env.update(request_long_lines)
     expected_help = """usage: op-env json [-h] [--title TITLE] [--environment ENVVAR] [--yaml-environment YAMLENV] \
-[--file-environment FILEENV]
+[--file-environment FILEENV] [--tag-prefix PREFIX] [--all-tags] \
+[--field-mapping MAPPINGYAML] [--timeout SECONDS] \
+[--op-timeout SECONDS] [--account-title ACCOUNT:TITLE] \
+[--backend {v1,v2,connect,auto}] \
+[--circuit-breaker FAILURES] [--circuit-reset SECONDS] [--item-cache] \
+[--fallback-snapshot] \
+[--record DIR | --replay DIR] [--partial] [--stream]
 
 Produce simple JSON on stdout mapping requested env variables to values
 
@@ -866,6 +1755,37 @@ will be set
                         YAML config specifying a list of environment variable names to set
   --file-environment FILEENV, -f FILEENV
                         Text config specifying environment variable names to set, one on each line
+  --tag-prefix PREFIX   also set every environment variable named by a 1Password tag starting \
+with this, found with a single listing of items
+  --all-tags            also set every environment variable named by any 1Password tag
+  --field-mapping MAPPINGYAML, -m MAPPINGYAML
+                        YAML config mapping environment variable names to the 1Password field (and \
+optionally item and vault) to read
+  --timeout SECONDS     give up if looking up values takes longer than this in total
+  --op-timeout SECONDS  give up if any single op command takes longer than this
+  --account-title ACCOUNT:TITLE
+                        title of 1Password item in the given op account from which all tagged \
+environment variable names will be set; env variables can be scoped to an account the same way, as \
+ACCOUNT:NAME
+  --backend {v1,v2,connect,auto}
+                        generation of the 1Password 'op' CLI to use; 'auto' asks op for its \
+version (default: $OP_ENV_BACKEND, or v1)
+  --circuit-breaker FAILURES
+                        after this many lookups in a row fail to reach 1Password, fail fast \
+instead of waiting on op (shared by every op-env on this machine)
+  --circuit-reset SECONDS
+                        with --circuit-breaker, try 1Password again after this long (default 60)
+  --item-cache          keep the fields of tagged items, encrypted, and fetch them again only once \
+1Password lists a new version of the item
+  --fallback-snapshot   save values after each lookup, and use the saved values, with a warning, \
+when 1Password cannot be reached
+  --record DIR          save each op call made, with secret values redacted, to this directory
+  --replay DIR          answer op calls from a directory written by --record instead of running \
+op, taking as long as they originally did
+  --partial             print whatever values can be found, reporting every lookup failure on \
+stderr rather than stopping at the first
+  --stream              print a JSON line for each value or lookup failure as soon as it is \
+known, rather than one object at the end
 """
     if sys.version_info <= (3, 10):
         # 3.10 changed the wording a bit
@@ -882,7 +1802,15 @@ def test_cli_help_sh():
     env.update(os.environ)
     env.update(request_long_lines)
     expected_help = """usage: op-env sh [-h] [--title TITLE] [--environment ENVVAR] [--yaml-environment YAMLENV] \
-[--file-environment FILEENV]
+[--file-environment FILEENV] [--tag-prefix PREFIX] [--all-tags] \
+[--field-mapping MAPPINGYAML] [--timeout SECONDS] \
+[--op-timeout SECONDS] [--account-title ACCOUNT:TITLE] \
+[--backend {v1,v2,connect,auto}] \
+[--circuit-breaker FAILURES] [--circuit-reset SECONDS] [--item-cache] \
+[--fallback-snapshot] \
+[--record DIR | --replay DIR] \
+[--stale-while-revalidate] [--max-stale SECONDS] \
+[--changed-marker FILE]
 
 Produce commands on stdout that can be 'eval'ed to set variables in current shell
 
@@ -897,6 +1825,41 @@ will be set
                         YAML config specifying a list of environment variable names to set
   --file-environment FILEENV, -f FILEENV
                         Text config specifying environment variable names to set, one on each line
+  --tag-prefix PREFIX   also set every environment variable named by a 1Password tag starting \
+with this, found with a single listing of items
+  --all-tags            also set every environment variable named by any 1Password tag
+  --field-mapping MAPPINGYAML, -m MAPPINGYAML
+                        YAML config mapping environment variable names to the 1Password field (and \
+optionally item and vault) to read
+  --timeout SECONDS     give up if looking up values takes longer than this in total
+  --op-timeout SECONDS  give up if any single op command takes longer than this
+  --account-title ACCOUNT:TITLE
+                        title of 1Password item in the given op account from which all tagged \
+environment variable names will be set; env variables can be scoped to an account the same way, as \
+ACCOUNT:NAME
+  --backend {v1,v2,connect,auto}
+                        generation of the 1Password 'op' CLI to use; 'auto' asks op for its \
+version (default: $OP_ENV_BACKEND, or v1)
+  --circuit-breaker FAILURES
+                        after this many lookups in a row fail to reach 1Password, fail fast \
+instead of waiting on op (shared by every op-env on this machine)
+  --circuit-reset SECONDS
+                        with --circuit-breaker, try 1Password again after this long (default 60)
+  --item-cache          keep the fields of tagged items, encrypted, and fetch them again only once \
+1Password lists a new version of the item
+  --fallback-snapshot   save values after each lookup, and use the saved values, with a warning, \
+when 1Password cannot be reached
+  --record DIR          save each op call made, with secret values redacted, to this directory
+  --replay DIR          answer op calls from a directory written by --record instead of running \
+op, taking as long as they originally did
+  --stale-while-revalidate
+                        print the last known good values from the local encrypted snapshot right \
+away and refresh them in the background
+  --max-stale SECONDS   with --stale-while-revalidate, look up values before printing if the \
+snapshot is older than this (default 86400)
+  --changed-marker FILE
+                        with --stale-while-revalidate, file to touch when a background refresh \
+finds changed values (e.g., for direnv's watch_file)
 """
     if sys.version_info <= (3, 10):
         # 3.10 changed the wording a bit
@@ -908,7 +1871,7 @@ will be set
 
 
 def test_cli_no_args():
-    expected_help = """usage: op-env [-h] {run,json,sh} ...
+    expected_help = """usage: op-env [-h] {run,json,plan,sh,k8s,check,matrix} ...
 op-env: error: the following arguments are required: operation
 """
     request_long_lines = {'COLUMNS': '999', 'LINES': '25'}
@@ -929,16 +1892,25 @@ def test_cli_help():
     env = {}
     env.update(os.environ)
     env.update(request_long_lines)
-    expected_help = """usage: op-env [-h] {run,json,sh} ...
+    expected_help = """usage: op-env [-h] {run,json,plan,sh,k8s,check,matrix} ...
 
 positional arguments:
-  {run,json,sh}
-    run          Run the specified command with the given environment variables
-    json         Produce simple JSON on stdout mapping requested env variables to values
-    sh           Produce commands on stdout that can be 'eval'ed to set variables in current shell
+  {run,json,plan,sh,k8s,check,matrix}
+    run                 Run the specified command with the given environment variables
+    json                Produce simple JSON on stdout mapping requested env variables to values
+    plan                Explain the op calls 'json' would make with the same arguments, \
+without running any of them
+    sh                  Produce commands on stdout that can be 'eval'ed to set variables in \
+current shell
+    k8s                 Produce Kubernetes Secret manifests containing the requested env \
+variables
+    check               Check that every environment list under the given paths can be looked \
+up, reporting each problem without printing any values
+    matrix              Look up the same env variables in several environments at once, \
+printing each environment's values and how they differ as JSON
 
 options:
-  -h, --help     show this help message and exit
+  -h, --help            show this help message and exit
 """
     if sys.version_info <= (3, 10):
         # 3.10 changed the wording a bit
@@ -0,0 +1,95 @@
+"""Tests for `op_env.op_v2`, against a fake 1Password CLI 2.x on the PATH."""
+
+import pytest
+
+from op_env.op import (do_lookups, do_partial_lookups, FieldReference, NoEntriesOPLookupError,
+                       OpV1Backend, select_backend, TooManyEntriesOPLookupError)
+from op_env.op_v2 import OpV2Backend
+
+
+def test_v2_tagged_lookups_use_one_list_and_one_get(fake_op):
+    out = do_lookups(['WEB_DB_USERNAME', 'WEB_DB_PASSWORD', 'STRIPE_API_KEY'], [],
+                     backend='v2')
+    assert out == {
+        'WEB_DB_USERNAME': 'webuser',
+        'WEB_DB_PASSWORD': 'multi\nline',
+        'STRIPE_API_KEY': 'sk_123',
+    }
+    assert fake_op() == [
+        ['item', 'list', '--tags', 'WEB_DB_USERNAME,WEB_DB_PASSWORD,STRIPE_API_KEY',
+         '--format', 'json'],
+        ['item', 'get', '-', '--format', 'json'],
+    ]
+
+
+def test_v2_vault_mapped_lookups_use_one_inject(fake_op):
+    field_mapping = {
+        'DB_USER': FieldReference(field='username', item='web db', vault='prod'),
+        'DB_PASSWORD': FieldReference(field='password', item='web db', vault='prod'),
+        'STRIPE': FieldReference(field='key', item='stripe', vault='prod'),
+    }
+    out = do_lookups(['DB_USER', 'DB_PASSWORD', 'STRIPE'], [], field_mapping=field_mapping,
+                     backend='v2')
+    assert out == {'DB_USER': 'webuser', 'DB_PASSWORD': 'multi\nline', 'STRIPE': 'sk_123'}
+    assert fake_op() == [['inject']]
+
+
+def test_v2_item_mapped_without_vault(fake_op):
+    field_mapping = {'DB_USER': FieldReference(field='username', item='web db')}
+    out = do_lookups(['DB_USER'], [], field_mapping=field_mapping, backend='v2')
+    assert out == {'DB_USER': 'webuser'}
+    assert fake_op() == [['item', 'get', 'web db', '--format', 'json']]
+
+
+def test_v2_title_lookup(fake_op):
+    out = do_lookups([], ['web db'], backend='v2')
+    assert out == {'WEB_DB_USERNAME': 'webuser', 'WEB_DB_PASSWORD': 'multi\nline'}
+
+
+def test_v2_missing_tag(fake_op):
+    with pytest.raises(NoEntriesOPLookupError, match='No 1Password entries with tag MISSING'):
+        do_lookups(['STRIPE_API_KEY', 'MISSING'], [], backend='v2')
+
+
+def test_v2_partial_lookups(fake_op):
+    field_mapping = {'BAD': FieldReference(field='nope', item='stripe', vault='prod')}
+    result = do_partial_lookups(['STRIPE_API_KEY', 'DUPLICATE', 'BAD'], ['no such title'],
+                                field_mapping=field_mapping, backend='v2')
+    assert result.values == {'STRIPE_API_KEY': 'sk_123'}
+    assert isinstance(result.env_var_errors['DUPLICATE'], TooManyEntriesOPLookupError)
+    assert 'op://prod/stripe/nope' in str(result.env_var_errors['BAD'])
+    assert result.failed_titles == ['no such title']
+
+
+def test_v2_tag_prefix_lookups_list_once(fake_op):
+    out = do_lookups([], [], backend='v2', tag_prefixes=['WEB_'])
+    assert out == {'WEB_DB_PASSWORD': 'multi\nline', 'WEB_DB_USERNAME': 'webuser'}
+    assert fake_op() == [
+        ['item', 'list', '--format', 'json'],
+        ['item', 'get', '-', '--format', 'json'],
+    ]
+
+
+def test_v2_all_tags_partial(fake_op):
+    result = do_partial_lookups([], [], backend='v2', tag_prefixes=[''])
+    assert result.values == {
+        'WEB_DB_PASSWORD': 'multi\nline',
+        'WEB_DB_USERNAME': 'webuser',
+        'STRIPE_API_KEY': 'sk_123',
+    }
+    assert isinstance(result.env_var_errors['DUPLICATE'], TooManyEntriesOPLookupError)
+
+
+def test_select_backend_auto_detects_v2(fake_op):
+    backend = select_backend('auto')
+    assert isinstance(backend.detected(), OpV2Backend)
+    assert fake_op() == [['--version']]
+
+
+def test_select_backend_from_env(monkeypatch):
+    monkeypatch.setenv('OP_ENV_BACKEND', 'v2')
+    assert isinstance(select_backend(), OpV2Backend)
+    monkeypatch.delenv('OP_ENV_BACKEND')
+    assert isinstance(select_backend(), OpV1Backend)
+    with pytest.raises(ValueError, match='Unknown op backend v3'):
+        select_backend('v3')
@@ -0,0 +1,162 @@
+"""Tests for `op_env.plan`."""
+
+import json
+import os
+from unittest.mock import patch
+
+from op_env._cli import main
+from op_env.op import AccountLookup, do_lookups, FieldReference
+from op_env.plan import plan_account_lookups, plan_lookups, render_plan
+
+UUID1 = 'abcdefghijklmnopqrstuvwxyz'
+UUID2 = 'bbcdefghijklmnopqrstuvwxyz'
+
+
+def test_plan_v1_matches_calls_made():
+    field_mapping = {
+        'DB_PASSWORD': FieldReference(field='password', item='web db', vault='prod'),
+        'ONE': FieldReference(field=None, item=UUID1),
+        'TWO': FieldReference(field=None, item=UUID2),
+    }
+    names = ['WEB_DB_USERNAME', 'STRIPE_KEY', 'DB_PASSWORD', 'ONE', 'TWO']
+    plan = plan_lookups(names, [], field_mapping)
+    made = []
+
+    def fake_run_op(command, input, timeout):
+        made.append(command)
+        if command[1] == 'list':
+            return json.dumps([{'uuid': 'a', 'overview': {'tags': ['WEB_DB_USERNAME']}},
+                               {'uuid': 'b', 'overview': {'tags': ['STRIPE_KEY']}}]).encode()
+        if command[3] == '-':
+            return b'{"username": "u", "key": "k", "one": "1", "two": "2"}\n' * 2
+        return b'p\n'
+    with patch('op_env.op._run_op', side_effect=fake_run_op):
+        do_lookups(names, [], field_mapping=field_mapping)
+    assert [call.argv for call in plan.calls] == made
+    assert plan.op_processes == 4
+    assert plan.calls[2].stdin_bytes is not None
+    assert plan.fields_to_try == {
+        'WEB_DB_USERNAME': ['web_db_username', 'username'],
+        'STRIPE_KEY': ['stripe_key', 'key'],
+        'DB_PASSWORD': ['password'],
+        'ONE': ['one'],
+        'TWO': ['two'],
+    }
+
+
+def test_plan_v2_uses_inject():
+    field_mapping = {
+        'DB_PASSWORD': FieldReference(field='password', item='web db', vault='prod'),
+        'DB_USER': FieldReference(field='username', item='web db', vault='prod'),
+    }
+    plan = plan_lookups(['DB_PASSWORD', 'DB_USER'], ['stripe'], field_mapping, backend='v2')
+    assert [call.argv for call in plan.calls] == [
+        ['op', 'inject'],
+        ['op', 'item', 'get', 'stripe', '--format', 'json'],
+    ]
+
+
+def test_plan_invalid_name_stops_strict_lookups():
+    plan = plan_lookups(['A', 'B,C'], [])
+    assert plan.calls == []
+    assert plan.stopped
+    assert list(plan.problems) == ['B,C']
+    partial_plan = plan_lookups(['A', 'B,C'], [], partial=True)
+    assert [call.argv[:3] for call in partial_plan.calls] == [['op', 'list', 'items'],
+                                                              ['op', 'get', 'item']]
+
+
+def test_plan_accounts_and_auto_detection(monkeypatch):
+    monkeypatch.delenv('OP_CONNECT_HOST', raising=False)
+    plans = plan_account_lookups({None: AccountLookup(['A'], []),
+                                  'work': AccountLookup(['B'], [])},
+                                 backend='auto')
+    assert plans[0].calls[0].argv == ['op', '--version']
+    assert plans[1].calls[0].argv == ['op', 'list', 'items', '--tags', 'B', '--account', 'work']
+    text = render_plan(plans)
+    assert text.startswith('5 op processes (backend v1)\n')
+    assert 'In account work:' in text
+
+
+def test_cli_plan_makes_no_op_calls(capsys, tmp_path, monkeypatch):
+    monkeypatch.setenv('OP_ENV_CACHE_DIR', str(tmp_path))
+    with patch('op_env.op._run_op') as run_op:
+        assert main(['op-env', 'plan', '-e', 'WEB_DB_PASSWORD', '-t', 'stripe']) == 0
+    run_op.assert_not_called()
+    out = capsys.readouterr().out
+    assert '3 op processes (backend v1)' in out
+    assert 'op get item - --fields password,web_db_password' in out
+    assert 'WEB_DB_PASSWORD: web_db_password, password' in out
+    assert 'No snapshot saved' in out
+
+
+def test_cli_plan_reports_snapshot(capsys, tmp_path, monkeypatch):
+    from op_env._cli import lookup_snapshot_name, parse_argv
+    from op_env.store import SnapshotStore
+
+    monkeypatch.setenv('OP_ENV_CACHE_DIR', str(tmp_path))
+    argv = ['op-env', 'plan', '-e', 'A']
+    path = SnapshotStore().path(lookup_snapshot_name(parse_argv(argv)))
+    with open(path, 'wb') as f:
+        f.write(b'x' * 100)
+    os.utime(path, (0, 0))
+    main(argv)
+    out = capsys.readouterr().out
+    assert f'Snapshot {path} (100 bytes)' in out
+    assert 'older than --max-stale' in out
+
+
+def test_plan_tag_prefixes_in_default_account():
+    plans = plan_account_lookups({'work': AccountLookup(['B'], [])},
+                                 backend='v2', tag_prefixes=['WEB_'])
+    assert [plan.account for plan in plans] == [None, 'work']
+    assert [call.argv for call in plans[0].calls] == [
+        ['op', 'item', 'list', '--format', 'json'],
+        ['op', 'item', 'get', '-', '--format', 'json'],
+    ]
+    assert 'the tags starting with WEB_' in plans[0].calls[0].purpose
+    assert plans[1].calls[0].argv[:4] == ['op', 'item', 'list', '--tags']
+
+
+def test_plan_v1_splits_long_field_lists_like_the_lookup():
+    names = ['A' * 30, 'B' * 30, 'C' * 30]
+    made = []
+
+    def fake_run_op(command, input, timeout):
+        made.append(command)
+        if command[1] == 'list':
+            return json.dumps([{'uuid': name, 'overview': {'tags': [name]}}
+                               for name in names]).encode()
+        return b''.join(json.dumps({field: 'v' for field in command[5].split(',')}).encode() +
+                        b'\n' for _ in json.loads(input))
+    with patch('op_env.op.MAX_FIELDS_ARGUMENT_LENGTH', 80):
+        plan = plan_lookups(names, [])
+        with patch('op_env.op._run_op', side_effect=fake_run_op):
+            do_lookups(names, [])
+    assert [call.argv for call in plan.calls] == made
+    assert len(plan.calls) == 3
+    assert 'part 1 of 2' in plan.calls[1].purpose
+
+
+def test_plan_leaves_out_what_the_resolver_has_cached():
+    from op_env.op import OpV1Backend, Resolver
+
+    resolver = Resolver(cache_ttl=60, backend=OpV1Backend())
+    resolver._store(resolver._value_cache, 'A', 'a')
+    resolver._store(resolver._title_cache, 'stripe', {'B': 'b'})
+    plan = plan_lookups(['A', 'C'], ['stripe', 'other'], resolver=resolver)
+    assert [call.argv for call in plan.calls] == [
+        ['op', 'list', 'items', '--tags', 'C'],
+        ['op', 'get', 'item', '-', '--fields', 'c'],
+        ['op', 'get', 'item', 'other'],
+    ]
+    assert plan.cached == ['A', 'stripe']
+    assert resolver.uncached(['A'], ['stripe'], 'work') == AccountLookup(['A'], ['stripe'])
+    assert 'Already cached, so not looked up: A, stripe' in render_plan([plan])
+
+
+def test_plan_marks_calls_the_item_cache_can_skip():
+    plan = plan_lookups(['A'], ['stripe'], item_cache=True)
+    assert 'unchanged since they were cached' in plan.calls[1].purpose
+    assert 'cached' not in plan.calls[0].purpose
+    assert 'cached' not in plan.calls[2].purpose
@@ -0,0 +1,112 @@
+"""Tests for `op_env.recording`."""
+
+import gzip
+import json
+import os
+from subprocess import CalledProcessError
+
+import pytest
+
+from op_env._cli import main
+from op_env.op import deadline, do_lookups, FieldReference, TimeoutOPLookupError
+from op_env.recording import (recording, Redactor, replaying, ReplayMissOPLookupError,
+                              STRUCTURAL_KEYS)
+
+SECRETS = ['webuser', 'multi\nline', 'sk_123']
+
+
+def read_captures(directory):
+    captures = []
+    for name in sorted(os.listdir(directory)):
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(os.path.join(directory, name), 'rb') as f:
+            captures.append(f.read().decode('utf-8'))
+    return captures
+
+
+def test_redactor_is_consistent_and_keeps_lengths():
+    redactor = Redactor(key=b'k' * 32)
+    assert redactor.value('hunter2') == redactor.value('hunter2')
+    assert len(redactor.value('hunter2')) == 7
+    assert redactor.value('hunter2') != 'hunter2'
+    assert len(redactor.value('x' * 200)) == 200
+    doc = {'uuid': 'abc', 'overview': {'tags': ['A'], 'ainfo': 'me@example.com'},
+           'details': {'fields': [{'name': 'password', 'value': 'hunter2'}]}}
+    redacted = redactor.json_doc(doc)
+    assert redacted['uuid'] == 'abc'
+    assert redacted['overview']['tags'] == ['A']
+    assert redacted['overview']['ainfo'] != 'me@example.com'
+    assert redacted['details']['fields'][0] == {
+        'name': 'password',
+        'value': redactor.value('hunter2'),
+    }
+    assert 'value' not in STRUCTURAL_KEYS
+
+
+def test_redactor_fields_output_redacts_every_value():
+    redactor = Redactor()
+    out = redactor.output(['op', 'get', 'item', '-', '--fields', 'name,password'],
+                          '{"name":"secret name","password":"hunter2"}\n')
+    assert 'secret name' not in out
+    assert 'hunter2' not in out
+    assert out.endswith('\n')
+    assert redactor.output(['op', 'get', 'item', 'x', '--fields', 'password'],
+                           'hunter2\n') == redactor.value('hunter2') + '\n'
+
+
+def test_record_and_replay_v2(fake_op, tmp_path, monkeypatch):
+    field_mapping = {'DB_PASSWORD': FieldReference(field='password', item='web db', vault='prod')}
+    names = ['WEB_DB_USERNAME', 'STRIPE_API_KEY', 'DB_PASSWORD']
+    with recording(str(tmp_path / 'rec')):
+        recorded = do_lookups(names, ['web db'], field_mapping=field_mapping, backend='v2')
+    assert recorded['DB_PASSWORD'] == 'multi\nline'
+    captures = read_captures(tmp_path / 'rec')
+    assert len(captures) == 4
+    for capture in captures:
+        for secret in SECRETS:
+            assert json.dumps(secret)[1:-1] not in capture
+    monkeypatch.setenv('PATH', str(tmp_path / 'nothing'))
+    with replaying(str(tmp_path / 'rec'), speed=0):
+        replayed = do_lookups(names, ['web db'], field_mapping=field_mapping, backend='v2')
+    assert set(replayed) == set(recorded)
+    for name, value in replayed.items():
+        assert len(value) == len(recorded[name])
+        assert value != recorded[name]
+    # the same secret, reached two ways, gets the same stand-in
+    assert replayed['DB_PASSWORD'] == replayed['WEB_DB_PASSWORD']
+
+
+def test_replay_miss(tmp_path):
+    os.makedirs(tmp_path / 'rec')
+    with replaying(str(tmp_path / 'rec')):
+        with pytest.raises(ReplayMissOPLookupError, match='No recorded op call matches op list'):
+            do_lookups(['A'], [])
+
+
+def test_replay_keeps_timings_and_failures(tmp_path):
+    rec = tmp_path / 'rec'
+    os.makedirs(rec)
+    with open(rec / '1.json', 'w') as f:
+        json.dump({'argv': ['op', 'list', 'items', '--tags', 'A'], 'stdin': None,
+                   'stdout': '', 'returncode': 1, 'duration': 0.0}, f)
+    with open(rec / '2.json', 'w') as f:
+        json.dump({'argv': ['op', 'list', 'items', '--tags', 'SLOW'], 'stdin': None,
+                   'stdout': '[]', 'returncode': 0, 'duration': 30.0}, f)
+    with replaying(str(rec)):
+        with pytest.raises(CalledProcessError):
+            do_lookups(['A'], [])
+        with pytest.raises(TimeoutOPLookupError):
+            with deadline(0.2):
+                do_lookups(['SLOW'], [])
+
+
+def test_cli_record_and_replay(fake_op, tmp_path, monkeypatch, capsys):
+    rec = str(tmp_path / 'rec')
+    main(['op-env', 'json', '--backend', 'v2', '-e', 'STRIPE_API_KEY', '--record', rec])
+    assert json.loads(capsys.readouterr().out) == {'STRIPE_API_KEY': 'sk_123'}
+    assert all(name.endswith('.json.gz') for name in os.listdir(rec))
+    monkeypatch.setenv('PATH', str(tmp_path / 'nothing'))
+    main(['op-env', 'json', '--backend', 'v2', '-e', 'STRIPE_API_KEY', '--replay', rec])
+    replayed = json.loads(capsys.readouterr().out)
+    assert len(replayed['STRIPE_API_KEY']) == len('sk_123')
+    assert replayed['STRIPE_API_KEY'] != 'sk_123'
@@ -0,0 +1,59 @@
+"""Tests for `op_env.store`."""
+
+import os
+import stat
+
+import pytest
+
+from op_env.op import FieldReference
+from op_env.store import snapshot_name, SnapshotStore
+
+fernet = pytest.importorskip('cryptography.fernet')
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SnapshotStore(directory=str(tmp_path), key=fernet.Fernet.generate_key())
+
+
+def test_snapshot_round_trip(store):
+    assert store.load('abc') is None
+    assert store.save('abc', {'A': 'secret'}) is True
+    snapshot = store.load('abc')
+    assert snapshot.values == {'A': 'secret'}
+    assert 0 <= snapshot.age < 60
+
+
+def test_snapshot_is_encrypted_and_private(store):
+    store.save('abc', {'A': 'secret'})
+    path = store.path('abc')
+    with open(path, 'rb') as f:
+        assert b'secret' not in f.read()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_snapshot_save_reports_changes(store):
+    store.save('abc', {'A': 'one'})
+    assert store.save('abc', {'A': 'one'}) is False
+    assert store.save('abc', {'A': 'two'}) is True
+
+
+def test_snapshot_with_wrong_key_is_ignored(store, tmp_path):
+    store.save('abc', {'A': 'one'})
+    other_store = SnapshotStore(directory=str(tmp_path), key=fernet.Fernet.generate_key())
+    assert other_store.load('abc') is None
+
+
+def test_snapshot_name_ignores_order():
+    assert snapshot_name(['A', 'B'], ['t']) == snapshot_name(['B', 'A'], ['t'])
+    assert snapshot_name(['A'], []) != snapshot_name([], ['A'])
+
+
+def test_snapshot_name_depends_on_field_mapping_and_backend():
+    names = {
+        snapshot_name(['A'], []),
+        snapshot_name(['A'], [], {'A': FieldReference('password')}),
+        snapshot_name(['A'], [], {'A': FieldReference('password', 'db')}),
+        snapshot_name(['A'], [], backend='v2'),
+    }
+    assert len(names) == 4
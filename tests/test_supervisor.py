@@ -0,0 +1,41 @@
+"""Tests for `op_env.supervisor`."""
+
+import io
+import os
+
+import pytest
+
+from op_env.supervisor import load_procfile, ProcfileEntry, supervise
+
+
+def test_load_procfile(tmp_path):
+    procfile = tmp_path / 'Procfile'
+    procfile.write_text('# processes\nweb: bin/web --port 80\n\nworker:bin/worker\n')
+    assert load_procfile(str(procfile)) == [
+        ProcfileEntry(name='web', command='bin/web --port 80'),
+        ProcfileEntry(name='worker', command='bin/worker'),
+    ]
+
+
+def test_load_procfile_invalid(tmp_path):
+    procfile = tmp_path / 'Procfile'
+    procfile.write_text('web\n')
+    with pytest.raises(ValueError, match='Procfile lines must look like'):
+        load_procfile(str(procfile))
+
+
+def test_supervise_shares_env_and_prefixes_output():
+    out = io.StringIO()
+    entries = [
+        ProcfileEntry(name='web', command='echo "web sees $SECRET"; sleep 30'),
+        ProcfileEntry(name='worker', command='echo "worker sees $SECRET"; exit 3'),
+    ]
+    status = supervise(entries, {**os.environ, 'SECRET': 'shared'}, out)
+    assert status == 3
+    lines = sorted(out.getvalue().splitlines())
+    assert lines == ['web    | web sees shared', 'worker | worker sees shared']
+
+
+def test_supervise_reports_signal_exit_like_a_shell():
+    entries = [ProcfileEntry(name='web', command='kill -TERM $$')]
+    assert supervise(entries, dict(os.environ), io.StringIO()) == 143
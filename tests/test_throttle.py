@@ -0,0 +1,117 @@
+"""Tests for `op_env.throttle`."""
+
+import json
+import subprocess
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+import op_env
+from op_env import metrics
+from op_env.op import deadline, do_lookups, TimeoutOPLookupError
+from op_env.throttle import configured_limit, OpSlots
+
+
+@pytest.fixture
+def slots_path(tmp_path):
+    return str(tmp_path / 'op-slots.json')
+
+
+def test_slots_limit_holders(slots_path):
+    slots = OpSlots(2, path=slots_path)
+    first = slots.acquire()
+    slots.acquire()
+    with pytest.raises(subprocess.TimeoutExpired):
+        slots.acquire(timeout=0.05)
+    slots.release(first)
+    slots.acquire(timeout=0.05)
+    with open(slots_path) as f:
+        state = json.load(f)
+    assert len(state['holders']) == 2
+    # the waiter which timed out is no longer queued
+    assert state['queue'] == []
+
+
+def test_slots_serve_waiters_in_order(slots_path):
+    slots = OpSlots(1, path=slots_path)
+    token = slots.acquire()
+    order = []
+
+    def wait(name):
+        with slots.slot():
+            order.append(name)
+    threads = []
+    for name in ['a', 'b', 'c']:
+        thread = threading.Thread(target=wait, args=(name,))
+        thread.start()
+        threads.append(thread)
+        # let each thread queue up before the next
+        time.sleep(0.05)
+    slots.release(token)
+    for thread in threads:
+        thread.join()
+    assert order == ['a', 'b', 'c']
+
+
+def test_slots_skip_dead_processes(slots_path):
+    dead = subprocess.Popen([sys.executable, '-c', ''])
+    dead.wait()
+    with open(slots_path, 'w') as f:
+        json.dump({'holders': [[dead.pid, 'x']], 'queue': [[dead.pid, 'y']]}, f)
+    slots = OpSlots(1, path=slots_path)
+    slots.acquire(timeout=0.05)
+
+
+def test_slots_shared_between_processes(tmp_path, slots_path):
+    script = f"""
+import sys, time
+from op_env.throttle import OpSlots
+with OpSlots(2, path={slots_path!r}).slot():
+    print(time.time())
+    time.sleep(0.3)
+    print(time.time())
+"""
+    processes = [subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE)
+                 for _ in range(4)]
+    spans = []
+    for process in processes:
+        out, _ = process.communicate(timeout=30)
+        start, end = map(float, out.split())
+        spans.append((start, end))
+    for start, _ in spans:
+        running = sum(1 for other_start, other_end in spans
+                      if other_start <= start < other_end)
+        assert running <= 2
+
+
+def test_configured_limit(monkeypatch):
+    monkeypatch.delenv('OP_ENV_MAX_CONCURRENCY', raising=False)
+    assert configured_limit() is None
+    monkeypatch.setenv('OP_ENV_MAX_CONCURRENCY', '3')
+    assert configured_limit() == 3
+    monkeypatch.setenv('OP_ENV_MAX_CONCURRENCY', 'lots')
+    with pytest.raises(ValueError, match='must be a whole number'):
+        configured_limit()
+
+
+@patch('op_env.op.subprocess', autospec=op_env.op.subprocess)
+def test_op_calls_wait_for_slots_within_deadline(subprocess_mock, tmp_path, monkeypatch):
+    monkeypatch.setenv('OP_ENV_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('OP_ENV_MAX_CONCURRENCY', '1')
+    aggregator = metrics.PrometheusAggregator()
+    holder = OpSlots(1).acquire()
+    with metrics.observing(aggregator):
+        with pytest.raises(TimeoutOPLookupError):
+            with deadline(0.2):
+                do_lookups(['A'], [])
+        subprocess_mock.check_output.assert_not_called()
+        OpSlots(1).release(holder)
+        subprocess_mock.check_output.side_effect = [
+            json.dumps([{'uuid': 'u', 'overview': {'tags': ['A']}}]).encode('utf-8'),
+            b'{"a": "1"}\n',
+        ]
+        assert do_lookups(['A'], []) == {'A': '1'}
+    assert 'op_env_slot_wait_seconds_count{limit="1"} 2' in aggregator.render()